@@ -1,18 +1,23 @@
+from __future__ import annotations
+
 import os
-from matplotlib import pyplot as plt
+import gzip
+import shutil
 import numpy as np
 import itertools
-from typing import List, Union, Tuple, Optional
-from eolearn.core import EOPatch
-from shapely.geometry import Polygon, MultiPolygon
-from matplotlib import patches, patheffects
+from typing import List, Union, Tuple, Optional, TYPE_CHECKING
 from datetime import datetime
 
-from eolearn.io import ImportFromTiff
-
 from logging import Logger
 logger = Logger(__file__)
 
+# matplotlib, shapely and eo-learn are slow to import, they are only 
+# imported by the functions that use them
+if TYPE_CHECKING:
+    from matplotlib import pyplot as plt
+    from eolearn.core import EOPatch
+    from shapely.geometry import Polygon, MultiPolygon
+
 
 def get_extent(eopatch: EOPatch) -> Tuple[float, float, float, float]:
     """
@@ -41,6 +46,7 @@ def draw_outline(o, lw, foreground='black'):
     Returns
     -------
     """
+    from matplotlib import patheffects
     o.set_path_effects([patheffects.Stroke(linewidth=lw, foreground=foreground), patheffects.Normal()])
 
 
@@ -60,6 +66,8 @@ def draw_poly(ax, poly: Union[Polygon, MultiPolygon], color: str = 'r', lw: int
     -------
 
     """
+    from matplotlib import patches
+    from shapely.geometry import MultiPolygon
     if isinstance(poly, MultiPolygon):
         polys = list(poly)
     else:
@@ -95,12 +103,13 @@ def draw_bbox(ax, eopatch: EOPatch, color: str = 'r', lw: int = 2, outline: bool
     -------
 
     """
+    from shapely.geometry import Polygon
     bbox_poly = eopatch.bbox.get_polygon()
     draw_poly(ax, Polygon(bbox_poly), color=color, lw=lw, outline=outline)
 
 
 def draw_feature(ax, eopatch: EOPatch, time_idx: Union[List[int], int, None], feature: tuple, grid: bool = True, band: int = None, interpolation: str = 'none',
-              vmin: int = 0, vmax: int = 1, alpha: float = 1.0, cmap=plt.cm.viridis):
+              vmin: int = 0, vmax: int = 1, alpha: float = 1.0, cmap='viridis'):
     """
     Draws an EOPatch feature.
     Parameters
@@ -228,6 +237,8 @@ def load_tiffs(datapath,
                data_source='s5p', 
                offset=2100):
     """ Helper function to load the data sources provided as tiffs """
+    from eolearn.io import ImportFromTiff
+
     assert data_source in ['s5p', 'modis', 'era5', 'cams', 's3']
     
     tiles = sorted(os.listdir(datapath)) if filename is None else [filename]
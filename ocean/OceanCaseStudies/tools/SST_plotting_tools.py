@@ -1,20 +1,22 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import cartopy.crs as ccrs
-import cartopy.feature as cfeature
-import image_tools as img
-from matplotlib import gridspec 
-import xarray as xr
 import os,sys
-import xmltodict
 
 def make_SLSTR_composite_plot(nc_files, plot_extents=None, fsz=20,\
                               land_resolution='50m', vmin=10, vmax=28,\
                               xsize=20, ysize=16, dpi=150, QMASK=4,\
-                              cmap=plt.cm.RdYlBu_r, grid_factor=None):
+                              cmap='RdYlBu_r', grid_factor=None):
     '''
      Plots SLSTR images from n-input files, will overay first to last.
     '''
+    # plotting and reading modules are slow to import, so only import
+    # them when a plot is made
+    import matplotlib.pyplot as plt
+    import cartopy.crs as ccrs
+    import cartopy.feature as cfeature
+    import image_tools as img
+    from matplotlib import gridspec 
+    import xarray as xr
+    import xmltodict
     
     if not grid_factor:
         grid_factor = 1
@@ -0,0 +1,142 @@
+'''
+
+  Benchmark of the marineHeatWaves module on a
+  synthetic daily SST time series
+
+'''
+
+# Load required modules
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from datetime import date
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import marineHeatWaves as mhw
+
+def dateVectorsLoop(t):
+    '''
+    Reference implementation of marineHeatWaves.dateVectors, with one
+    call to date.fromordinal per time step and a search of a leap-year
+    table for the day-of-year (as in marineHeatWaves v0.28)
+    '''
+    T = len(t)
+    year = np.zeros((T))
+    month = np.zeros((T))
+    day = np.zeros((T))
+    doy = np.zeros((T))
+    for i in range(T):
+        year[i] = date.fromordinal(t[i]).year
+        month[i] = date.fromordinal(t[i]).month
+        day[i] = date.fromordinal(t[i]).day
+    t_leapYear = np.arange(date(2012, 1, 1).toordinal(),date(2012, 12, 31).toordinal()+1)
+    month_leapYear = np.zeros((len(t_leapYear)))
+    day_leapYear = np.zeros((len(t_leapYear)))
+    doy_leapYear = np.zeros((len(t_leapYear)))
+    for tt in range(len(t_leapYear)):
+        month_leapYear[tt] = date.fromordinal(t_leapYear[tt]).month
+        day_leapYear[tt] = date.fromordinal(t_leapYear[tt]).day
+        doy_leapYear[tt] = t_leapYear[tt] - date(2012,1,1).toordinal() + 1
+    for tt in range(T):
+        doy[tt] = doy_leapYear[(month_leapYear == month[tt]) * (day_leapYear == day[tt])][0]
+    return year, month, day, doy
+
+def windowClimatologyLoop(doy, temp, start, end, pctile, windowHalfWidth):
+    '''
+    Reference implementation of marineHeatWaves.windowClimatology, with
+    a loop over the day-of-year values (as in marineHeatWaves v0.28)
+    '''
+    thresh_climYear = np.NaN*np.zeros(366)
+    seas_climYear = np.NaN*np.zeros(366)
+    for d in range(1,366+1):
+        if d == 60:
+            continue
+        tt0 = np.where(doy[start:end+1] == d)[0]
+        if len(tt0) == 0:
+            continue
+        tt = np.array([])
+        for w in range(-windowHalfWidth, windowHalfWidth+1):
+            tt = np.append(tt, start+tt0 + w)
+        tt = tt[tt>=0]
+        tt = tt[tt<len(temp)]
+        thresh_climYear[d-1] = np.percentile(mhw.nonans(temp[tt.astype(int)]), pctile)
+        seas_climYear[d-1] = np.mean(mhw.nonans(temp[tt.astype(int)]))
+    return thresh_climYear, seas_climYear
+
+def synthetic(years, seed=0):
+    '''
+    Synthetic SST time series: seasonal cycle, warming trend and noise
+    '''
+    t = np.arange(date(1982,1,1).toordinal(), date(1982+years-1,12,31).toordinal()+1)
+    rng = np.random.RandomState(seed)
+    sst = 15. + 4.*np.cos(2*np.pi*(t - t[0])/365.25) + 0.03*(t - t[0])/365.25 + rng.randn(len(t))
+    return t, sst
+
+def timeit(func, repeat):
+    '''
+    Returns the best wall-clock time [s] of repeat calls of func
+    '''
+    best = np.inf
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the marineHeatWaves module on a synthetic SST time series.')
+    parser.add_argument('--years', type=int, default=35, help='length of the time series [years]')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--cells', type=int, default=100, help='number of grid cells for detectGrid')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes for detectParallel')
+    args = parser.parse_args()
+
+    t, sst = synthetic(args.years)
+    print('%d days (%d years)' % (len(t), args.years))
+
+    # Calendar
+    if not all(np.array_equal(a, b) for a, b in zip(dateVectorsLoop(t), mhw.dateVectors(t))):
+        print('Error: dateVectors differs from the reference implementation')
+        sys.exit(1)
+    loop = timeit(lambda: dateVectorsLoop(t), args.repeat)
+    vectorized = timeit(lambda: mhw.dateVectors(t), args.repeat)
+    print('%-24s %10.4f s' % ('dateVectors (loop)', loop))
+    print('%-24s %10.4f s  (x%.0f)' % ('dateVectors', vectorized, loop/vectorized))
+
+    # Climatology
+    doy = mhw.dateVectors(t)[3]
+    sst[np.random.RandomState(1).rand(len(t)) < 0.02] = np.nan
+    climArgs = (doy, sst, 0, len(t)-1, 90, 5)
+    if not all(np.array_equal(a, b, equal_nan=True) for a, b in zip(windowClimatologyLoop(*climArgs), mhw.windowClimatology(*climArgs))):
+        print('Error: windowClimatology differs from the reference implementation')
+        sys.exit(1)
+    loop = timeit(lambda: windowClimatologyLoop(*climArgs), args.repeat)
+    vectorized = timeit(lambda: mhw.windowClimatology(*climArgs), args.repeat)
+    print('%-24s %10.4f s' % ('windowClimatology (loop)', loop))
+    print('%-24s %10.4f s  (x%.0f)' % ('windowClimatology', vectorized, loop/vectorized))
+
+    # Detection and block averages
+    print('%-24s %10.4f s' % ('detect', timeit(lambda: mhw.detect(t, sst.copy()), args.repeat)))
+    mhws, clim = mhw.detect(t, sst.copy())
+    print('%-24s %10.4f s' % ('blockAverage', timeit(lambda: mhw.blockAverage(t, mhws), args.repeat)))
+
+    # Daily update of the last year relative to a precomputed climatology
+    clim = mhw.climatology(t, sst)
+    recent = slice(-365, None)
+    print('%-24s %10.4f s' % ('climatology', timeit(lambda: mhw.climatology(t, sst), args.repeat)))
+    print('%-24s %10.4f s' % ('detect (last year)', timeit(lambda: mhw.detect(t[recent], sst[recent].copy(), precomputedClimatology=clim), args.repeat)))
+
+    # Gridded detection
+    grid = np.array([synthetic(args.years, seed)[1] for seed in range(args.cells)]).T
+    loop = timeit(lambda: [mhw.detect(t, grid[:,c].copy(), climatologyPeriod=[None,None]) for c in range(args.cells)], 1)
+    vectorized = timeit(lambda: mhw.detectGrid(t, grid), 1)
+    print('%-24s %10.4f s' % ('detect (%d cells)' % args.cells, loop))
+    print('%-24s %10.4f s  (x%.0f)' % ('detectGrid (%d cells)' % args.cells, vectorized, loop/vectorized))
+    parallel = timeit(lambda: mhw.detectParallel(t, grid, nWorkers=args.workers), 1)
+    print('%-24s %10.4f s  (x%.0f, %d workers)' % ('detectParallel', parallel, loop/parallel, args.workers))
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,9 @@
 '''
 
 
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
 import numpy as np
 import scipy as sp
 from scipy import linalg
@@ -14,7 +17,11 @@ import scipy.ndimage as ndimage
 from datetime import date
 
 
-def detect(t, temp, climatologyPeriod=[None,None], pctile=90, windowHalfWidth=5, smoothPercentile=True, smoothPercentileWidth=31, minDuration=5, joinAcrossGaps=True, maxGap=2, maxPadLength=False, coldSpells=False, alternateClimatology=False):
+# Day-of-year of the last day of each previous month in a leap year
+DOY_LEAPYEAR = np.cumsum([0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30])
+
+
+def detect(t, temp, climatologyPeriod=[None,None], pctile=90, windowHalfWidth=5, smoothPercentile=True, smoothPercentileWidth=31, minDuration=5, joinAcrossGaps=True, maxGap=2, maxPadLength=False, coldSpells=False, alternateClimatology=False, precomputedClimatology=None):
     '''
 
     Applies the Hobday et al. (2016) marine heat wave definition to an input time
@@ -111,6 +118,13 @@ def detect(t, temp, climatologyPeriod=[None,None], pctile=90, windowHalfWidth=5,
                              [1D numpy array of length TClim] and (2) the second element of
                              the list is a temperature vector [1D numpy array of length TClim].
                              (DEFAULT = False)
+      precomputedClimatology Specifies a climatology calculated with marineHeatWaves.climatology
+                             (or loaded with marineHeatWaves.loadClimatology), which is used
+                             instead of calculating the climatology from temp, e.g., to detect
+                             MHWs in recent data relative to a fixed baseline period. The options
+                             climatologyPeriod, pctile, windowHalfWidth, smoothPercentile,
+                             smoothPercentileWidth and alternateClimatology are then ignored.
+                             (DEFAULT = None)
 
     Notes:
 
@@ -180,32 +194,7 @@ def detect(t, temp, climatologyPeriod=[None,None], pctile=90, windowHalfWidth=5,
 
     # Generate vectors for year, month, day-of-month, and day-of-year
     T = len(t)
-    year = np.zeros((T))
-    month = np.zeros((T))
-    day = np.zeros((T))
-    doy = np.zeros((T))
-    for i in range(T):
-        year[i] = date.fromordinal(t[i]).year
-        month[i] = date.fromordinal(t[i]).month
-        day[i] = date.fromordinal(t[i]).day
-    # Leap-year baseline for defining day-of-year values
-    year_leapYear = 2012 # This year was a leap-year and therefore doy in range of 1 to 366
-    t_leapYear = np.arange(date(year_leapYear, 1, 1).toordinal(),date(year_leapYear, 12, 31).toordinal()+1)
-    dates_leapYear = [date.fromordinal(tt.astype(int)) for tt in t_leapYear]
-    month_leapYear = np.zeros((len(t_leapYear)))
-    day_leapYear = np.zeros((len(t_leapYear)))
-    doy_leapYear = np.zeros((len(t_leapYear)))
-    for tt in range(len(t_leapYear)):
-        month_leapYear[tt] = date.fromordinal(t_leapYear[tt]).month
-        day_leapYear[tt] = date.fromordinal(t_leapYear[tt]).day
-        doy_leapYear[tt] = t_leapYear[tt] - date(date.fromordinal(t_leapYear[tt]).year,1,1).toordinal() + 1
-    # Calculate day-of-year values
-    for tt in range(T):
-        doy[tt] = doy_leapYear[(month_leapYear == month[tt]) * (day_leapYear == day[tt])]
-
-    # Constants (doy values for Feb-28 and Feb-29) for handling leap-years
-    feb28 = 59
-    feb29 = 60
+    year, month, day, doy = dateVectors(t)
 
     # Set climatology period, if unset use full range of available data
     if (climatologyPeriod[0] is None) or (climatologyPeriod[1] is None):
@@ -216,83 +205,27 @@ def detect(t, temp, climatologyPeriod=[None,None], pctile=90, windowHalfWidth=5,
     # Calculate threshold and seasonal climatology (varying with day-of-year)
     #
 
-    # if alternate temperature time series is supplied for the calculation of the climatology
-    if alternateClimatology:
-        tClim = alternateClimatology[0]
-        tempClim = alternateClimatology[1]
-        TClim = len(tClim)
-        yearClim = np.zeros((TClim))
-        monthClim = np.zeros((TClim))
-        dayClim = np.zeros((TClim))
-        doyClim = np.zeros((TClim))
-        for i in range(TClim):
-            yearClim[i] = date.fromordinal(tClim[i]).year
-            monthClim[i] = date.fromordinal(tClim[i]).month
-            dayClim[i] = date.fromordinal(tClim[i]).day
-            doyClim[i] = doy_leapYear[(month_leapYear == monthClim[i]) * (day_leapYear == dayClim[i])]
-    else:
-        tempClim = temp.copy()
-        TClim = np.array([T]).copy()[0]
-        yearClim = year.copy()
-        monthClim = month.copy()
-        dayClim = day.copy()
-        doyClim = doy.copy()
+    # unless a precomputed climatology is supplied
+    if precomputedClimatology is None:
+        # if alternate temperature time series is supplied for the calculation of the climatology
+        if alternateClimatology:
+            tClim = alternateClimatology[0]
+            tempClim = alternateClimatology[1]
+        else:
+            tClim = t
+            tempClim = temp
+        precomputedClimatology = climatology(tClim, tempClim, climatologyPeriod=climatologyPeriod, pctile=pctile, windowHalfWidth=windowHalfWidth, smoothPercentile=smoothPercentile, smoothPercentileWidth=smoothPercentileWidth, maxPadLength=maxPadLength, coldSpells=coldSpells)
+    thresh_climYear, seas_climYear = climatologyYear(precomputedClimatology, coldSpells)
 
     # Flip temp time series if detecting cold spells
     if coldSpells:
         temp = -1.*temp
-        tempClim = -1.*tempClim
 
     # Pad missing values for all consecutive missing blocks of length <= maxPadLength
     if maxPadLength:
         temp = pad(temp, maxPadLength=maxPadLength)
-        tempClim = pad(tempClim, maxPadLength=maxPadLength)
 
-    # Length of climatological year
-    lenClimYear = 366
-    # Start and end indices
-    clim_start = np.where(yearClim == climatologyPeriod[0])[0][0]
-    clim_end = np.where(yearClim == climatologyPeriod[1])[0][-1]
-    # Inialize arrays
-    thresh_climYear = np.NaN*np.zeros(lenClimYear)
-    seas_climYear = np.NaN*np.zeros(lenClimYear)
     clim = {}
-    clim['thresh'] = np.NaN*np.zeros(TClim)
-    clim['seas'] = np.NaN*np.zeros(TClim)
-    # Loop over all day-of-year values, and calculate threshold and seasonal climatology across years
-    for d in range(1,lenClimYear+1):
-        # Special case for Feb 29
-        if d == feb29:
-            continue
-        # find all indices for each day of the year +/- windowHalfWidth and from them calculate the threshold
-        tt0 = np.where(doyClim[clim_start:clim_end+1] == d)[0] 
-        # If this doy value does not exist (i.e. in 360-day calendars) then skip it
-        if len(tt0) == 0:
-            continue
-        tt = np.array([])
-        for w in range(-windowHalfWidth, windowHalfWidth+1):
-            tt = np.append(tt, clim_start+tt0 + w)
-        tt = tt[tt>=0] # Reject indices "before" the first element
-        tt = tt[tt<TClim] # Reject indices "after" the last element
-        thresh_climYear[d-1] = np.percentile(nonans(tempClim[tt.astype(int)]), pctile)
-        seas_climYear[d-1] = np.mean(nonans(tempClim[tt.astype(int)]))
-    # Special case for Feb 29
-    thresh_climYear[feb29-1] = 0.5*thresh_climYear[feb29-2] + 0.5*thresh_climYear[feb29]
-    seas_climYear[feb29-1] = 0.5*seas_climYear[feb29-2] + 0.5*seas_climYear[feb29]
-
-    # Smooth if desired
-    if smoothPercentile:
-        # If the climatology contains NaNs, then assume it is a <365-day year and deal accordingly
-        if np.sum(np.isnan(seas_climYear)) + np.sum(np.isnan(thresh_climYear)):
-            valid = ~np.isnan(thresh_climYear)
-            thresh_climYear[valid] = runavg(thresh_climYear[valid], smoothPercentileWidth)
-            valid = ~np.isnan(seas_climYear)
-            seas_climYear[valid] = runavg(seas_climYear[valid], smoothPercentileWidth)
-        # >= 365-day year
-        else:
-            thresh_climYear = runavg(thresh_climYear, smoothPercentileWidth)
-            seas_climYear = runavg(seas_climYear, smoothPercentileWidth)
-
     # Generate threshold for full time series
     clim['thresh'] = thresh_climYear[doy.astype(int)-1]
     clim['seas'] = seas_climYear[doy.astype(int)-1]
@@ -423,6 +356,671 @@ def detect(t, temp, climatologyPeriod=[None,None], pctile=90, windowHalfWidth=5,
     return mhw, clim
 
 
+def detectGrid(t, temp, climatologyPeriod=[None,None], pctile=90, windowHalfWidth=5, smoothPercentile=True, smoothPercentileWidth=31, minDuration=5, joinAcrossGaps=True, maxGap=2, maxPadLength=False, coldSpells=False, alternateClimatology=False, precomputedClimatology=None):
+    '''
+
+    Applies the Hobday et al. (2016) marine heat wave definition to gridded temperature,
+    e.g., a (time, lat, lon) cube of SST, for all grid cells at once. Outputs, for each grid
+    cell, statistics of the marine heat waves detected in its time series.
+
+    Inputs:
+
+      t       Time vector, in datetime format (e.g., date(1982,1,1).toordinal())
+              [1D numpy array of length T]. May be None if temp is an xarray DataArray,
+              in which case the time coordinate of temp is used.
+      temp    Gridded temperature [numpy array or xarray DataArray of shape (T, ...),
+              e.g., (T, lat, lon)]. The first dimension is time.
+
+    Outputs:
+
+      mhw     Statistics of the detected marine heat waves (MHWs) for each grid cell. Each
+              key (following list) is an array of the shape of the grid (e.g., (lat, lon)):
+
+        'count'                Total MHW count
+        'duration'             Average MHW duration [days]
+        'intensity_max'        Average MHW "maximum (peak) intensity" [deg. C]
+        'intensity_max_max'    Maximum MHW "maximum (peak) intensity" [deg. C]
+        'intensity_mean'       Average MHW "mean intensity" [deg. C]
+        'intensity_var'        Average MHW "intensity variability" [deg. C]
+        'intensity_cumulative' Average MHW "cumulative intensity" [deg. C x days]
+        'rate_onset'           Average MHW onset rate [deg. C / days]
+        'rate_decline'         Average MHW decline rate [deg. C / days]
+        'total_days'           Total number of MHW days [days]
+        'total_icum'           Total cumulative intensity over all MHWs [deg. C x days]
+        'moderate_days', 'strong_days', 'severe_days', 'extreme_days'
+                               Total number of MHW days in each category [days]
+
+        'intensity_max_relThresh', 'intensity_mean_relThresh', 'intensity_var_relThresh',
+        and 'intensity_cumulative_relThresh' are as above except relative to the
+        threshold (e.g., 90th percentile) rather than the seasonal climatology
+
+        'intensity_max_abs', 'intensity_mean_abs', 'intensity_var_abs', and
+        'intensity_cumulative_abs' are as above except as absolute magnitudes
+        rather than relative to the seasonal climatology or threshold
+
+        Averages are NaN for cells without MHWs.
+
+      clim    Climatology of SST:
+
+        'thresh'               Threshold (e.g., 90th percentile) for each day-of-year
+                               [array of shape (366, ...)]
+        'seas'                 Climatological seasonal cycle for each day-of-year
+                               [array of shape (366, ...)]
+        'missing'              TRUE/FALSE indicating which elements in temp were missing
+                               values for the MHWs detection [array of shape (T, ...)]
+
+      If temp is an xarray DataArray, mhw and clim are xarray Datasets with the grid
+      coordinates of temp.
+
+    Options:
+
+      As for marineHeatWaves.detect. If alternateClimatology is supplied, its temperature
+      is gridded as temp, i.e., of shape (TClim, ...). A precomputedClimatology is that of
+      the same grid.
+
+    Notes:
+
+      1. The MHWs of each grid cell are those detected by marineHeatWaves.detect for the
+         time series of that cell, and their properties are calculated in the same way.
+         Thresholds, climatologies and MHW properties may differ from those of detect by
+         rounding errors only.
+
+      2. Grid cells with only missing values (e.g., land) have no MHWs and NaN climatologies.
+
+      3. The average intensities of cold spells (coldSpells = True) are negative, and
+         'intensity_max_max' is the most negative peak intensity.
+
+    '''
+
+    #
+    # Gridded temperature as a (time x cells) matrix
+    #
+
+    grid = None
+    if hasattr(temp, 'dims'): # xarray DataArray
+        grid = temp
+        if t is None:
+            t = gridTime(grid)
+        temp = grid.values
+    t = np.asarray(t)
+    T = len(t)
+    shape = np.shape(temp)[1:]
+    temp = np.array(temp, dtype=float).reshape(T, -1)
+    N = temp.shape[1]
+
+    # Generate vectors for year, month, day-of-month, and day-of-year
+    year, month, day, doy = dateVectors(t)
+
+    # Set climatology period, if unset use full range of available data
+    climatologyPeriod = list(climatologyPeriod)
+    if (climatologyPeriod[0] is None) or (climatologyPeriod[1] is None):
+        climatologyPeriod[0] = year[0]
+        climatologyPeriod[1] = year[-1]
+
+    #
+    # Calculate threshold and seasonal climatology (varying with day-of-year)
+    #
+
+    # unless a precomputed climatology is supplied
+    if precomputedClimatology is None:
+        # if alternate temperature time series is supplied for the calculation of the climatology
+        if alternateClimatology:
+            tClim = alternateClimatology[0]
+            tempClim = np.reshape(alternateClimatology[1], (len(tClim), -1))
+        else:
+            tClim = t
+            tempClim = temp
+        precomputedClimatology = climatology(tClim, tempClim, climatologyPeriod=climatologyPeriod, pctile=pctile, windowHalfWidth=windowHalfWidth, smoothPercentile=smoothPercentile, smoothPercentileWidth=smoothPercentileWidth, maxPadLength=maxPadLength, coldSpells=coldSpells)
+    thresh_climYear, seas_climYear = climatologyYear(precomputedClimatology, coldSpells)
+    thresh_climYear = thresh_climYear.reshape(366, N)
+    seas_climYear = seas_climYear.reshape(366, N)
+
+    # Flip temp time series if detecting cold spells
+    if coldSpells:
+        temp = -1.*temp
+
+    # Pad missing values for all consecutive missing blocks of length <= maxPadLength
+    if maxPadLength:
+        missing = np.isnan(temp)
+        for c in np.where(missing.any(axis=0) * ~missing.all(axis=0))[0]:
+            temp[:,c] = pad(temp[:,c], maxPadLength=maxPadLength)
+
+    # Generate threshold for full time series
+    thresh = thresh_climYear[doy.astype(int)-1]
+    seas = seas_climYear[doy.astype(int)-1]
+
+    # Save array indicating which points in temp are missing values
+    missing = np.isnan(temp)
+    # Set all remaining missing temp values equal to the climatology
+    temp[missing] = seas[missing]
+
+    #
+    # Find MHWs as exceedances above the threshold
+    #
+
+    # Start and end indices of contiguous exceedances, ordered by cell then time
+    exceed = np.zeros((N, T+2), dtype=np.int8)
+    exceed[:,1:-1] = (temp > thresh).T
+    cell, start = np.nonzero(np.diff(exceed, axis=1) == 1)
+    end = np.nonzero(np.diff(exceed, axis=1) == -1)[1] - 1
+
+    # Find all MHW events of duration >= minDuration
+    long = end - start + 1 >= minDuration
+    cell, start, end = cell[long], start[long], end[long]
+
+    # Link heat waves that occur before and after a short gap (gap must be no longer than maxGap)
+    if joinAcrossGaps and len(start) > 1:
+        gaps = t[start[1:]] - t[end[:-1]] - 1
+        join = (cell[1:] == cell[:-1]) * (gaps <= maxGap)
+        isStart = np.append(True, ~join)
+        isEnd = np.append(~join, True)
+        cell, start, end = cell[isStart], start[isStart], end[isEnd]
+
+    #
+    # Calculate marine heat wave properties
+    #
+
+    # All days of all MHWs: MHW number, day of the MHW, time index
+    duration = end - start + 1
+    first = np.cumsum(duration) - duration
+    ev = np.repeat(np.arange(len(start)), duration)
+    offset = np.arange(duration.sum()) - first[ev]
+    tt = start[ev] + offset
+    # SST during MHWs, relative to both threshold and to seasonal climatology
+    temp_mhw = temp[tt, cell[ev]]
+    thresh_mhw = thresh[tt, cell[ev]]
+    seas_mhw = seas[tt, cell[ev]]
+    mhw_relSeas = temp_mhw - seas_mhw
+    mhw_relThresh = temp_mhw - thresh_mhw
+    mhw_relThreshNorm = (temp_mhw - thresh_mhw) / (thresh_mhw - seas_mhw)
+    mhw_abs = temp_mhw
+
+    def eventSum(x):
+        return np.add.reduceat(x, first) if len(first) else np.zeros(0)
+
+    def intensities(x, peak):
+        mean = eventSum(x) / duration
+        return x[first + peak], mean, np.sqrt(eventSum((x - mean[ev])**2) / duration), eventSum(x)
+
+    # Find peak (first maximum of each MHW)
+    relSeas_peak = np.maximum.reduceat(mhw_relSeas, first) if len(first) else np.zeros(0)
+    tt_peak = np.minimum.reduceat(np.where(mhw_relSeas == relSeas_peak[ev], offset, T), first) if len(first) else np.zeros(0, dtype=int)
+    # MHW Intensity metrics
+    events = {}
+    events['intensity_max'], events['intensity_mean'], events['intensity_var'], events['intensity_cumulative'] = intensities(mhw_relSeas, tt_peak)
+    events['intensity_max_relThresh'], events['intensity_mean_relThresh'], events['intensity_var_relThresh'], events['intensity_cumulative_relThresh'] = intensities(mhw_relThresh, tt_peak)
+    events['intensity_max_abs'], events['intensity_mean_abs'], events['intensity_var_abs'], events['intensity_cumulative_abs'] = intensities(mhw_abs, tt_peak)
+    events['duration'] = duration
+    # Categories
+    cats = np.floor(1. + mhw_relThreshNorm)
+    events['moderate_days'] = eventSum(cats == 1.)
+    events['strong_days'] = eventSum(cats == 2.)
+    events['severe_days'] = eventSum(cats == 3.)
+    events['extreme_days'] = eventSum(cats >= 4.)
+
+    # Rates of onset and decline
+    # Requires getting MHW strength at "start" and "end" of event (continuous: assume start/end half-day before/after first/last point)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relSeas_start = 0.5*(mhw_relSeas[first] + temp[start-1, cell] - seas[start-1, cell])
+        events['rate_onset'] = np.where(start > 0, (relSeas_peak - relSeas_start) / (tt_peak+0.5), \
+                               (relSeas_peak - mhw_relSeas[first]) / np.where(tt_peak == 0, 1., tt_peak))
+        relSeas_end = 0.5*(mhw_relSeas[first+duration-1] + temp[np.minimum(end+1, T-1), cell] - seas[np.minimum(end+1, T-1), cell])
+        events['rate_decline'] = np.where(end < T-1, (relSeas_peak - relSeas_end) / (end-start-tt_peak+0.5), \
+                                 (relSeas_peak - mhw_relSeas[first+duration-1]) / np.where(tt_peak == T-1, 1., end-start-tt_peak))
+
+    # Flip climatology and intensties in case of cold spell detection
+    if coldSpells:
+        thresh_climYear = -1.*thresh_climYear
+        seas_climYear = -1.*seas_climYear
+        for key in events:
+            if key.startswith('intensity') and ('_var' not in key):
+                events[key] = -1.*events[key]
+
+    #
+    # Statistics of the MHWs of each grid cell
+    #
+
+    mhwGrid = {}
+    mhwGrid['count'] = np.bincount(cell, minlength=N).astype(float)
+    count = mhwGrid['count'].copy()
+    count[count==0] = np.nan
+    for key in ['duration', 'intensity_max', 'intensity_mean', 'intensity_var', 'intensity_cumulative', \
+                'intensity_max_relThresh', 'intensity_mean_relThresh', 'intensity_var_relThresh', 'intensity_cumulative_relThresh', \
+                'intensity_max_abs', 'intensity_mean_abs', 'intensity_var_abs', 'intensity_cumulative_abs', 'rate_onset', 'rate_decline']:
+        mhwGrid[key] = np.bincount(cell, weights=events[key], minlength=N) / count
+    # Largest peak intensity (most negative for cold spells)
+    sign = -1. if coldSpells else 1.
+    peak = -np.inf*np.ones(N)
+    np.maximum.at(peak, cell, sign*events['intensity_max'])
+    mhwGrid['intensity_max_max'] = np.where(np.isnan(count), np.nan, sign*peak)
+    mhwGrid['total_days'] = np.bincount(cell, weights=duration, minlength=N).astype(float)
+    mhwGrid['total_icum'] = np.bincount(cell, weights=events['intensity_cumulative'], minlength=N).astype(float)
+    for key in ['moderate_days', 'strong_days', 'severe_days', 'extreme_days']:
+        mhwGrid[key] = np.bincount(cell, weights=events[key], minlength=N).astype(float)
+    for key in mhwGrid:
+        mhwGrid[key] = mhwGrid[key].reshape(shape)
+
+    clim = {}
+    clim['thresh'] = thresh_climYear.reshape((366,) + shape)
+    clim['seas'] = seas_climYear.reshape((366,) + shape)
+    clim['missing'] = missing.reshape((T,) + shape)
+
+    # xarray Datasets with the grid coordinates of the input
+    if grid is not None:
+        mhwGrid, clim = gridDatasets(grid, mhwGrid, clim)
+
+    return mhwGrid, clim
+
+
+def detectParallel(t, temp, nWorkers=None, chunkSize=None, **options):
+    '''
+
+    Applies marineHeatWaves.detectGrid to gridded temperature in parallel: the grid cells
+    are split into chunks, which are processed by a pool of worker processes. Cells with
+    only missing values (e.g., land) are skipped.
+
+    Inputs:
+
+      t       Time vector, in datetime format (e.g., date(1982,1,1).toordinal())
+              [1D numpy array of length T]. May be None if temp is an xarray DataArray.
+      temp    Gridded temperature [numpy array or xarray DataArray of shape (T, ...), e.g.,
+              (T, lat, lon)], or the file name of such an array saved with np.save
+
+    Outputs:
+
+      mhw, clim  As output by marineHeatWaves.detectGrid
+
+    Options:
+
+      nWorkers               Number of worker processes (DEFAULT = number of CPUs)
+      chunkSize              Number of grid cells processed by a worker at once
+                             (DEFAULT = enough for 4 chunks per worker, at most 256)
+
+      Any other option is passed to marineHeatWaves.detectGrid.
+
+    Notes:
+
+      1. The workers do not receive the temperature through pickling. A numpy array or
+         DataArray is copied once (cells with values only) into shared memory, which the
+         workers read their chunks from. An array saved with np.save is memory-mapped by
+         the workers instead, so that it is never loaded as a whole.
+
+      2. The statistics of a cell do not depend on the other cells of its chunk, so the
+         results are identical to those of detectGrid on the full grid up to rounding.
+         The climatology means may differ by rounding errors, as the order in which they
+         are summed depends on the number of cells in a chunk.
+
+      3. The temperature of an alternateClimatology and a precomputedClimatology, if any,
+         are sent to the workers with each chunk.
+
+    '''
+
+    #
+    # Gridded temperature and the cells with values
+    #
+
+    grid = None
+    if hasattr(temp, 'dims'): # xarray DataArray
+        grid = temp
+        if t is None:
+            t = gridTime(grid)
+        temp = grid.values
+    fileName = temp if isinstance(temp, str) else None
+    if fileName is not None:
+        temp = np.load(fileName, mmap_mode='r')
+    t = np.asarray(t)
+    T = len(t)
+    shape = temp.shape[1:]
+    data = temp.reshape(T, -1)
+    N = data.shape[1]
+    # Cells with at least one value, in blocks of time to limit memory use
+    block = 1000
+    valid = np.zeros(N, dtype=bool)
+    for i in range(0, T, block):
+        valid = valid + (~np.isnan(data[i:i+block])).any(axis=0)
+    cells = np.where(valid)[0]
+
+    # Options for a chunk of cells, with the alternate or precomputed climatology (if any) of those cells
+    def chunkOptions(chunkCells):
+        chunk = dict(options)
+        if options.get('alternateClimatology'):
+            tClim, tempClim = options['alternateClimatology']
+            tempClim = np.reshape(tempClim, (len(tClim), -1))[:,chunkCells] if chunkCells is not None else np.NaN*np.zeros((len(tClim), 1))
+            chunk['alternateClimatology'] = [tClim, tempClim]
+        if options.get('precomputedClimatology') is not None:
+            clim = options['precomputedClimatology']
+            chunk['precomputedClimatology'] = dict(clim.attrs if hasattr(clim, 'attrs') else clim)
+            for key in ['thresh', 'seas']:
+                climYear = np.reshape(np.asarray(clim[key]), (366, -1))
+                chunk['precomputedClimatology'][key] = climYear[:,chunkCells] if chunkCells is not None else np.NaN*np.zeros((366, 1))
+        return chunk
+
+    # Outputs, initialised with those of a cell with only missing values
+    emptyGrid, emptyClim = detectGrid(t, np.NaN*np.zeros((T, 1)), **chunkOptions(None))
+    mhwGrid = {key: np.repeat(value, N) for key, value in emptyGrid.items()}
+    clim = {key: np.repeat(value, N, axis=1) for key, value in emptyClim.items()}
+
+    if nWorkers is None:
+        nWorkers = os.cpu_count()
+    if chunkSize is None:
+        chunkSize = int(min(max(np.ceil(len(cells) / (4.*nWorkers)), 1), 256))
+
+    #
+    # Detect MHWs in chunks of cells
+    #
+
+    memory = None
+    try:
+        # Temperature of the cells with values, where the workers can read it
+        if fileName is not None:
+            source = ('file', fileName, (T, N))
+            columns = cells
+        else:
+            memory = shared_memory.SharedMemory(create=True, size=max(8*T*len(cells), 1))
+            shared = np.ndarray((T, len(cells)), dtype=float, buffer=memory.buf)
+            for i in range(0, T, block):
+                shared[i:i+block] = data[i:i+block][:,cells]
+            del shared
+            source = ('memory', memory.name, (T, len(cells)))
+            columns = np.arange(len(cells))
+        chunks = [(cells[i:i+chunkSize], columns[i:i+chunkSize]) for i in range(0, len(cells), chunkSize)]
+
+        def collect(chunkCells, result):
+            mhwChunk, climChunk = result
+            for key in mhwChunk:
+                mhwGrid[key][chunkCells] = mhwChunk[key]
+            for key in climChunk:
+                clim[key][:,chunkCells] = climChunk[key]
+
+        if nWorkers == 1:
+            for chunkCells, chunkColumns in chunks:
+                collect(chunkCells, detectChunk(source, chunkColumns, t, chunkOptions(chunkCells)))
+        else:
+            with ProcessPoolExecutor(max_workers=nWorkers) as pool:
+                futures = {pool.submit(detectChunk, source, chunkColumns, t, chunkOptions(chunkCells)): chunkCells for chunkCells, chunkColumns in chunks}
+                for future in as_completed(futures):
+                    collect(futures[future], future.result())
+    finally:
+        if memory is not None:
+            memory.close()
+            memory.unlink()
+
+    for key in mhwGrid:
+        mhwGrid[key] = mhwGrid[key].reshape(shape)
+    for key in clim:
+        clim[key] = clim[key].reshape(clim[key].shape[:1] + shape)
+
+    # xarray Datasets with the grid coordinates of the input
+    if grid is not None:
+        mhwGrid, clim = gridDatasets(grid, mhwGrid, clim)
+
+    return mhwGrid, clim
+
+
+def detectChunk(source, columns, t, options):
+    '''
+
+    Worker function of marineHeatWaves.detectParallel. Reads the temperature of a chunk
+    of grid cells from shared memory or from a memory-mapped file, and applies
+    marineHeatWaves.detectGrid to it.
+
+    Inputs:
+
+      source        ('memory', name of the shared memory block, shape) or
+                    ('file', name of the file saved with np.save, shape)
+      columns       Indices of the cells of the chunk in the (T x cells) array of source
+      t             Time vector
+      options       Options of marineHeatWaves.detectGrid
+
+    Outputs:
+
+      mhw, clim     As output by marineHeatWaves.detectGrid for the chunk
+
+    '''
+    kind, name, shape = source
+    if kind == 'file':
+        temp = np.load(name, mmap_mode='r').reshape(shape)[:,columns]
+    else:
+        memory = shared_memory.SharedMemory(name=name)
+        try:
+            shared = np.ndarray(shape, dtype=float, buffer=memory.buf)
+            temp = shared[:,columns]
+            del shared
+        finally:
+            memory.close()
+
+    return detectGrid(t, temp, **options)
+
+
+def gridTime(grid):
+    '''
+    Return the time coordinate (first dimension) of an xarray
+    DataArray in datetime format (e.g., date(1982,1,1).toordinal())
+    '''
+    return grid[grid.dims[0]].values.astype('datetime64[D]').astype(np.int64) + date(1970, 1, 1).toordinal()
+
+
+def gridDatasets(grid, mhwGrid, clim):
+    '''
+    Return the outputs of marineHeatWaves.detectGrid as xarray Datasets
+    with the grid coordinates of the xarray DataArray grid
+    '''
+    import xarray as xr
+    dims = grid.dims[1:]
+    coords = {name: coord for name, coord in grid.coords.items() if set(coord.dims) <= set(dims)}
+    mhwGrid = xr.Dataset({key: (dims, value) for key, value in mhwGrid.items()}, coords=coords)
+    clim = xr.Dataset({'thresh': (('doy',) + dims, clim['thresh']),
+                       'seas': (('doy',) + dims, clim['seas']),
+                       'missing': (grid.dims, clim['missing'])},
+                      coords=dict(coords, doy=np.arange(1, 367), **{grid.dims[0]: grid[grid.dims[0]]}))
+
+    return mhwGrid, clim
+
+
+def climatology(t, temp, climatologyPeriod=[None,None], pctile=90, windowHalfWidth=5, smoothPercentile=True, smoothPercentileWidth=31, maxPadLength=False, coldSpells=False):
+    '''
+
+    Calculates the seasonally varying threshold and climatology of a temperature time series,
+    or of gridded temperature, as used by marineHeatWaves.detect for the detection of marine
+    heat waves. The climatology can be saved (marineHeatWaves.saveClimatology) and supplied
+    to detect, detectGrid or detectParallel (option precomputedClimatology), so that it is
+    not calculated again for each detection, e.g., for daily updates relative to a fixed
+    baseline period.
+
+    Inputs:
+
+      t       Time vector, in datetime format (e.g., date(1982,1,1).toordinal())
+              [1D numpy array of length T]. May be None if temp is an xarray DataArray.
+      temp    Temperature vector [1D numpy array of length T], or gridded temperature
+              [numpy array or xarray DataArray of shape (T, ...), e.g., (T, lat, lon)]
+
+    Outputs:
+
+      clim    Climatology of SST. Keys:
+
+        'thresh'               Threshold (e.g., 90th percentile) for each day-of-year
+                               [array of shape (366,) or (366, ...) for gridded temperature]
+        'seas'                 Climatological seasonal cycle for each day-of-year
+                               [as 'thresh']
+
+        and the options used for its calculation (climatologyPeriod, pctile, windowHalfWidth,
+        smoothPercentile, smoothPercentileWidth, maxPadLength and coldSpells) as numbers.
+        If temp is an xarray DataArray, clim is an xarray Dataset with the grid coordinates
+        of temp and the options as attributes.
+
+    Options:
+
+      As for marineHeatWaves.detect.
+
+    Notes:
+
+      The threshold and climatology are identical to those calculated by marineHeatWaves.detect
+      (or detectGrid, for gridded temperature) with the same options. For cold spells
+      (coldSpells = True) the threshold is the (100 - pctile)th percentile.
+
+    '''
+
+    grid = None
+    if hasattr(temp, 'dims'): # xarray DataArray
+        grid = temp
+        if t is None:
+            t = gridTime(grid)
+        temp = grid.values
+    t = np.asarray(t)
+    shape = np.shape(temp)[1:]
+    temp = np.array(temp, dtype=float)
+    if temp.ndim > 1:
+        temp = temp.reshape(len(t), -1)
+
+    # Generate vectors for year, month, day-of-month, and day-of-year
+    year, month, day, doy = dateVectors(t)
+
+    # Constant (doy value for Feb-29) for handling leap-years
+    feb29 = 60
+
+    # Set climatology period, if unset use full range of available data
+    climatologyPeriod = list(climatologyPeriod)
+    if (climatologyPeriod[0] is None) or (climatologyPeriod[1] is None):
+        climatologyPeriod[0] = year[0]
+        climatologyPeriod[1] = year[-1]
+
+    # Flip temp time series if detecting cold spells
+    if coldSpells:
+        temp = -1.*temp
+
+    # Pad missing values for all consecutive missing blocks of length <= maxPadLength
+    if maxPadLength:
+        if temp.ndim == 1:
+            temp = pad(temp, maxPadLength=maxPadLength)
+        else:
+            missing = np.isnan(temp)
+            for c in np.where(missing.any(axis=0) * ~missing.all(axis=0))[0]:
+                temp[:,c] = pad(temp[:,c], maxPadLength=maxPadLength)
+
+    # Start and end indices
+    clim_start = np.where(year == climatologyPeriod[0])[0][0]
+    clim_end = np.where(year == climatologyPeriod[1])[0][-1]
+    # Calculate threshold and seasonal climatology across years for all day-of-year values
+    thresh_climYear, seas_climYear = windowClimatology(doy, temp, clim_start, clim_end, pctile, windowHalfWidth)
+    # Special case for Feb 29
+    thresh_climYear[feb29-1] = 0.5*thresh_climYear[feb29-2] + 0.5*thresh_climYear[feb29]
+    seas_climYear[feb29-1] = 0.5*seas_climYear[feb29-2] + 0.5*seas_climYear[feb29]
+
+    # Smooth if desired
+    if smoothPercentile and temp.ndim == 1:
+        # If the climatology contains NaNs, then assume it is a <365-day year and deal accordingly
+        if np.sum(np.isnan(seas_climYear)) + np.sum(np.isnan(thresh_climYear)):
+            valid = ~np.isnan(thresh_climYear)
+            thresh_climYear[valid] = runavg(thresh_climYear[valid], smoothPercentileWidth)
+            valid = ~np.isnan(seas_climYear)
+            seas_climYear[valid] = runavg(seas_climYear[valid], smoothPercentileWidth)
+        # >= 365-day year
+        else:
+            thresh_climYear = runavg(thresh_climYear, smoothPercentileWidth)
+            seas_climYear = runavg(seas_climYear, smoothPercentileWidth)
+    elif smoothPercentile:
+        # Day-of-year values of the calendar (i.e., all but NaNs in <365-day years), in any cell
+        valid = ~np.isnan(thresh_climYear).all(axis=1) * ~np.isnan(seas_climYear).all(axis=1)
+        # Cells with other missing day-of-year values are smoothed one at a time
+        irregular = (np.isnan(thresh_climYear[valid]) + np.isnan(seas_climYear[valid])).any(axis=0)
+        irregular = irregular * ~(np.isnan(thresh_climYear).all(axis=0) + np.isnan(seas_climYear).all(axis=0))
+        for c in np.where(irregular)[0]:
+            for climYear in (thresh_climYear, seas_climYear):
+                validCell = ~np.isnan(climYear[:,c])
+                climYear[validCell,c] = runavg(climYear[validCell,c], smoothPercentileWidth)
+        regular = ~irregular
+        for climYear in (thresh_climYear, seas_climYear):
+            climYear[np.ix_(valid, regular)] = ndimage.uniform_filter1d(climYear[np.ix_(valid, regular)], smoothPercentileWidth, axis=0, mode='wrap')
+
+    # Flip climatology in case of cold spell detection
+    if coldSpells:
+        thresh_climYear = -1.*thresh_climYear
+        seas_climYear = -1.*seas_climYear
+
+    options = {}
+    options['climatologyPeriod'] = np.array(climatologyPeriod).astype(int)
+    options['pctile'] = pctile
+    options['windowHalfWidth'] = windowHalfWidth
+    options['smoothPercentile'] = int(smoothPercentile)
+    options['smoothPercentileWidth'] = smoothPercentileWidth
+    options['maxPadLength'] = int(maxPadLength)
+    options['coldSpells'] = int(coldSpells)
+
+    # xarray Dataset with the grid coordinates of the input
+    if grid is not None:
+        import xarray as xr
+        dims = grid.dims[1:]
+        coords = {name: coord for name, coord in grid.coords.items() if set(coord.dims) <= set(dims)}
+        return xr.Dataset({'thresh': (('doy',) + dims, thresh_climYear.reshape((366,) + shape)),
+                           'seas': (('doy',) + dims, seas_climYear.reshape((366,) + shape))},
+                          coords=dict(coords, doy=np.arange(1, 367)), attrs=options)
+
+    clim = {}
+    clim['thresh'] = thresh_climYear.reshape((366,) + shape)
+    clim['seas'] = seas_climYear.reshape((366,) + shape)
+    clim.update(options)
+
+    return clim
+
+
+def climatologyYear(clim, coldSpells=False):
+    '''
+
+    Returns the threshold and seasonal climatology for each day-of-year of a climatology
+    calculated with marineHeatWaves.climatology (dictionary or xarray Dataset), for the
+    detection of heat waves (coldSpells = False) or cold spells (coldSpells = True).
+    Raises a ValueError if the climatology was calculated for the other kind of event.
+
+    '''
+    options = clim.attrs if hasattr(clim, 'attrs') else clim
+    if bool(options['coldSpells']) != bool(coldSpells):
+        raise ValueError('The climatology was calculated with coldSpells = {}'.format(bool(options['coldSpells'])))
+    thresh_climYear = np.array(clim['thresh'], dtype=float)
+    seas_climYear = np.array(clim['seas'], dtype=float)
+    # Flip climatology if detecting cold spells
+    if coldSpells:
+        thresh_climYear = -1.*thresh_climYear
+        seas_climYear = -1.*seas_climYear
+
+    return thresh_climYear, seas_climYear
+
+
+def saveClimatology(clim, fileName):
+    '''
+
+    Saves a climatology calculated with marineHeatWaves.climatology, as a NetCDF file if the
+    file name ends with '.nc' (requires xarray), otherwise as a numpy .npz file.
+
+    '''
+    if fileName.endswith('.nc'):
+        import xarray as xr
+        if not isinstance(clim, xr.Dataset):
+            dims = ('doy',) + tuple('dim_{}'.format(i) for i in range(1, np.ndim(clim['thresh'])))
+            clim = xr.Dataset({'thresh': (dims, clim['thresh']), 'seas': (dims, clim['seas'])},
+                              coords={'doy': np.arange(1, 367)},
+                              attrs={key: value for key, value in clim.items() if key not in ('thresh', 'seas')})
+        clim.to_netcdf(fileName)
+    else:
+        if hasattr(clim, 'attrs'):
+            clim = dict(clim.attrs, thresh=clim['thresh'].values, seas=clim['seas'].values)
+        np.savez(fileName, **clim)
+
+
+def loadClimatology(fileName):
+    '''
+
+    Loads a climatology saved with marineHeatWaves.saveClimatology: an xarray Dataset from a
+    NetCDF file, or a dictionary from a numpy .npz file.
+
+    '''
+    if fileName.endswith('.nc'):
+        import xarray as xr
+        with xr.open_dataset(fileName) as clim:
+            return clim.load()
+    with np.load(fileName) as data:
+        return {key: data[key] if data[key].ndim else data[key].item() for key in data.files}
+
+
 def blockAverage(t, mhw, clim=None, blockLength=1, removeMissing=False, temp=None):
     '''
 
@@ -497,13 +1095,7 @@ def blockAverage(t, mhw, clim=None, blockLength=1, removeMissing=False, temp=Non
 
     # Generate vectors for year, month, day-of-month, and day-of-year
     T = len(t)
-    year = np.zeros((T))
-    month = np.zeros((T))
-    day = np.zeros((T))
-    for i in range(T):
-        year[i] = date.fromordinal(t[i]).year
-        month[i] = date.fromordinal(t[i]).month
-        day[i] = date.fromordinal(t[i]).day
+    year, month, day, doy = dateVectors(t)
 
     # Number of blocks, round up to include partial blocks at end
     years = np.unique(year)
@@ -850,6 +1442,156 @@ def rank(t, mhw):
     return rank, returnPeriod
 
 
+def dateVectors(t):
+    '''
+
+    Decomposes a time vector into vectors of year, month, day-of-month and
+    day-of-year. The day-of-year is defined relative to a leap year, i.e., it is
+    in the range 1 to 366 for all years and Mar 1 is always day 61, so that the
+    same calendar day has the same day-of-year value in all years.
+
+    Inputs:
+
+      t             Time vector, in datetime format (e.g., date(1982,1,1).toordinal())
+                    [1D numpy array of length T]
+
+    Outputs:
+
+      year          Year [1D numpy array of length T]
+      month         Month (1 to 12) [1D numpy array of length T]
+      day           Day-of-month (1 to 31) [1D numpy array of length T]
+      doy           Day-of-year (1 to 366) [1D numpy array of length T]
+
+    Notes:
+
+      The calculation uses numpy datetime64 arithmetic on the whole vector at once
+      rather than a loop over date.fromordinal.
+
+    '''
+    # Days since 1970-01-01 (the datetime64 epoch), which is ordinal day 719163
+    days = (np.asarray(t).astype(np.int64) - date(1970, 1, 1).toordinal()).astype('datetime64[D]')
+    months = days.astype('datetime64[M]')
+    year = months.astype('datetime64[Y]').astype(int) + 1970.
+    month = months.astype(int) % 12 + 1.
+    day = (days - months).astype(int) + 1.
+    # Day-of-year relative to a leap year (e.g., 2012)
+    doy = DOY_LEAPYEAR[month.astype(int)-1] + day
+
+    return year, month, day, doy
+
+
+def windowClimatology(doy, temp, start, end, pctile, windowHalfWidth):
+    '''
+
+    Calculates the threshold and seasonal climatology for each day-of-year from
+    all values within windowHalfWidth days of that day-of-year, over the years of
+    the climatology period. All day-of-year values are handled at once: the indices
+    of each occurrence of a day-of-year, and of the days in the window about it,
+    are gathered in a (day-of-year x window) matrix from which the percentiles and
+    means are calculated in batched calls.
+
+    Inputs:
+
+      doy              Day-of-year vector, as output by dateVectors [1D numpy array of length T]
+      temp             Temperature vector [1D numpy array of length T], or gridded temperature
+                       [numpy array of shape (T, ...)], e.g., (T, number of cells)
+      start, end       Indices of the first and last elements of the climatology period
+      pctile           Threshold percentile (%)
+      windowHalfWidth  Width of window (one sided) about day-of-year [days]
+
+    Outputs:
+
+      thresh_climYear  Threshold for each day-of-year [1D numpy array of length 366, or
+                       of shape (366, ...) for gridded temperature]
+      seas_climYear    Seasonal climatology for each day-of-year [as thresh_climYear]
+
+    Notes:
+
+      Feb 29 and day-of-year values which do not exist in the climatology period (e.g.,
+      in 360-day calendars) are left as NaN. The windows may extend outside the
+      climatology period, but not outside the time series. Missing values (NaNs) are
+      excluded, and the values are pooled in the same order as a loop over the window
+      would, so that the results are identical to those of such a loop. For gridded
+      temperature, the means may differ from those of the time series of each cell
+      by rounding errors, as the missing values differ between cells.
+
+    '''
+    lenClimYear = 366
+    feb29 = 60
+    T = len(temp)
+    # Indices of each occurrence of each day-of-year in the climatology period, one row per day-of-year
+    doyPeriod = doy[start:end+1].astype(int)
+    order = np.argsort(doyPeriod, kind='stable')
+    count = np.bincount(doyPeriod, minlength=lenClimYear+1)
+    occurrence = np.arange(len(order)) - np.repeat(np.cumsum(count) - count, count)
+    occurrences = -np.ones((lenClimYear+1, max(count.max(), 1)), dtype=int)
+    occurrences[doyPeriod[order], occurrence] = start + order
+    # Indices of all days in the window about each occurrence, ordered by window offset then year
+    window = np.arange(-windowHalfWidth, windowHalfWidth+1)
+    tt = (occurrences[:,None,:] + window[None,:,None]).reshape(lenClimYear+1, -1)
+    valid = np.tile(occurrences >= 0, len(window))
+    valid = valid * (tt >= 0) * (tt < T) # Reject indices "before" the first and "after" the last element
+    thresh_climYear = np.NaN*np.zeros((lenClimYear+1,) + temp.shape[1:])
+    seas_climYear = np.NaN*np.zeros((lenClimYear+1,) + temp.shape[1:])
+    # Gridded temperature: one day-of-year at a time, for all cells at once
+    if temp.ndim > 1:
+        rows = count > 0
+        rows[feb29] = False
+        for d in np.where(rows)[0]:
+            pool = temp[tt[d][valid[d]]]
+            thresh_climYear[d] = nanPercentile(pool, pctile)
+            with np.errstate(invalid='ignore'):
+                seas_climYear[d] = np.nansum(pool, axis=0) / (~np.isnan(pool)).sum(axis=0)
+        return thresh_climYear[1:], seas_climYear[1:]
+    values = temp[np.clip(tt, 0, T-1)]
+    valid = valid * ~np.isnan(values)
+    # Threshold and seasonal climatology, for the rows with the same number of values at once
+    nValues = valid.sum(axis=1)
+    rows = (count > 0) * (nValues > 0)
+    rows[feb29] = False
+    for n in np.unique(nValues[rows]):
+        d = np.where(rows * (nValues == n))[0]
+        pool = values[d][valid[d]].reshape(len(d), n)
+        thresh_climYear[d] = np.percentile(pool, pctile, axis=1)
+        seas_climYear[d] = np.mean(pool, axis=1)
+
+    return thresh_climYear[1:], seas_climYear[1:]
+
+
+def nanPercentile(values, pctile):
+    '''
+
+    Calculates the percentile of the values along the first axis, ignoring NaNs.
+    Uses the same (linear) interpolation between values as np.percentile, so that
+    each result is identical to np.percentile(nonans(column), pctile).
+
+    Inputs:
+
+      values        Values [numpy array of shape (M, ...)]
+      pctile        Percentile (%)
+
+    Outputs:
+
+      percentile    Percentile [numpy array of shape (...)], NaN where all values are NaN
+
+    '''
+    values = np.sort(values, axis=0) # NaNs are sorted to the end
+    n = (~np.isnan(values)).sum(axis=0)
+    index = (n - 1) * (pctile / 100.)
+    previous = np.floor(index)
+    gamma = index - previous
+    previous = np.clip(previous.astype(int), 0, values.shape[0]-1)
+    following = np.clip(np.minimum(previous + 1, n - 1), 0, values.shape[0]-1)
+    a = np.take_along_axis(values, previous[None], axis=0)[0]
+    b = np.take_along_axis(values, following[None], axis=0)[0]
+    # Linear interpolation, as in np.percentile
+    percentile = a + (b - a)*gamma
+    percentile = np.where(gamma >= 0.5, b - (b - a)*(1 - gamma), percentile)
+    percentile[n == 0] = np.nan
+
+    return percentile
+
+
 def runavg(ts, w):
     '''
 
@@ -2,7 +2,7 @@
 from distutils.core import setup
 
 setup(name='marineHeatWaves',
-    version='0.28',
+    version='0.33',
     author = "Eric C. J. Oliver",
     author_email = "eric.oliver@utas.edu.au",
     description = ("A set of functions which implement the Marine Heatwave definition of Hobday et al. (2016, Prog Ocean)"),
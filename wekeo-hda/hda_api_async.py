@@ -0,0 +1,506 @@
+import asyncio
+import json
+import os
+import time
+
+import aiohttp
+
+from hda_api_functions import PollingStrategy, FAILED_STATUSES, \
+                              MAX_CLIENT_ERRORS, TOKEN_REFRESH_MARGIN, \
+                              read_token_cache, write_token_cache, \
+                              get_endpoint_name, get_download_name, \
+                              is_client_error
+
+def get_session(hda_dict, pool_size=10):
+    """
+    Creates an aiohttp session with a pool of keep-alive connections and
+    stores it in the dictionary, together with the lock that serialises
+    the refreshes of the access token. Must be called from within a 
+    running event loop.
+
+    Parameters:
+        hda_dict: dictionary initied with the function
+                  hda_api_functions.init
+        pool_size: maximum number of simultaneous connections
+
+    Returns:
+        Returns the dictionary including the aiohttp session
+    """
+    connector = aiohttp.TCPConnector(limit=pool_size)
+    hda_dict['async_session'] = aiohttp.ClientSession(connector=connector)
+    hda_dict['async_token_lock'] = asyncio.Lock()
+    return hda_dict
+
+async def close_session(hda_dict):
+    """
+    Closes the aiohttp session stored in the dictionary.
+    """
+    session = hda_dict.pop('async_session', None)
+    hda_dict.pop('async_token_lock', None)
+    if session is not None:
+        await session.close()
+
+async def hda_request(hda_dict, method, url, **kwargs):
+    """
+    Sends a request to the HDA API through the aiohttp session stored in
+    the dictionary and reads the response body. Requests authorised with
+    the access token are sent with a refreshed token shortly before it
+    expires, and are repeated once with a new token on a 401.
+
+    Parameters:
+        hda_dict: dictionary initied with the function
+                  hda_api_functions.init
+        method: HTTP method, e.g. 'GET', 'POST' or 'PUT'
+        url: the request URL
+        kwargs: keyword arguments passed on to aiohttp
+
+    Returns:
+        Returns a tuple of the HTTP status code and the response text
+    """
+    if 'async_session' not in hda_dict:
+        get_session(hda_dict)
+    metrics = hda_dict.get('metrics')
+
+    async def send(**kwargs):
+        start = time.perf_counter()
+        async with hda_dict['async_session'].request(method, url, \
+                **kwargs) as response:
+            status, text = response.status, await response.text()
+        if metrics is not None:
+            metrics.record('call', method=method, \
+                           endpoint=get_endpoint_name(url), status=status, \
+                           seconds=time.perf_counter() - start)
+        return status, text
+
+    headers = kwargs.get('headers') or {}
+    bearer = headers.get('Authorization', '').startswith('Bearer')
+    if bearer:
+        kwargs['headers'] = dict(headers, **await get_headers(hda_dict))
+    status, text = await send(**kwargs)
+    if bearer and status == 401:
+        print("Access token rejected, requesting a new one")
+        kwargs['headers'] = dict(headers, **await get_headers(hda_dict, \
+                                 force=True))
+        status, text = await send(**kwargs)
+    return status, text
+
+async def get_headers(hda_dict, force=False):
+    """
+    Returns the request headers with an access token that is valid for
+    at least TOKEN_REFRESH_MARGIN seconds, refreshing the token first if
+    needed. Coroutines that need a new token at the same time wait for
+    a single refresh.
+    """
+    if 'async_session' not in hda_dict:
+        get_session(hda_dict)
+    access_token = hda_dict.get('access_token')
+    async with hda_dict['async_token_lock']:
+        # another coroutine may have refreshed the token while we waited
+        if force and hda_dict.get('access_token') != access_token:
+            force = False
+        if force or 'headers' not in hda_dict or \
+           hda_dict.get('token_expires_at', 0) - time.time() \
+           < TOKEN_REFRESH_MARGIN:
+            await get_access_token(hda_dict, force=force)
+    return hda_dict['headers']
+
+async def get_access_token(hda_dict, force=False):
+    """
+    Requests an access token to use the HDA API and stores it as separate
+    key in the dictionary. Tokens are shared with hda_api_functions 
+    through the same cache and reused while they are valid for more than
+    TOKEN_REFRESH_MARGIN seconds.
+
+    Parameters:
+        hda_dict: dictionary initied with the function
+                  hda_api_functions.init
+        force: request a new token even if a cached one is still valid
+
+    Returns:
+        Returns the dictionary including the access token
+    """
+    token = None if force else read_token_cache(hda_dict)
+    if token is None or \
+       token['expires_at'] - time.time() < TOKEN_REFRESH_MARGIN:
+        headers = {
+            'Authorization': 'Basic ' + hda_dict['api_key']
+        }
+        print("Getting an access token. This token is valid for one hour only.")
+        status, text = await hda_request(hda_dict, 'GET', \
+                       hda_dict['accessToken_address'], headers=headers, \
+                       ssl=False)
+
+        if (status == hda_dict["CONST_HTTP_SUCCESS_CODE"]):
+            parsedResponse = json.loads(text)
+            expires_in = parsedResponse.get('expires_in', 3600)
+            print("Success: Access token received, valid for {} seconds"\
+                  .format(expires_in))
+        else:
+            print("Error: Unexpected response {}".format(status))
+            return hda_dict
+        token = {'access_token': parsedResponse['access_token'],
+                 'expires_at': time.time() + expires_in}
+        write_token_cache(hda_dict, token)
+
+    hda_dict['access_token'] = token['access_token']
+    hda_dict['token_expires_at'] = token['expires_at']
+    hda_dict['headers'] = {'Authorization': 'Bearer ' + \
+                  hda_dict["access_token"], 'Accept': 'application/json'}
+    return hda_dict
+
+async def get_status(hda_dict, url, strategy=None):
+    """
+    Polls a job or order status URL until it is completed, has failed or
+    the deadline of the polling strategy has passed. Waiting does not
+    block the event loop.
+
+    Parameters:
+        hda_dict: dictionary initied with the function
+                  hda_api_functions.init
+        url: status URL of the job or order
+        strategy: hda_api_functions.PollingStrategy
+
+    Returns:
+        Returns the final status ("completed", a failure status or
+        "timeout")
+    """
+    if strategy is None:
+        strategy = PollingStrategy()
+    status = "not started"
+    n_messages = 0
+    n_errors = 0
+    t_start = time.monotonic()
+    while True:
+        await asyncio.sleep(strategy.delay(n_messages))
+        n_messages = n_messages+1
+        code, text = await hda_request(hda_dict, 'GET', url, \
+                     headers=hda_dict['headers'])
+        if (code == hda_dict['CONST_HTTP_SUCCESS_CODE']):
+            status = json.loads(text)['status'] or "not started"
+            print ("Query successfully submitted. Status is {}"\
+                   .format(status))
+            n_errors = 0
+        else:
+            print("Error: Unexpected response {}".format(code))
+            n_errors = n_errors + 1 if is_client_error(code) else 0
+        if n_errors >= MAX_CLIENT_ERRORS:
+            print("Error: Giving up on {} after {} client errors"\
+                  .format(url, n_errors))
+            status = "failed"
+            break
+        if status == "completed":
+            break
+        if str(status).lower() in FAILED_STATUSES:
+            print("Error: {} ended with status {}".format(url, status))
+            break
+        if strategy.expired(t_start):
+            print("Error: {} not completed after {} seconds"\
+                  .format(url, strategy.deadline))
+            status = "timeout"
+            break
+    if hda_dict.get('metrics') is not None:
+        hda_dict['metrics'].record('poll', endpoint=get_endpoint_name(url),\
+                                   url=url, status=status, checks=n_messages,\
+                                   seconds=time.monotonic() - t_start)
+    return status
+
+async def get_job_id(hda_dict, data, strategy=None):
+    """
+    Assigns a job id for the data request and waits for the job to
+    complete.
+
+    Parameters:
+        hda_dict: dictionary initied with the function
+                  hda_api_functions.init
+        data: dictionary containing the dataset description
+        strategy: hda_api_functions.PollingStrategy for the job status
+                  checks
+
+    Returns:
+        Returns the dictionary including the assigned job id.
+    """
+    status, text = await hda_request(hda_dict, 'POST', \
+                   hda_dict['broker_endpoint'] + '/datarequest', \
+                   headers=hda_dict['headers'], json=data, ssl=False)
+
+    if (status == hda_dict['CONST_HTTP_SUCCESS_CODE']):
+        job_id=json.loads(text)['jobId']
+        print ("Query successfully submitted. Job ID is " + job_id)
+    else:
+        job_id=""
+        print("Error: Unexpected response {}".format(status))
+
+    hda_dict['job_id']=job_id
+    if not job_id:
+        # there is no job to poll
+        hda_dict['job_status'] = "failed"
+        return hda_dict
+    hda_dict['job_status'] = await get_status(hda_dict, \
+                             hda_dict['broker_endpoint'] + \
+                             '/datarequest/status/' + job_id, strategy)
+    return hda_dict
+
+async def get_results_list(hda_dict, page=0, verbose=False):
+    """
+    Generates a list of filenames to be available for download
+
+    Parameters:
+        hda_dict: dictionary initied with the function
+                  hda_api_functions.init
+
+    Returns:
+        Returns the dictionary including the list of filenames to be
+        downloaded.
+    """
+    params = {'page':page}
+    status, text = await hda_request(hda_dict, 'GET', \
+                   hda_dict['broker_endpoint'] + '/datarequest/jobs/' + \
+                   hda_dict['job_id'] + '/result', \
+                   headers=hda_dict['headers'], params=params)
+    results = json.loads(text)
+    hda_dict['results']=results
+
+    if verbose:
+        print("************** Results *******************************")
+        print(json.dumps(results, indent=4, sort_keys=True))
+        print("*******************************************")
+    else:
+        for item in results['content']:
+            print(item['filename'])
+
+    return hda_dict
+
+async def place_order(hda_dict, result, strategy=None):
+    """
+    Places an order for a single entry of the results list and waits for
+    it to complete.
+
+    Returns:
+        Returns the order ID, or None if the order was not accepted or
+        did not complete.
+    """
+    data = {
+        "jobId": result.get('jobId', hda_dict['job_id']),
+        "uri": result['url']
+    }
+    status, text = await hda_request(hda_dict, 'POST', \
+                   hda_dict['broker_endpoint'] + '/dataorder', \
+                   headers=hda_dict['headers'], json=data, ssl=False)
+
+    if (status == hda_dict['CONST_HTTP_SUCCESS_CODE']):
+        order_id = json.loads(text)['orderId']
+        print ("Query successfully submitted. Order ID is " + order_id)
+    else:
+        print("Error: Unexpected response {}".format(status))
+        return None
+
+    status = await get_status(hda_dict, hda_dict['broker_endpoint'] + \
+                              '/dataorder/status/' + order_id, strategy)
+    if status != "completed":
+        return None
+    return order_id
+
+async def get_order_ids(hda_dict, n_workers=10, strategy=None):
+    """
+    Assigns each file to be downloaded a unique order ID. Orders are
+    placed and polled concurrently.
+
+    Parameters:
+        hda_dict: dictionary initied with the function
+                  hda_api_functions.init
+        n_workers: maximum number of orders in flight at once
+        strategy: hda_api_functions.PollingStrategy for the order status
+                  checks
+
+    Returns:
+        Returns the dictionary including the list of order IDs.
+    """
+    semaphore = asyncio.Semaphore(n_workers)
+
+    async def order(result):
+        async with semaphore:
+            return await place_order(hda_dict, result, strategy)
+
+    results = hda_dict['results']['content']
+    order_ids = await asyncio.gather(*[order(r) for r in results])
+
+    hda_dict['order_ids'] = [o for o in order_ids if o is not None]
+    hda_dict['order_sizes'] = [r['size'] for r, o \
+                               in zip(results, order_ids) if o is not None]
+    hda_dict['order_filenames'] = [r['filename'] for r, o \
+                                   in zip(results, order_ids) if o is not None]
+    return hda_dict
+
+async def downloadFile(hda_dict, url, directory, file_name, total_length=0,
+                       max_resumes=3, strategy=None):
+    """
+    Function to dowload a a single data file. As in 
+    hda_api_functions.downloadFile, the data is written to a 
+    file_name.part file which is renamed once the download is complete,
+    and an interrupted transfer is resumed with an HTTP Range request.
+    Connection errors and server errors (5xx) are retried after a 
+    backoff, and the access token is refreshed once if it is rejected.
+
+    Parameters:
+        hda_dict: dictionary initied with the function
+                  hda_api_functions.init
+        url: is the download url which included the unique order ID
+        directory: download directory, where data file shall be stored
+        file_name: name of the data file
+        total_length: size of the data file in bytes, if known
+        max_resumes: number of times a failed transfer is retried before
+                     giving up
+        strategy: hda_api_functions.PollingStrategy for the wait before 
+                  each retry
+
+    Returns:
+        Returns the time needed to download the data file, or None if the
+        download failed.
+    """
+    if 'async_session' not in hda_dict:
+        get_session(hda_dict)
+    if strategy is None:
+        strategy = PollingStrategy()
+    filename = os.path.join(directory,  file_name)
+    part_filename = filename + '.part'
+    print("Downloading " + filename)
+    start = time.perf_counter()
+    status = "failed"
+    n_resumes = 0
+    # force a new token only for the request right after a 401
+    force = False
+    refreshed = False
+    dl = 0
+    while True:
+        dl = 0
+        if os.path.exists(part_filename):
+            dl = os.path.getsize(part_filename)
+        headers = dict(await get_headers(hda_dict, force=force))
+        force = False
+        if dl > 0:
+            headers['Range'] = 'bytes={}-'.format(dl)
+        try:
+            async with hda_dict['async_session'].get(url, \
+                    headers=headers) as r:
+                if r.status == 401 and not refreshed:
+                    print("Access token rejected, requesting a new one")
+                    force = refreshed = True
+                    continue
+                refreshed = False
+                if r.status == 416:
+                    # nothing left to fetch if the partial file is complete
+                    if not (total_length and dl == total_length):
+                        os.remove(part_filename)
+                        raise aiohttp.ClientError(\
+                              "Requested range not satisfiable")
+                    mode = None
+                    length = total_length
+                elif r.status == 206:
+                    print("Resuming download of {} at {} bytes"\
+                          .format(file_name, dl))
+                    mode = 'ab'
+                    length = r.headers.get('Content-Range', '')\
+                             .rpartition('/')[2]
+                    length = int(length) if length.isdigit() \
+                             else total_length
+                elif r.status == 200:
+                    # no range support, restart from byte zero
+                    dl = 0
+                    mode = 'wb'
+                    length = r.content_length or total_length
+                elif r.status >= 500:
+                    raise aiohttp.ClientError(\
+                          "Unexpected response {}".format(r.status))
+                else:
+                    print("Error: Unexpected response {}".format(r.status))
+                    break
+                if mode is not None:
+                    with open(part_filename, mode) as f:
+                        async for chunk in r.content.iter_chunked(64738):
+                            dl += len(chunk)
+                            f.write(chunk)
+            if length and dl < length:
+                # keep the partial file, the next attempt resumes it
+                raise aiohttp.ClientError(\
+                      "Transfer incomplete, {} of {} bytes".format(dl, length))
+            if length and dl > length:
+                os.remove(part_filename)
+                raise aiohttp.ClientError(\
+                      "Size mismatch, {} instead of {} bytes"\
+                      .format(dl, length))
+            os.replace(part_filename, filename)
+            status = "completed"
+            break
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            n_resumes += 1
+            if n_resumes > max_resumes:
+                print("Error: Download of {} failed after {} attempts: {}"\
+                      .format(file_name, n_resumes, e))
+                break
+            print("Transfer of {} interrupted ({}), retrying"\
+                  .format(file_name, e))
+            await asyncio.sleep(strategy.delay(n_resumes - 1))
+    elapsed = time.perf_counter() - start
+    if hda_dict.get('metrics') is not None:
+        hda_dict['metrics'].record('download', file_name=file_name, \
+            status=status, bytes=dl, seconds=elapsed, \
+            attempts=n_resumes + 1, bytes_per_s=dl / elapsed if elapsed else 0)
+    return elapsed if status == "completed" else None
+
+async def download_data(hda_dict, file_extension=None, user_filename=None,
+                        n_workers=4, strategy=None):
+    """
+    Downloads for each of the order IDs the associated data file. Files
+    are downloaded concurrently. The aiohttp session is closed 
+    afterwards, also if a download raises an exception.
+
+    Parameters:
+        hda_dict: dictionary initied with the function
+                  hda_api_functions.init
+        file_extension:
+                  optional file extension to add to file
+        user_filename:
+                  user specified download name. If there are several 
+                  order IDs, their index is added to it (see 
+                  hda_api_functions.get_download_name).
+        n_workers:
+                  maximum number of simultaneous downloads
+        strategy:
+                  hda_api_functions.PollingStrategy for the wait before
+                  retrying a failed transfer
+
+    Returns:
+        hda_dict: with names/paths of downloaded files
+    """
+    semaphore = asyncio.Semaphore(n_workers)
+
+    async def download(i, order_id, file_name, size):
+        file_name = get_download_name(file_name, file_extension, \
+                    user_filename, i if len(hda_dict['order_ids']) > 1 \
+                    else None)
+        download_url = hda_dict['broker_endpoint'] + \
+                       '/dataorder/download/' + order_id
+        async with semaphore:
+            time_elapsed = await downloadFile(hda_dict, download_url, \
+                           hda_dict['download_dir_path'], file_name, size, \
+                           strategy=strategy)
+        if time_elapsed is None:
+            return None
+        print ("Download of {} complete in {} seconds"\
+               .format(file_name, time_elapsed))
+        return os.path.join(hda_dict['download_dir_path'], file_name)
+
+    if 'order_filenames' in hda_dict:
+        fileName = hda_dict['order_filenames']
+    else:
+        fileName = [r['filename'] for r in hda_dict['results']['content']]
+    sizes = hda_dict.get('order_sizes', [0] * len(fileName))
+    try:
+        fileNames = await asyncio.gather(*[download(i, o, f, s) for i, \
+                    (o, f, s) in enumerate(zip(hda_dict['order_ids'], \
+                    fileName, sizes))])
+    finally:
+        await close_session(hda_dict)
+
+    hda_dict['filenames'] = [f for f in fileNames if f is not None]
+    return hda_dict
@@ -0,0 +1,154 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import shutil
+import tempfile
+import time
+
+import hda_api_functions as hapi
+from hda_api_mock import MockBroker
+
+DATA = {'datasetId': 'EO:MOCK:DAT:DATASET'}
+
+def new_dict(broker, workdir):
+    """
+    Returns a dictionary initialised against the mock data broker, with
+    its own download and cache directories and metrics enabled.
+    """
+    hda_dict = hapi.init(DATA['datasetId'], 'bW9jazptb2Nr', \
+                         tempfile.mkdtemp(dir=workdir), pool_size=32, \
+                         cache_dir=tempfile.mkdtemp(dir=workdir), \
+                         broker_endpoint=broker.endpoint)
+    hda_dict = hapi.enable_metrics(hda_dict)
+    hda_dict = hapi.get_access_token(hda_dict)
+    return hda_dict
+
+def run_sequential(hda_dict, strategy, args):
+    hda_dict = hapi.get_job_id(hda_dict, DATA, strategy)
+    hda_dict = hapi.get_results_list(hda_dict, all_pages=True)
+    hda_dict = hapi.get_order_ids(hda_dict, strategy)
+    return hapi.download_data(hda_dict)
+
+def run_concurrent(hda_dict, strategy, args):
+    hda_dict = hapi.get_job_id(hda_dict, DATA, strategy)
+    hda_dict = hapi.get_results_list(hda_dict, all_pages=True)
+    return hapi.download_data_concurrent(hda_dict, \
+           n_order_workers=args.workers, n_download_workers=args.workers, \
+           strategy=strategy)
+
+def run_segmented(hda_dict, strategy, args):
+    hda_dict = hapi.get_job_id(hda_dict, DATA, strategy)
+    hda_dict = hapi.get_results_list(hda_dict, all_pages=True)
+    return hapi.download_data_concurrent(hda_dict, \
+           n_order_workers=args.workers, n_download_workers=args.workers, \
+           n_segments=args.segments, strategy=strategy)
+
+def run_async(hda_dict, strategy, args):
+    import hda_api_async as hasync
+
+    async def run():
+        await hasync.get_job_id(hda_dict, DATA, strategy)
+        content = []
+        page = 0
+        while page is not None:
+            await hasync.get_results_list(hda_dict, page)
+            content += hda_dict['results']['content']
+            page = hda_dict['results']['nextPage']
+        hda_dict['results']['content'] = content
+        await hasync.get_order_ids(hda_dict, args.workers, strategy)
+        await hasync.download_data(hda_dict, n_workers=args.workers, \
+                                   strategy=strategy)
+        await hasync.close_session(hda_dict)
+
+    asyncio.run(run())
+    return hda_dict
+
+SCENARIOS = {'sequential': run_sequential,
+             'concurrent': run_concurrent,
+             'segmented': run_segmented,
+             'async': run_async}
+
+def run_scenario(name, broker, workdir, args):
+    """
+    Runs a scenario against the mock data broker.
+
+    Returns:
+        Returns a dictionary with the wall-clock time, the number of
+        files and bytes downloaded and the metrics summary.
+    """
+    strategy = hapi.PollingStrategy(t_start=args.poll_interval, \
+                                    t_max=args.poll_interval)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output) if args.quiet \
+            else contextlib.nullcontext():
+        hda_dict = new_dict(broker, workdir)
+        start = time.perf_counter()
+        hda_dict = SCENARIOS[name](hda_dict, strategy, args)
+        elapsed = time.perf_counter() - start
+    summary = hda_dict['metrics'].summary()
+    return {'scenario': name, 'seconds': elapsed,
+            'files': len(hda_dict['filenames']),
+            'bytes': summary['downloads']['bytes'],
+            'calls': sum(c['count'] for c in summary['calls'].values()),
+            'checks': summary['polls']['checks'],
+            'metrics': summary}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the HDA '
+                                     'client against a local mock data '
+                                     'broker (see hda_api_mock).')
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS),
+                        help='any of ' + ', '.join(SCENARIOS))
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--segments', type=int, default=4)
+    parser.add_argument('--poll-interval', type=float, default=0.05)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--failure-rate', type=float, default=0)
+    parser.add_argument('--truncate-rate', type=float, default=0)
+    parser.add_argument('--n-results', type=int, default=20)
+    parser.add_argument('--page-size', type=int, default=5)
+    parser.add_argument('--file-size', type=int, default=4*1024*1024)
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='maximum rate of each download [bytes/s]')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write all results to this file')
+    parser.add_argument('--verbose', dest='quiet', action='store_false',
+                        help='show the output of the HDA client')
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario ' + name)
+
+    broker = MockBroker(latency=args.latency,
+                        failure_rate=args.failure_rate,
+                        truncate_rate=args.truncate_rate,
+                        n_results=args.n_results, page_size=args.page_size,
+                        file_size=args.file_size, bandwidth=args.bandwidth,
+                        seed=args.seed).start()
+    workdir = tempfile.mkdtemp(prefix='hda_benchmark_')
+    runs = []
+    print("%-12s %10s %6s %10s %10s %6s %7s" % ('scenario', 'seconds', \
+          'files', 'MB', 'MB/s', 'calls', 'checks'))
+    try:
+        for name in args.scenarios:
+            for i in range(args.repeat):
+                run = run_scenario(name, broker, workdir, args)
+                runs.append(run)
+                print("%-12s %10.3f %6d %10.2f %10.2f %6d %7d" % (name, \
+                      run['seconds'], run['files'], \
+                      run['bytes']/(1024*1024), \
+                      run['bytes']/(1024*1024)/run['seconds'], \
+                      run['calls'], run['checks']))
+    finally:
+        broker.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(runs, f, indent=4)
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,54 @@
-import requests, re, json
+import re, json
 import base64
-import shutil
+import hashlib
+import importlib
 import time, os
-import urllib.parse
+import random
+import fnmatch
+import threading
+import contextlib
+import functools
+import io
+import mmap
+import shutil, tempfile, zipfile
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class LazyModule:
+    """ 
+    Stands in for a module that is only imported when one of its 
+    attributes is first used, so that importing hda_api_functions does
+    not load the HTTP stack (requests, urllib3, certifi) until the first
+    request is made.
+    
+    Parameters:
+        name: name of the module, e.g. 'requests'
+    """
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+requests = LazyModule('requests')
+
+# Refresh access tokens this many seconds before they expire
+TOKEN_REFRESH_MARGIN = 300
+
+# Time [s] for which query metadata and the accepted Terms and 
+# Conditions are reused from the cache directory
+METADATA_CACHE_TTL = 7 * 24 * 3600
+
+# Access tokens shared by all dictionaries of this process, keyed by 
+# api key and broker
+_token_cache = {}
+_token_lock = threading.Lock()
 
 def generate_api_key(username, password):
     """ 
@@ -19,7 +65,213 @@ def generate_api_key(username, password):
     s = username+':'+password
     return (base64.b64encode(str.encode(s), altchars=None)).decode()
 
-def init(dataset_id, api_key, download_dir_path):
+def get_session(pool_size=10, max_retries=3, backoff_factor=0.5):
+    """ 
+    Creates a pooled HTTP session that keeps connections to the data 
+    broker alive between requests, so that status polls and orders do 
+    not pay for a new TCP+TLS handshake each time.
+    
+    Parameters:
+        pool_size: maximum number of connections kept open per host
+        max_retries: number of retries for failed connections and 
+                     transient server errors (429, 5xx). POST requests
+                     are not retried, so orders are never placed twice.
+        backoff_factor: factor for the exponential wait between retries
+    
+    Returns:
+        Returns a requests.Session with the retry adapters mounted
+    """
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    retries = Retry(total=max_retries, backoff_factor=backoff_factor,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, 
+                          pool_maxsize=pool_size, max_retries=retries)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def hda_request(hda_dict, method, url, **kwargs):
+    """ 
+    Sends a request to the HDA API through the pooled session stored in
+    the dictionary. All calls to the data broker go through this 
+    function. Requests authorised with the access token are sent with a
+    token that is refreshed shortly before it expires, and are repeated
+    once with a new token if the data broker answers 401.
+    
+    Parameters:
+        hda_dict: dictionary initied with the function init, that stores 
+                  all required information to be able to interact with 
+                  the HDA API
+        method: HTTP method, e.g. 'GET', 'POST' or 'PUT'
+        url: the request URL
+        kwargs: keyword arguments passed on to requests
+    
+    Returns:
+        Returns the response of the request
+    """
+    if 'session' not in hda_dict:
+        hda_dict['session'] = get_session()
+    metrics = hda_dict.get('metrics')
+
+    def send(**kwargs):
+        start = time.perf_counter()
+        response = hda_dict['session'].request(method, url, **kwargs)
+        if metrics is not None:
+            metrics.record('call', method=method, \
+                           endpoint=get_endpoint_name(url), \
+                           status=response.status_code, \
+                           seconds=time.perf_counter() - start)
+        return response
+
+    headers = kwargs.get('headers') or {}
+    if not headers.get('Authorization', '').startswith('Bearer'):
+        return send(**kwargs)
+
+    kwargs['headers'] = dict(headers, **get_headers(hda_dict))
+    response = send(**kwargs)
+    if response.status_code == 401:
+        print("Access token rejected, requesting a new one")
+        rejected = kwargs['headers']['Authorization'][len('Bearer '):]
+        kwargs['headers'] = dict(headers, **get_headers(hda_dict, \
+                                 force=True, rejected=rejected))
+        response = send(**kwargs)
+    return response
+
+def get_endpoint_name(url):
+    """ 
+    Returns the HDA API endpoint of a request URL without the job, 
+    order or dataset IDs in it, e.g. 'datarequest/status'.
+    """
+    from urllib.parse import urlparse
+    path = urlparse(url).path
+    return '/'.join(p for p in path.split('/') \
+                    if re.fullmatch('[a-z]+', p) and p != 'databroker')
+
+def summarize_timings(seconds):
+    """ 
+    Returns the count, total, mean and maximum of a list of durations.
+    """
+    return {'count': len(seconds), 'total_s': sum(seconds),
+            'mean_s': sum(seconds) / len(seconds) if seconds else 0,
+            'max_s': max(seconds, default=0)}
+
+class Metrics:
+    """ 
+    Collects wall-clock timings of the calls to the data broker, the 
+    throughput of the downloads, the number of status checks per job or
+    order and the time work waits in the queues of the worker pools.
+    Each event is passed to the callbacks as a dictionary, e.g. to 
+    forward it to a monitoring system, and summary aggregates all 
+    events. Enabled with enable_metrics.
+    
+    Parameters:
+        callbacks: functions called with each event. The 'kind' of an
+                   event is 'call', 'download', 'poll' or 'queue_wait'.
+    """
+    def __init__(self, callbacks=()):
+        self.callbacks = list(callbacks)
+        self.events = []
+        self.lock = threading.Lock()
+
+    def add_callback(self, callback):
+        """
+        Adds a function that is called with each new event.
+        """
+        self.callbacks.append(callback)
+
+    def record(self, kind, **event):
+        """
+        Records an event and passes it to the callbacks.
+        """
+        event = dict(event, kind=kind, time=time.time())
+        with self.lock:
+            self.events.append(event)
+        for callback in self.callbacks:
+            try:
+                callback(event)
+            except Exception as e:
+                print("Error: Metrics callback failed: {}".format(e))
+
+    def summary(self):
+        """
+        Aggregates the recorded events.
+
+        Returns:
+            Returns a dictionary that can be serialised to JSON, with 
+            the latency of each API endpoint, the bytes/s of each 
+            download and overall, the number of checks per status poll
+            and the waits in each worker queue.
+        """
+        with self.lock:
+            events = list(self.events)
+        calls = {}
+        for e in [e for e in events if e['kind'] == 'call']:
+            calls.setdefault(e['method'] + ' ' + e['endpoint'], [])\
+                 .append(e)
+        downloads = [e for e in events if e['kind'] == 'download']
+        completed = [e for e in downloads if e['status'] == "completed"]
+        polls = [e for e in events if e['kind'] == 'poll']
+        queues = {}
+        for e in [e for e in events if e['kind'] == 'queue_wait']:
+            queues.setdefault(e['queue'], []).append(e['seconds'])
+
+        n_bytes = sum(e['bytes'] for e in completed)
+        seconds = sum(e['seconds'] for e in completed)
+        return {
+            'calls': {name: dict(summarize_timings(\
+                      [e['seconds'] for e in c]), errors=len(\
+                      [e for e in c if e['status'] >= 400])) \
+                      for name, c in calls.items()},
+            'downloads': {'count': len(completed),
+                          'failed': len(downloads) - len(completed),
+                          'bytes': n_bytes, 'seconds': seconds,
+                          'bytes_per_s': n_bytes / seconds \
+                                         if seconds else 0,
+                          'files': [{k: e[k] for k in ('file_name', \
+                                    'status', 'bytes', 'seconds', \
+                                    'bytes_per_s', 'attempts')} \
+                                    for e in downloads]},
+            'polls': {'count': len(polls),
+                      'checks': sum(e['checks'] for e in polls),
+                      'max_checks': max([e['checks'] for e in polls], \
+                                        default=0),
+                      'statuses': {status: len([e for e in polls \
+                                   if e['status'] == status]) for status \
+                                   in set(e['status'] for e in polls)}},
+            'queue_waits': {queue: summarize_timings(waits) \
+                            for queue, waits in queues.items()}
+        }
+
+    def export(self, filename):
+        """
+        Writes the summary to a JSON file.
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=4)
+
+def enable_metrics(hda_dict, callbacks=()):
+    """ 
+    Turns on the collection of metrics (see Metrics) for all requests
+    and downloads made with the dictionary.
+    
+    Parameters:
+        hda_dict: dictionary initied with the function init, that 
+                  stores all required information to be able to 
+                  interact with the HDA API
+        callbacks: functions called with each recorded event
+        
+    Returns:
+        Returns the dictionary including the Metrics object, whose
+        summary and export methods give the aggregated metrics
+    """
+    hda_dict['metrics'] = Metrics(callbacks)
+    return hda_dict
+
+def init(dataset_id, api_key, download_dir_path, pool_size=10, 
+         max_retries=3, cache_dir=None, broker_endpoint=None):
     """ 
     Initiates a dictionary with keys needed to use the HDA API.
     
@@ -28,14 +280,23 @@ def init(dataset_id, api_key, download_dir_path):
         api_key: Base64-encoded string
         download_dir_path: directory path where data shall be downloaded 
                            to
+        pool_size: number of keep-alive connections held open to the 
+                   data broker
+        max_retries: number of retries on transient connection errors
+        cache_dir: directory for data cached between runs, e.g. the 
+                   access token. Defaults to ~/.cache/wekeo-hda
+        broker_endpoint: address of the data broker, e.g. of a local 
+                   hda_api_mock server. Defaults to the WEkEO broker.
     
     Returns:
         Returns the initiated dictionary.
     """
     hda_dict = {}
     # Data broker address
-    hda_dict["broker_endpoint"] = \
-      "https://wekeo-broker.apps.mercator.dpi.wekeo.eu/databroker"
+    if broker_endpoint is None:
+        broker_endpoint = \
+          "https://wekeo-broker.apps.mercator.dpi.wekeo.eu/databroker"
+    hda_dict["broker_endpoint"] = broker_endpoint
     # Terms and conditions
     hda_dict["acceptTandC_address"]\
             = hda_dict["broker_endpoint"]\
@@ -51,91 +312,292 @@ def init(dataset_id, api_key, download_dir_path):
     # set HTTP success code
     hda_dict["CONST_HTTP_SUCCESS_CODE"] = 200
 
+    # pooled HTTP session shared by all requests to the data broker
+    hda_dict["session"] = get_session(pool_size, max_retries)
+
     # download directory
     hda_dict["download_dir_path"] = download_dir_path
     if not os.path.exists(download_dir_path):
         os.makedirs(download_dir_path)
 
+    # cache directory
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.expanduser('~'), '.cache', \
+                                 'wekeo-hda')
+    hda_dict["cache_dir"] = cache_dir
+    os.makedirs(cache_dir, exist_ok=True)
+
     return hda_dict
 
-def get_access_token(hda_dict):
+def get_token_cache_file(hda_dict):
+    """ 
+    Returns the path of the file in which the access token for the api
+    key and broker of the dictionary is cached.
+    """
+    key = hashlib.sha256((hda_dict['api_key'] + \
+          hda_dict['broker_endpoint']).encode()).hexdigest()[:16]
+    return os.path.join(hda_dict['cache_dir'], 'token_' + key + '.json')
+
+def read_token_cache(hda_dict):
+    """ 
+    Looks up a cached access token for the api key, first in memory and
+    then on disk, so that tokens are shared between dictionaries and 
+    processes.
+    
+    Returns:
+        Returns a dictionary with the keys 'access_token' and 
+        'expires_at' (seconds since the epoch), or None if no token is
+        cached.
+    """
+    cache_file = get_token_cache_file(hda_dict)
+    token = _token_cache.get(cache_file)
+    if token is None and os.path.isfile(cache_file):
+        try:
+            with open(cache_file) as f:
+                token = json.load(f)
+        except (OSError, ValueError):
+            token = None
+    return token
+
+def write_token_cache(hda_dict, token):
+    """ 
+    Stores an access token in memory and on disk. The file is only 
+    readable by the user.
+    """
+    cache_file = get_token_cache_file(hda_dict)
+    _token_cache[cache_file] = token
+    tmp_file = cache_file + '.{}.tmp'.format(os.getpid())
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(token, f)
+    os.replace(tmp_file, cache_file)
+
+def get_access_token(hda_dict, force=False, rejected=None):
     """ 
     Requests an access token to use the HDA API and stores it as separate
-    key in the dictionary
+    key in the dictionary. A cached token is reused as long as it is 
+    valid for more than TOKEN_REFRESH_MARGIN seconds.
     
     Parameters:
         hda_dict: dictionary initied with the function init, that stores 
         all required information to be able to interact with the HDA API.
+        force: request a new token even if a cached one is still valid
+        rejected: the token the data broker answered 401 to. If another
+                  thread has already replaced it, the new token is used
+                  instead of forcing a further refresh.
     
     Returns:
         Returns the dictionary including the access token
     """
+    with _token_lock:
+        token = read_token_cache(hda_dict)
+        if force and (rejected is None or token is None or \
+                      token['access_token'] == rejected):
+            token = None
+        if token is None or \
+           token['expires_at'] - time.time() < TOKEN_REFRESH_MARGIN:
+            token = request_access_token(hda_dict)
+            if token is None:
+                return hda_dict
+            write_token_cache(hda_dict, token)
+
+    hda_dict['access_token'] = token['access_token']
+    hda_dict['token_expires_at'] = token['expires_at']
+    hda_dict['headers'] = {'Authorization': 'Bearer ' + \
+                  hda_dict["access_token"], 'Accept': 'application/json'}
+    return hda_dict
+
+def request_access_token(hda_dict):
+    """ 
+    Requests a new access token from the data broker.
+    
+    Parameters:
+        hda_dict: dictionary initied with the function init, that stores 
+        all required information to be able to interact with the HDA API.
+    
+    Returns:
+        Returns a dictionary with the keys 'access_token' and 
+        'expires_at', or None if the request failed.
+    """
     headers = { 
         'Authorization': 'Basic ' + hda_dict['api_key'] 
     }
-    data = [
-        ('grant_type', 'client_credentials'),
-    ]
     print("Getting an access token. This token is valid for one hour only.") 
-    response = requests.get(hda_dict['accessToken_address'], \
+    response = hda_request(hda_dict, 'GET', hda_dict['accessToken_address'], \
                headers=headers, verify=False)
 
     # If the HTTP response code is 200 (i.e. success), then retrive the 
     # token from the response
     if (response.status_code == hda_dict["CONST_HTTP_SUCCESS_CODE"]):
-        access_token = json.loads(response.text)['access_token']
-        
-        print("Success: Access token is " + access_token)
+        parsedResponse = json.loads(response.text)
+        expires_in = parsedResponse.get('expires_in', 3600)
+        print("Success: Access token received, valid for {} seconds"\
+              .format(expires_in))
+        return {'access_token': parsedResponse['access_token'],
+                'expires_at': time.time() + expires_in}
     else:
         print("Error: Unexpected response {}".format(response))
         print(response.headers)
+        return None
+
+def get_headers(hda_dict, force=False, rejected=None):
+    """ 
+    Returns the request headers with an access token that is valid for 
+    at least TOKEN_REFRESH_MARGIN seconds, refreshing the token first if
+    needed.
     
-    hda_dict['access_token'] = access_token
-    hda_dict['headers'] = {'Authorization': 'Bearer ' + \
-                  hda_dict["access_token"], 'Accept': 'application/json'}
-    return hda_dict
+    Parameters:
+        hda_dict: dictionary initied with the function init, that stores 
+        all required information to be able to interact with the HDA API.
+        force: request a new token even if the current one is still valid
+        rejected: the token the data broker answered 401 to, so that 
+                  threads rejected at the same time refresh it only once
+                  (see get_access_token)
+    
+    Returns:
+        Returns the headers dictionary
+    """
+    if force or 'headers' not in hda_dict or \
+       hda_dict.get('token_expires_at', 0) - time.time() \
+       < TOKEN_REFRESH_MARGIN:
+        get_access_token(hda_dict, force=force, rejected=rejected)
+    return hda_dict['headers']
+
+def get_cache_file(hda_dict, kind, key):
+    """ 
+    Returns the path of the cache file for an entry of the given kind 
+    (e.g. 'metadata') and key (e.g. the dataset id).
+    """
+    key = re.sub(r'[^A-Za-z0-9_.-]', '_', key)
+    return os.path.join(hda_dict['cache_dir'], kind + '_' + key + '.json')
+
+def read_cache(hda_dict, kind, key, ttl=METADATA_CACHE_TTL):
+    """ 
+    Reads an entry from the cache directory.
+    
+    Parameters:
+        hda_dict: dictionary initied with the function init, that stores 
+                  all required information to be able to interact with 
+                  the HDA API
+        kind: kind of the cached entry, e.g. 'metadata' or 'tandc'
+        key: key of the entry, e.g. the dataset id
+        ttl: maximum age of the entry [s]
+    
+    Returns:
+        Returns the cached value, or None if there is no entry or it is
+        older than ttl.
+    """
+    cache_file = get_cache_file(hda_dict, kind, key)
+    try:
+        with open(cache_file) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - entry['time'] > ttl:
+        return None
+    return entry['value']
+
+def write_cache(hda_dict, kind, key, value):
+    """ 
+    Writes an entry to the cache directory, see read_cache.
+    """
+    cache_file = get_cache_file(hda_dict, kind, key)
+    tmp_file = cache_file + '.{}.tmp'.format(os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump({'time': time.time(), 'value': value}, f)
+    os.replace(tmp_file, cache_file)
+
+def get_metadata_cache_key(hda_dict, dataset_id):
+    """ 
+    Returns the cache key of the query metadata of a dataset, which 
+    includes the data broker endpoint so that brokers never share 
+    entries.
+    """
+    return dataset_id + '_' + hashlib.sha256(\
+           hda_dict['broker_endpoint'].encode()).hexdigest()[:16]
+
+def invalidate_cache(hda_dict, dataset_id=None):
+    """ 
+    Removes cached query metadata and Terms and Conditions state, so 
+    that they are requested again from the data broker.
+    
+    Parameters:
+        hda_dict: dictionary initied with the function init, that stores 
+                  all required information to be able to interact with 
+                  the HDA API
+        dataset_id: only remove the metadata of this dataset. By default
+                    all metadata and the Terms and Conditions state are
+                    removed.
+    """
+    if dataset_id is not None:
+        cache_files = [get_cache_file(hda_dict, 'metadata', \
+                       get_metadata_cache_key(hda_dict, dataset_id))]
+    else:
+        cache_files = [os.path.join(hda_dict['cache_dir'], f) \
+                       for f in os.listdir(hda_dict['cache_dir']) \
+                       if f.startswith(('metadata_', 'tandc_'))]
+    for cache_file in cache_files:
+        if os.path.isfile(cache_file):
+            os.remove(cache_file)
 
-def query_metadata(hda_dict):
+def query_metadata(hda_dict, use_cache=True, ttl=METADATA_CACHE_TTL):
     """ 
     Requests metadata for the given dataset id and stores the response 
-    of the request in the dictionary.
+    of the request in the dictionary. The response is cached per dataset
+    id and data broker and reused for ttl seconds.
     
     Parameters:
         hda_dict: dictionary initied with the function init, that stores 
         all required information to be able to interact with the HDA API
+        use_cache: reuse cached metadata if available
+        ttl: maximum age of cached metadata [s]
     
     Returns:
         Returns the dictionary including the query response
     """
-    response = requests.get(hda_dict['broker_endpoint'] + \
-               '/querymetadata/' + hda_dict['dataset_id'], \
-               headers=hda_dict['headers'])
+    parsedResponse = None
+    key = get_metadata_cache_key(hda_dict, hda_dict['dataset_id'])
+    if use_cache:
+        parsedResponse = read_cache(hda_dict, 'metadata', key, ttl)
 
-    print('Getting query metadata, URL Is ' + hda_dict['broker_endpoint']\
-          + '/querymetadata/' + hda_dict['dataset_id'] \
-          + "?access_token=" + hda_dict['access_token'])
-    print("************** Query Metadata for " + hda_dict['dataset_id']\
-          +" **************") 
+    if parsedResponse is None:
+        response = hda_request(hda_dict, 'GET', hda_dict['broker_endpoint'] + \
+                   '/querymetadata/' + hda_dict['dataset_id'], \
+                   headers=hda_dict['headers'])
 
-    if (response.status_code == hda_dict['CONST_HTTP_SUCCESS_CODE']):
-        parsedResponse = json.loads(response.text)
-        print(json.dumps(parsedResponse, indent=4, sort_keys=True))
-        print("**************************************************")
+        print('Getting query metadata, URL Is ' + hda_dict['broker_endpoint']\
+              + '/querymetadata/' + hda_dict['dataset_id'])
+
+        if (response.status_code == hda_dict['CONST_HTTP_SUCCESS_CODE']):
+            parsedResponse = json.loads(response.text)
+            write_cache(hda_dict, 'metadata', key, parsedResponse)
+        else:
+            print("Error: Unexpected response {}".format(response))
+            return hda_dict
     else:
-        print("Error: Unexpected response {}".format(response))
+        print('Using cached query metadata')
+
+    print("************** Query Metadata for " + hda_dict['dataset_id']\
+          +" **************") 
+    print(json.dumps(parsedResponse, indent=4, sort_keys=True))
+    print("**************************************************")
     
     hda_dict['parsedResponse']=parsedResponse
     return hda_dict
 
-def acceptTandC(hda_dict):
+def acceptTandC(hda_dict, use_cache=True, ttl=METADATA_CACHE_TTL):
     """ 
     Checks if the Terms and Conditions have been accepted and it not, 
-    they will be accepted. The response is stored in the dictionary
+    they will be accepted. The response is stored in the dictionary.
+    Once accepted, the acceptance is cached per api key and not checked
+    again for ttl seconds.
     
     Parameters:
         hda_dict: dictionary initied with the function init, that stores 
                   all required information to be able to interact with 
                   the HDA API
+        use_cache: reuse a cached acceptance if available
+        ttl: maximum age of a cached acceptance [s]
     
     Returns:
         Returns the dictionary including the response from the Terms and 
@@ -144,24 +606,34 @@ def acceptTandC(hda_dict):
     
     msg1="Accepting Terms and Conditions of Copernicus_General_License"
     msg2="Copernicus_General_License Terms and Conditions already accepted"
-    response = requests.get(hda_dict['acceptTandC_address'], \
+    key = hashlib.sha256((hda_dict['api_key'] + \
+          hda_dict['acceptTandC_address']).encode()).hexdigest()[:16]
+    if use_cache and read_cache(hda_dict, 'tandc', key, ttl):
+        print(msg2)
+        hda_dict['isTandCAccepted']=True
+        return hda_dict
+
+    response = hda_request(hda_dict, 'GET', hda_dict['acceptTandC_address'], \
                             headers=hda_dict['headers'])
 
     isTandCAccepted = json.loads(response.text)['accepted']
 
     if isTandCAccepted is False:
         print(msg1)
-        response = requests.put(hda_dict['acceptTandC_address'],\
-                                headers=hda_dict['headers'])
+        response = hda_request(hda_dict, 'PUT', \
+                               hda_dict['acceptTandC_address'],\
+                               headers=hda_dict['headers'])
     else:
         print(msg2)
     isTandCAccepted = json.loads(response.text)['accepted']
+    if isTandCAccepted is True:
+        write_cache(hda_dict, 'tandc', key, True)
     hda_dict['isTandCAccepted']=isTandCAccepted
     return hda_dict
 
-def get_job_id(hda_dict, data):
+def submit_job(hda_dict, data):
     """ 
-    Assigns a job id for the data request.
+    Submits the data request without waiting for the job to complete.
     
     Parameters:
         hda_dict: dictionary initied with the function init, 
@@ -170,9 +642,10 @@ def get_job_id(hda_dict, data):
         data: dictionary containing the dataset description
 
     Returns:
-        Returns the dictionary including the assigned job id.
+        Returns the dictionary including the assigned job id, or an 
+        empty job id if the request was not accepted.
     """
-    response = requests.post(hda_dict['broker_endpoint'] +\
+    response = hda_request(hda_dict, 'POST', hda_dict['broker_endpoint'] +\
                '/datarequest', headers=hda_dict['headers'],\
                json=data, verify=False)
 
@@ -184,58 +657,338 @@ def get_job_id(hda_dict, data):
         print("Error: Unexpected response {}".format(response))
     
     hda_dict['job_id']=job_id
-    get_request_status(hda_dict)
+    return hda_dict
+
+def get_job_id(hda_dict, data, strategy=None):
+    """ 
+    Assigns a job id for the data request.
+    
+    Parameters:
+        hda_dict: dictionary initied with the function init, 
+                  that stores all required information to be able to 
+                  interact with the HDA API
+        data: dictionary containing the dataset description
+        strategy: PollingStrategy for the job status checks
+
+    Returns:
+        Returns the dictionary including the assigned job id.
+    """
+    hda_dict = submit_job(hda_dict, data)
+    if not hda_dict['job_id']:
+        # there is no job to poll
+        hda_dict['job_status']="failed"
+        return hda_dict
+    hda_dict['job_status']=get_request_status(hda_dict, strategy=strategy)
     return hda_dict
 
 def report_timing_control(t_step=5, t_max=60):
     """
-    Controls report timing
+    Controls report timing: waits t_step seconds, at most t_max
     """
     t_wait = min(t_step, t_max)
-    print('Next check in {} seconds'.format(t_wait))
+    print('Next check in {:.1f} seconds'.format(t_wait))
     time.sleep(t_wait)
 
-def get_request_status(hda_dict, t_step=5, t_max=60):
+# Statuses after which a job or order will never complete
+FAILED_STATUSES = ('failed', 'error', 'cancelled', 'canceled')
+
+# Number of client errors (4xx, e.g. 404 for an unknown job ID) in a row
+# after which a job or order is given up
+MAX_CLIENT_ERRORS = 3
+
+def is_client_error(status_code):
     """ 
-    Requests the status of the process to assign a job ID.
+    Returns True for an HTTP status code that repeating the request will
+    not change, i.e. a 4xx code other than 408 (timeout) and 429 (too 
+    many requests).
+    """
+    return 400 <= status_code < 500 and status_code not in (408, 429)
+
+class PollingStrategy:
+    """ 
+    Timing of the status checks for jobs and orders. The wait between
+    checks grows exponentially from t_start up to t_max, with a random
+    jitter so that many pollers do not hit the data broker in lockstep.
+    
+    Parameters:
+        t_start: wait before the first check [s]
+        t_max: maximum wait between two checks [s]
+        factor: growth factor of the wait after each check
+        jitter: relative random variation of each wait, e.g. 0.1 for 
+                +/- 10%
+        deadline: overall time after which polling gives up [s], None
+                  to poll until a final status is reached
+    """
+    def __init__(self, t_start=1, t_max=60, factor=2, jitter=0.1,
+                 deadline=None):
+        self.t_start = t_start
+        self.t_max = t_max
+        self.factor = factor
+        self.jitter = jitter
+        self.deadline = deadline
+
+    def delay(self, n_checks):
+        """
+        Returns the wait [s] before the next check, after n_checks 
+        checks have been made.
+        """
+        # the exponent is capped, the wait reached t_max long before
+        t_wait = min(self.t_start * self.factor**min(n_checks, 64), \
+                     self.t_max)
+        return t_wait * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def expired(self, t_start):
+        """
+        Returns True if the deadline, counted from t_start 
+        (time.monotonic), has passed.
+        """
+        return self.deadline is not None and \
+               time.monotonic() - t_start > self.deadline
+
+def poll_status(hda_dict, url, strategy=None):
+    """ 
+    Checks the status of a job or order until it is completed, has 
+    failed or the deadline of the polling strategy has passed.
     
     Parameters:
         hda_dict: dictionary initied with the function init, that 
                   stores all required information to be able to 
                   interact with the HDA API
+        url: status URL of the job or order
+        strategy: PollingStrategy, defaults to PollingStrategy()
+
+    Returns:
+        Returns a tuple of the final status ("completed", a failure 
+        status or "timeout") and the response of the last check. The 
+        status is "failed" after MAX_CLIENT_ERRORS client errors in a 
+        row, e.g. for an unknown ID.
     """
+    if strategy is None:
+        strategy = PollingStrategy()
     status = "not started"
+    response = None
     n_messages = 0
-    while (status != "completed"):
+    n_errors = 0
+    t_start = time.monotonic()
+    while True:
+        report_timing_control(strategy.delay(n_messages), strategy.t_max)
         n_messages = n_messages+1
-        report_timing_control(t_step*n_messages, t_max)
-        response = requests.get(hda_dict['broker_endpoint'] + \
-                   '/datarequest/status/' + hda_dict['job_id'],\
-                   headers=hda_dict['headers'])
+        response = hda_request(hda_dict, 'GET', url, \
+                               headers=hda_dict['headers'])
         if (response.status_code == hda_dict['CONST_HTTP_SUCCESS_CODE']):
-            status = json.loads(response.text)['status']
-            print ("Query successfully submitted. Status is " + status)
+            status = json.loads(response.text)['status'] or "not started"
+            print ("Query successfully submitted. Status is {}"\
+                   .format(status))
+            n_errors = 0
         else:
             print("Error: Unexpected response {}".format(response))
+            n_errors = n_errors + 1 \
+                       if is_client_error(response.status_code) else 0
+        if n_errors >= MAX_CLIENT_ERRORS:
+            print("Error: Giving up on {} after {} client errors"\
+                  .format(url, n_errors))
+            status = "failed"
+            break
+        if status == "completed":
+            break
+        if str(status).lower() in FAILED_STATUSES:
+            print("Error: {} ended with status {}".format(url, status))
+            break
+        if strategy.expired(t_start):
+            print("Error: {} not completed after {} seconds"\
+                  .format(url, strategy.deadline))
+            status = "timeout"
+            break
+    if hda_dict.get('metrics') is not None:
+        hda_dict['metrics'].record('poll', endpoint=get_endpoint_name(url),\
+                                   url=url, status=status, checks=n_messages,\
+                                   seconds=time.monotonic() - t_start)
+    return status, response
 
-def get_results_list(hda_dict, page=0, verbose=False):
+def poll_many(hda_dict, job_ids=(), order_ids=(), strategy=None):
     """ 
-    Generates a list of filenames to be available for download
+    Checks the status of many jobs and orders in a single loop. Each 
+    ID follows its own backoff schedule, and the loop sleeps until the 
+    next ID is due.
+    
+    Parameters:
+        hda_dict: dictionary initied with the function init, that 
+                  stores all required information to be able to 
+                  interact with the HDA API
+        job_ids: job IDs as returned by get_job_id
+        order_ids: order IDs as returned by place_order
+        strategy: PollingStrategy, defaults to PollingStrategy()
+
+    Returns:
+        Returns a dictionary with the final status of each ID 
+        ("completed", a failure status or "timeout").
+    """
+    if strategy is None:
+        strategy = PollingStrategy()
+    urls = {}
+    for job_id in job_ids:
+        urls[job_id] = hda_dict['broker_endpoint'] + \
+                       '/datarequest/status/' + job_id
+    for order_id in order_ids:
+        urls[order_id] = hda_dict['broker_endpoint'] + \
+                         '/dataorder/status/' + order_id
+
+    t_start = time.monotonic()
+    n_checks = dict.fromkeys(urls, 0)
+    n_errors = dict.fromkeys(urls, 0)
+    next_check = {key: t_start + strategy.delay(0) for key in urls}
+    statuses = {}
+    while next_check:
+        key = min(next_check, key=next_check.get)
+        time.sleep(max(0, next_check[key] - time.monotonic()))
+        response = hda_request(hda_dict, 'GET', urls[key], \
+                               headers=hda_dict['headers'])
+        n_checks[key] += 1
+        status = "not started"
+        if (response.status_code == hda_dict['CONST_HTTP_SUCCESS_CODE']):
+            status = json.loads(response.text)['status'] or "not started"
+            n_errors[key] = 0
+        else:
+            print("Error: Unexpected response {}".format(response))
+            n_errors[key] = n_errors[key] + 1 \
+                            if is_client_error(response.status_code) else 0
+            if n_errors[key] >= MAX_CLIENT_ERRORS:
+                print("Error: Giving up on {} after {} client errors"\
+                      .format(urls[key], n_errors[key]))
+                status = "failed"
+        if status == "completed" or str(status).lower() in FAILED_STATUSES:
+            print("Status of {} is {}".format(key, status))
+            statuses[key] = status
+            del next_check[key]
+        elif strategy.expired(t_start):
+            print("Error: {} not completed after {} seconds"\
+                  .format(key, strategy.deadline))
+            statuses[key] = "timeout"
+            del next_check[key]
+        else:
+            next_check[key] = time.monotonic() + \
+                              strategy.delay(n_checks[key])
+            continue
+        if hda_dict.get('metrics') is not None:
+            hda_dict['metrics'].record('poll', \
+                endpoint=get_endpoint_name(urls[key]), url=urls[key], \
+                status=statuses[key], checks=n_checks[key], \
+                seconds=time.monotonic() - t_start)
+    return statuses
+
+def get_request_status(hda_dict, t_step=1, t_max=60, strategy=None):
+    """ 
+    Requests the status of the process to assign a job ID.
+    
+    Parameters:
+        hda_dict: dictionary initied with the function init, that 
+                  stores all required information to be able to 
+                  interact with the HDA API
+        t_step: wait before the first check [s]
+        t_max: maximum wait between two checks [s]
+        strategy: PollingStrategy, overrides t_step and t_max
+
+    Returns:
+        Returns the final status of the job
+    """
+    if strategy is None:
+        strategy = PollingStrategy(t_start=t_step, t_max=t_max)
+    status, response = poll_status(hda_dict, hda_dict['broker_endpoint'] \
+                       + '/datarequest/status/' + hda_dict['job_id'], \
+                       strategy)
+    return status
+
+def get_results_page(hda_dict, page=0):
+    """ 
+    Requests one page of the results list of the current job.
     
     Parameters:
         hda_dict: dictionary initied with the function init, that 
                   stores all required information to be able to interact
                   with the HDA API
+        page: page number, starting at 0
 
     Returns:
-        Returns the dictionary including the list of filenames to be 
-        downloaded.
+        Returns the parsed results page, including the keys 'content', 
+        'page', 'pages' and 'totItems'.
     """
     params = {'page':page}
-    response = requests.get(hda_dict['broker_endpoint'] + \
+    response = hda_request(hda_dict, 'GET', hda_dict['broker_endpoint'] + \
                '/datarequest/jobs/' + hda_dict['job_id'] + \
                '/result', headers=hda_dict['headers'], params = params)
-    results = json.loads(response.text)
+    return json.loads(response.text)
+
+def iter_results(hda_dict, prefetch=True):
+    """ 
+    Iterates over the entries of all pages of the results list. Pages 
+    are requested lazily, so the first entries can be ordered while 
+    later pages are still loading.
+    
+    Parameters:
+        hda_dict: dictionary initied with the function init, that 
+                  stores all required information to be able to interact
+                  with the HDA API
+        prefetch: request the next page in a background thread while the
+                  entries of the current page are being consumed
+
+    Returns:
+        Yields the entries of the results list, as found in 
+        hda_dict['results']['content'].
+    """
+    pool = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+        page = 0
+        results = get_results_page(hda_dict, page)
+        while True:
+            # brokers may omit 'pages' or 'nextPage', then the other one
+            # or an empty page ends the list
+            last_page = not results['content'] \
+                        or page + 1 >= results.get('pages', float('inf')) \
+                        or results.get('nextPage', True) is None
+            if pool is not None and not last_page:
+                next_results = pool.submit(get_results_page, hda_dict, \
+                                           page + 1)
+            for item in results['content']:
+                yield item
+            if last_page:
+                break
+            page += 1
+            if pool is not None:
+                results = next_results.result()
+            else:
+                results = get_results_page(hda_dict, page)
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+def get_single_page(content):
+    """ 
+    Returns a results page holding all entries of the results list.
+    """
+    return {'content': content, 'itemsInPage': len(content),
+            'totItems': len(content), 'page': 0, 'pages': 1,
+            'nextPage': None, 'previousPage': None}
+
+def get_results_list(hda_dict, page=0, verbose=False, all_pages=False):
+    """ 
+    Generates a list of filenames to be available for download
+    
+    Parameters:
+        hda_dict: dictionary initied with the function init, that 
+                  stores all required information to be able to interact
+                  with the HDA API
+        page: page of the results list to request
+        all_pages: request all pages (see iter_results) and store their
+                   entries as a single page
+
+    Returns:
+        Returns the dictionary including the list of filenames to be 
+        downloaded.
+    """
+    if all_pages:
+        results = get_single_page(list(iter_results(hda_dict)))
+    else:
+        results = get_results_page(hda_dict, page)
     hda_dict['results']=results
 
     if verbose:
@@ -248,51 +1001,78 @@ def get_results_list(hda_dict, page=0, verbose=False):
     
     return hda_dict
 
-def get_order_ids(hda_dict):
+def place_order(hda_dict, result):
     """ 
-    Assigns each file to be downloaded a unique order ID.
+    Places an order for a single entry of the results list.
     
     Parameters:
         hda_dict: dictionary initied with the function init, that 
                   stores all required information to be able to 
                   interact with the HDA API
+        result: one entry of hda_dict['results']['content']
 
     Returns:
-        Returns the dictionary including the list of order IDs and the
-        request status of assigning the order IDs.
+        Returns the order ID, or None if the order was not accepted.
     """
-    i = 0
-    order_ids = []
-    order_sizes = []
+    # results merged from several jobs carry their own job id
+    data = {
+        "jobId": result.get('jobId', hda_dict['job_id']),
+        "uri": result['url']
+    }
 
-    for result in hda_dict['results']['content']:
+    response = hda_request(hda_dict, 'POST', hda_dict['broker_endpoint'] + \
+               '/dataorder', headers=hda_dict['headers'],\
+               json=data, verify=False)
 
-        data = {
-            "jobId": hda_dict['job_id'],
-            "uri": result['url']
-        }
+    if (response.status_code == hda_dict['CONST_HTTP_SUCCESS_CODE']):
+        order_id = json.loads(response.text)['orderId']
+        print ("Query successfully submitted. Order ID is " + order_id)
+        return order_id
+    else:
+        print("Error: Unexpected response {}".format(response))
+        return None
+
+def get_order_ids(hda_dict, strategy=None):
+    """ 
+    Assigns each file to be downloaded a unique order ID. All orders 
+    are placed first and then polled together until they are completed.
     
-        order_sizes.append(result['size'])
+    Parameters:
+        hda_dict: dictionary initied with the function init, that 
+                  stores all required information to be able to 
+                  interact with the HDA API
+        strategy: PollingStrategy used for the order status checks
+
+    Returns:
+        Returns the dictionary including the list of completed order 
+        IDs with the sizes and filenames of the ordered files. Files
+        found in the download cache (see enable_download_cache) are not
+        ordered but listed in hda_dict['cached_results'].
+    """
+    placed = {}
+    cached_results = []
+    for result in hda_dict['results']['content']:
+        if lookup_download_cache(hda_dict, result) is not None:
+            cached_results.append(result)
+            continue
+        order_id = place_order(hda_dict, result)
+        if order_id is not None:
+            placed[order_id] = result
 
-        response = requests.post(hda_dict['broker_endpoint'] + \
-                   '/dataorder', headers=hda_dict['headers'],\
-                   json=data, verify=False)
+    statuses = poll_many(hda_dict, order_ids=list(placed), \
+                         strategy=strategy)
+    order_ids = [o for o in placed if statuses[o] == "completed"]
 
-        if (response.status_code == hda_dict['CONST_HTTP_SUCCESS_CODE']):
-            order_ids.append(json.loads(response.text)['orderId'])
-            print ("Query successfully submitted. Order ID is " + \
-                   order_ids[i])
-            response = get_order_status(hda_dict,order_ids[i])
-        else:
-            print("Error: Unexpected response {}".format(response))
-        
-        i += 1
     hda_dict['order_ids']=order_ids
-    hda_dict['order_sizes']=order_sizes
-    hda_dict['order_status_response']=response
+    hda_dict['order_sizes']=[placed[o]['size'] for o in order_ids]
+    hda_dict['order_filenames']=[placed[o]['filename'] for o in order_ids]
+    hda_dict['order_results']=[placed[o] for o in order_ids]
+    hda_dict['order_statuses']=statuses
+    hda_dict['cached_results']=cached_results
     return hda_dict
 
-def get_order_status(hda_dict, order_id, t_step=5, t_max=60):
+def get_order_status(hda_dict, order_id, t_step=1, t_max=60, 
+                     strategy=None):
     """ 
     Requests the status of assigning an order ID for a data file.
     
@@ -301,76 +1081,605 @@ def get_order_status(hda_dict, order_id, t_step=5, t_max=60):
                   stores all required information to be able to 
                   interact with the HDA API
         order_id: the order id for the data file
+        t_step: wait before the first check [s]
+        t_max: maximum wait between two checks [s]
+        strategy: PollingStrategy, overrides t_step and t_max
 
     Returns:
         Returns the response of assigning an order ID.
     """
-    status = "not started"
-    n_messages = 0
-    while (status != "completed"):
-        n_messages = n_messages+1
-        report_timing_control(t_step*n_messages, t_max)
-        response = requests.get(hda_dict['broker_endpoint'] +\
-                   '/dataorder/status/' + order_id, \
-                   headers=hda_dict['headers'])
- 
-        if (response.status_code == hda_dict['CONST_HTTP_SUCCESS_CODE']):
-            status = json.loads(response.text)['status']
-            print ("Query successfully submitted. Status is " + status)
-        else:
-             print("Error: Unexpected response {}".format(response))
-    
+    if strategy is None:
+        strategy = PollingStrategy(t_start=t_step, t_max=t_max)
+    status, response = poll_status(hda_dict, hda_dict['broker_endpoint'] \
+                       + '/dataorder/status/' + order_id, strategy)
     return response
 
-def downloadFile(url, headers, directory, file_name, total_length = 0):
+# Time [s] after which a waiting download of another process is assumed
+# to be gone, see BandwidthScheduler
+WAITER_TIMEOUT = 5
+
+class BandwidthScheduler:
     """ 
-    Function to dowload a a single data file.
+    Limits the bandwidth used by all downloads of a process or, with a
+    lock file, of all processes on a host, e.g. the users of a shared
+    JupyterHub node. The limit is a token bucket that refills at rate 
+    bytes/s. Downloads ask for tokens before each chunk they read, and
+    take them from the bucket in batches, so that the bucket (and the 
+    lock file) is only locked about once per batch. When several are 
+    waiting, the one with the lowest priority value is served first, 
+    and among equal priorities the one served longest ago, so that they
+    share the bandwidth fairly. By default small products get a lower 
+    value than large ones (see downloadFile) and overtake them.
     
     Parameters:
+        rate: bandwidth limit [bytes/s]
+        burst: size of the token bucket [bytes], defaults to a quarter
+               of a second at rate
+        lock_file: path of a file, e.g. in /tmp, through which processes
+                   share the token bucket and the waiting downloads. All
+                   processes should use the same rate. None to limit 
+                   this process only. If the file cannot be opened, e.g.
+                   because another user created it without write 
+                   permission, only this process is limited.
+        batch: tokens taken from the bucket at once by a download 
+               [bytes], defaults to one second at rate. At most burst 
+               tokens are taken, unless a single chunk is larger.
+    """
+    def __init__(self, rate, burst=None, lock_file=None, batch=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate / 4, 65536)
+        self.batch = min(batch if batch is not None else rate, self.burst)
+        self.lock_file = lock_file
+        if lock_file is not None and fcntl is None:
+            print("Error: Lock files are not supported on this platform,"
+                  " limiting this process only")
+            self.lock_file = None
+        if self.lock_file is not None:
+            try:
+                self.open_lock_file().close()
+            except OSError as e:
+                print("Error: Cannot open lock file {} ({}), limiting this"
+                      " process only".format(lock_file, e))
+                self.lock_file = None
+        self.lock = threading.Lock()
+        self.state = self.new_state()
+        self.served = {}
+        self.reserved = {}
+        self.n_keys = 0
+
+    def new_state(self):
+        return {'tokens': self.burst, 'time': time.time(), 'waiting': {}}
+
+    def new_key(self):
+        """
+        Returns a key identifying a download across processes.
+        """
+        with self.lock:
+            self.n_keys += 1
+            return '{}-{}'.format(os.getpid(), self.n_keys)
+
+    def open_lock_file(self):
+        """
+        Opens the lock file for reading and writing. A new lock file is
+        made readable and writable by all users, whatever the umask, so
+        that the processes of other users can share it.
+        """
+        try:
+            fd = os.open(self.lock_file, \
+                         os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o666)
+            os.fchmod(fd, 0o666)
+        except FileExistsError:
+            fd = os.open(self.lock_file, os.O_RDWR)
+        return os.fdopen(fd, 'r+')
+
+    @contextlib.contextmanager
+    def shared_state(self):
+        """
+        Locks the state of the token bucket, in memory or in the lock 
+        file, and writes it back afterwards.
+        """
+        with self.lock:
+            if self.lock_file is None:
+                yield self.state
+                return
+            with self.open_lock_file() as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        state = json.loads(f.read())
+                    except ValueError:
+                        state = self.new_state()
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(state, f)
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def acquire(self, key, n_bytes, priority=(0,)):
+        """
+        Waits until the download identified by key may read n_bytes.
+        
+        Parameters:
+            key: key of the download, see new_key
+            n_bytes: size of the next chunk
+            priority: list or tuple, downloads with a lower value are 
+                      served first
+        """
+        with self.lock:
+            reserved = self.reserved.get(key, 0)
+            if reserved >= n_bytes:
+                self.reserved[key] = reserved - n_bytes
+                return
+        # the tokens still reserved count towards the chunk
+        n_bytes -= reserved
+        take = max(n_bytes, self.batch)
+        while True:
+            with self.shared_state() as state:
+                now = time.time()
+                state['tokens'] = min(self.burst, state['tokens'] + \
+                                      (now - state['time']) * self.rate)
+                state['time'] = now
+                waiting = state['waiting']
+                for other in [k for k, w in waiting.items() \
+                              if now - w[2] > WAITER_TIMEOUT]:
+                    del waiting[other]
+                waiting[key] = [list(priority), self.served.get(key, 0), now]
+                first = min(waiting, key=lambda k: waiting[k][:2])
+                needed = min(take, self.burst)
+                if first == key and state['tokens'] >= needed:
+                    state['tokens'] -= take
+                    del waiting[key]
+                    self.served[key] = now
+                    self.reserved[key] = take - n_bytes
+                    return
+                # the others wait at least as long as the first one
+                t_wait = max((needed - state['tokens']) / self.rate, \
+                             0.001 if first == key else 0.01)
+            time.sleep(min(t_wait, 0.1))
+
+    def release(self, key):
+        """
+        Removes a finished download from the scheduler and returns the 
+        tokens it has not used to the bucket.
+        """
+        with self.shared_state() as state:
+            state['waiting'].pop(key, None)
+            state['tokens'] += self.reserved.pop(key, 0)
+        self.served.pop(key, None)
+
+def enable_scheduler(hda_dict, rate, burst=None, lock_file=None):
+    """ 
+    Limits the bandwidth of the downloads made with the dictionary, see
+    BandwidthScheduler.
+    
+    Parameters:
+        hda_dict: dictionary initied with the function init, that 
+                  stores all required information to be able to 
+                  interact with the HDA API
+        rate: bandwidth limit [bytes/s]
+        burst: size of the token bucket [bytes]
+        lock_file: file shared with other processes on the host, e.g. 
+                   /tmp/wekeo-hda-bandwidth.json, so that the limit 
+                   applies to all of them
+        
+    Returns:
+        Returns the dictionary including the BandwidthScheduler
+    """
+    hda_dict['scheduler'] = BandwidthScheduler(rate, burst, lock_file)
+    return hda_dict
+
+def get_size_class(total_length):
+    """ 
+    Returns the size class of a file, the number of bits of its size, so
+    that files of similar size share bandwidth and much smaller files 
+    overtake larger ones.
+    """
+    return int(total_length or 0).bit_length()
+
+def get_download_response(session, url, headers, byte_range=None):
+    """ 
+    Sends the GET request of a download with streaming. If headers is a
+    function, it is called for each request so that a long download 
+    never uses an expired access token, and the request is repeated 
+    once with a new token if the data broker answers 401.
+    
+    Parameters:
+        session: pooled session (see get_session) or the requests module
         url: is the download url which included the unique order ID
-        headers:
-        directory: download directory, where data file shall be stored
-        file_name: name of the data file
+        headers: request headers including the access token, or a 
+                 function returning them that takes force and rejected
+                 arguments, e.g. functools.partial(get_headers, hda_dict)
+        byte_range: value of the Range header, e.g. 'bytes=1024-', or 
+                 None to request the whole file
         
     Returns:
-        Returns the time needed to download the data file.
+        Returns the response
     """
-    r = requests.get(url, headers=headers, stream=True)
+    def send(rejected=None):
+        request_headers = dict(headers(force=rejected is not None, \
+                               rejected=rejected) if callable(headers) \
+                               else headers)
+        if byte_range is not None:
+            request_headers['Range'] = byte_range
+        return session.get(url, headers=request_headers, stream=True), \
+               request_headers.get('Authorization', '')[len('Bearer '):]
 
-    if r.status_code == 200:
-        filename = os.path.join(directory,  file_name)
-        print("Downloading " + filename)
-        with open(filename, 'wb') as f:
-            start = time.process_time()
-            print("File size is: %8.2f MB" % (total_length/(1024*1024)))
-            dl = 0
+    r, token = send()
+    if r.status_code == 401 and callable(headers):
+        print("Access token rejected, requesting a new one")
+        r.close()
+        r, token = send(rejected=token)
+    return r
+
+def download_segments(url, headers, filename, total_length, n_segments=4,
+                      session=None, scheduler=None, priority=(0,)):
+    """ 
+    Downloads a single data file of known size over several connections
+    at once. The file is split into n_segments byte ranges, which are 
+    fetched in parallel and written with os.pwrite into a preallocated
+    file.
+    
+    Parameters:
+        url: is the download url which included the unique order ID
+        headers: request headers including the access token, or a 
+                 function returning them (see get_download_response)
+        filename: path of the file to be written
+        total_length: size of the data file in bytes
+        n_segments: number of parallel connections
+        session: optional pooled session (see get_session)
+        scheduler: optional BandwidthScheduler limiting the bandwidth
+        priority: priority of the segments for the scheduler
+        
+    Returns:
+        Returns True if all segments were downloaded. Returns False if 
+        the data broker does not serve the requested ranges, in which 
+        case no file is left behind.
+    """
+    if session is None:
+        session = requests
+    part_filename = filename + '.part'
+    segment = -(-total_length // n_segments)
+    ranges = [(first, min(first + segment, total_length) - 1) \
+              for first in range(0, total_length, segment)]
+
+    def fetch(first, last):
+        r = get_download_response(session, url, headers, \
+                                  'bytes={}-{}'.format(first, last))
+        content_range = r.headers.get('Content-Range', '')
+        if r.status_code != 206 or \
+           not content_range.endswith('/{}'.format(total_length)):
+            r.close()
+            raise requests.exceptions.RequestException(\
+                  "Range {}-{} not served".format(first, last))
+        offset = first
+        key = scheduler.new_key() if scheduler is not None else None
+        try:
             for chunk in r.iter_content(64738):
-                dl += len(chunk)
-                f.write(chunk)
-                if total_length is not None: # no content length header
-                    done = int(50 * dl / total_length)
-                    try:
-                        print("\r[%s%s]  %8.2f Mbps" \
-                            % ('=' * done, ' ' * (50-done),\
-                               (dl/(time.process_time() - start))\
-                               /(1024*1024)), end='', flush=True)
-                    except:
-                        pass
-                else:
-                    if( dl % (1024)  == 0 ):
-                        try:
-                            print("[%8.2f] MB downloaded, %8.2f kbps" \
-                                  % (dl / (1024 * 1024), \
-                                  (dl/(time.process_time() - start))/1024))
-                        except:
-                            pass
+                if scheduler is not None:
+                    scheduler.acquire(key, len(chunk), priority)
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+        finally:
+            if scheduler is not None:
+                scheduler.release(key)
+        if offset != last + 1:
+            raise requests.exceptions.RequestException(\
+                  "Range {}-{} incomplete".format(first, last))
+
+    fd = os.open(part_filename, os.O_RDWR | os.O_CREAT)
+    try:
+        os.ftruncate(fd, total_length)
+        with ThreadPoolExecutor(max_workers=n_segments) as pool:
+            for future in [pool.submit(fetch, first, last) \
+                           for first, last in ranges]:
+                future.result()
+    except requests.exceptions.RequestException as e:
+        print("Segmented download not possible ({})".format(e))
+        os.close(fd)
+        os.remove(part_filename)
+        return False
+    os.close(fd)
+    os.replace(part_filename, filename)
+    return True
+
+# Largest file [bytes] that download_to_buffer keeps in a BytesIO buffer,
+# larger files are memory-mapped from a temporary file
+MAX_MEMORY_BUFFER = 64 * 1024 * 1024
+
+# Minimum time [s] between two updates of a download progress bar
+PROGRESS_INTERVAL = 0.5
+
+# Hash algorithm of a checksum given without one, by hex digest length
+CHECKSUM_ALGORITHMS = {32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
+
+def get_checksum(result):
+    """ 
+    Returns the checksum of an entry of the results list, or an empty 
+    string if the data broker does not provide one.
+    """
+    return result.get('checksum') or \
+           (result.get('productInfo') or {}).get('checksum') or ''
+
+def parse_checksum(checksum):
+    """ 
+    Parses a checksum such as "md5:9e107d9d372bb6826bd81d3542a419d6" or
+    "sha-256=...". Without an algorithm, it is guessed from the length
+    of the hex digest.
+    
+    Returns:
+        Returns a tuple (algorithm, hex digest), or None if the checksum
+        is empty or not understood.
+    """
+    match = re.match(r'^(?:([\w-]+)[:=])?([0-9a-fA-F]+)$', \
+                     str(checksum or '').strip())
+    if match is None:
+        return None
+    algorithm, digest = match.groups()
+    if algorithm is None:
+        algorithm = CHECKSUM_ALGORITHMS.get(len(digest))
+    else:
+        algorithm = algorithm.lower().replace('-', '')
+    if algorithm not in hashlib.algorithms_available:
+        return None
+    return algorithm, digest.lower()
+
+def get_response_checksum(r):
+    """ 
+    Returns the checksum the data broker sent along with a download, 
+    from a Digest header (RFC 3230) or, for a complete file, a 
+    Content-MD5 header.
+    
+    Returns:
+        Returns a tuple (algorithm, hex digest), or None.
+    """
+    for item in r.headers.get('Digest', '').split(','):
+        algorithm, sep, value = item.strip().partition('=')
+        algorithm = algorithm.lower().replace('-', '')
+        if sep and algorithm in hashlib.algorithms_available:
             try:
-                print("[%8.2f] MB downloaded, %8.2f kbps" \
-                      % (dl / (1024 * 1024),\
-                      (dl/(time.process_time() - start))/1024))
-            except:
+                return algorithm, base64.b64decode(value).hex()
+            except ValueError:
                 pass
-            return (time.process_time() - start)
+    # Content-MD5 only covers the body sent, not the whole file
+    if r.status_code == 200 and r.headers.get('Content-MD5'):
+        try:
+            return 'md5', base64.b64decode(r.headers['Content-MD5']).hex()
+        except ValueError:
+            pass
+    return None
+
+def get_response_length(r):
+    """ 
+    Returns the size of the whole file as announced by the data broker,
+    or None if it is not known.
+    """
+    if r.status_code == 206:
+        total = r.headers.get('Content-Range', '').rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+    if r.headers.get('Content-Encoding', 'identity') != 'identity':
+        # the size on disk differs from the encoded size
+        return None
+    length = r.headers.get('Content-Length', '')
+    return int(length) if length.isdigit() else None
+
+def hash_file(filename, algorithm):
+    """ 
+    Hashes the content of a file.
+    
+    Returns:
+        Returns the hashlib object, so that more data can be added to it
+    """
+    hasher = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            hasher.update(chunk)
+    return hasher
+
+def downloadFile(url, headers, directory, file_name, total_length = 0,
+                 session=None, show_progress=True, max_resumes=3,
+                 n_segments=1, checksum=None, metrics=None,
+                 scheduler=None, priority=0):
+    """ 
+    Function to dowload a a single data file. The data is written to a
+    file_name.part file which is renamed once the download is complete.
+    If a .part file is already present, or the connection drops during
+    the download, the transfer is resumed with an HTTP Range request. 
+    If the data broker does not support ranges, the download restarts 
+    from byte zero.
+    
+    The file is checked before it is renamed: its size must match the 
+    size announced by the data broker (or total_length if the broker 
+    does not announce one), and its content must match the checksum 
+    given or sent by the broker, if any. Chunks are hashed while they 
+    are written. A truncated file is resumed, a file with a wrong size
+    or checksum is downloaded again.
+    
+    Parameters:
+        url: is the download url which included the unique order ID
+        headers: request headers including the access token, or a 
+                 function returning them, e.g. 
+                 functools.partial(get_headers, hda_dict). A function is
+                 called before each request, so that the token is 
+                 refreshed during long downloads (see 
+                 get_download_response).
+        directory: download directory, where data file shall be stored
+        file_name: name of the data file
+        session: optional pooled session (see get_session) to reuse an 
+                 open connection to the data broker
+        show_progress: print the progress bar while downloading, at 
+                 most every PROGRESS_INTERVAL seconds. Turned off when 
+                 several files are downloaded at the same time.
+        max_resumes: number of times a dropped or corrupt transfer is 
+                 resumed or restarted before giving up
+        n_segments: if larger than 1 and total_length is known, fetch
+                 the file over n_segments parallel connections (see 
+                 download_segments). Falls back to a single stream if 
+                 the data broker does not serve byte ranges.
+        checksum: expected checksum of the file (see parse_checksum), 
+                 e.g. from get_checksum(result)
+        metrics: optional Metrics object that records the size, time 
+                 and throughput of the download
+        scheduler: optional BandwidthScheduler that limits the bandwidth
+                 shared with other downloads
+        priority: priority of the download for the scheduler, lower 
+                 values are served first. Within a priority, smaller 
+                 files are served first (see get_size_class).
+        
+    Returns:
+        Returns the time needed to download the data file (wall-clock),
+        or None if the download failed.
+    """
+    if session is None:
+        session = requests
+    filename = os.path.join(directory,  file_name)
+    part_filename = filename + '.part'
+    expected = parse_checksum(checksum)
+    print("Downloading " + filename)
+    print("File size is: %8.2f MB" % (total_length/(1024*1024)))
+    start = time.perf_counter()
+    priority = (priority, get_size_class(total_length))
+    key = scheduler.new_key() if scheduler is not None else None
+
+    def finish(status, n_bytes, attempts):
+        if scheduler is not None:
+            scheduler.release(key)
+        elapsed = time.perf_counter() - start
+        if metrics is not None:
+            metrics.record('download', file_name=file_name, status=status,\
+                           bytes=n_bytes, seconds=elapsed, attempts=attempts,\
+                           bytes_per_s=n_bytes / elapsed if elapsed else 0)
+        return elapsed if status == "completed" else None
+
+    if n_segments > 1 and total_length and hasattr(os, 'pwrite'):
+        if download_segments(url, headers, filename, total_length,\
+                             n_segments, session, scheduler, priority):
+            # segments arrive out of order, so hash the file afterwards
+            if expected is None or \
+               hash_file(filename, expected[0]).hexdigest() == expected[1]:
+                return finish("completed", total_length, 1)
+            print("Checksum mismatch, downloading {} again".format(file_name))
+            os.remove(filename)
+    n_resumes = 0
+    last_progress = 0
+    while True:
+        dl = 0
+        if os.path.exists(part_filename):
+            dl = os.path.getsize(part_filename)
+        try:
+            r = get_download_response(session, url, headers, \
+                'bytes={}-'.format(dl) if dl > 0 else None)
+            if r.status_code == 416:
+                # nothing left to fetch if the partial file is complete
+                if not (total_length and dl == total_length):
+                    os.remove(part_filename)
+                    raise requests.exceptions.RequestException(\
+                          "Requested range not satisfiable")
+                mode = None
+                length = total_length
+            elif r.status_code == 206:
+                print("Resuming download at %8.2f MB" % (dl/(1024*1024)))
+                mode = 'ab'
+                length = get_response_length(r)
+            elif r.status_code == 200:
+                # no range support, restart from byte zero
+                dl = 0
+                mode = 'wb'
+                length = get_response_length(r)
+            else:
+                print("Error: Unexpected response {}".format(r))
+                return finish("failed", dl, n_resumes + 1)
+            if length is None:
+                length = total_length
+            elif total_length and length != total_length:
+                print("File size announced by the data broker ({} bytes) "
+                      "differs from the results list ({} bytes)"\
+                      .format(length, total_length))
+            file_checksum = expected or get_response_checksum(r)
+            hasher = None
+            if file_checksum is not None:
+                # hash the data already on disk once, then the new chunks
+                hasher = hash_file(part_filename, file_checksum[0]) \
+                         if mode != 'wb' else hashlib.new(file_checksum[0])
+            if mode is not None:
+                with open(part_filename, mode) as f:
+                    for chunk in r.iter_content(64738):
+                        if scheduler is not None:
+                            scheduler.acquire(key, len(chunk), priority)
+                        dl += len(chunk)
+                        f.write(chunk)
+                        if hasher is not None:
+                            hasher.update(chunk)
+                        now = time.perf_counter()
+                        if show_progress and \
+                           now - last_progress >= PROGRESS_INTERVAL:
+                            last_progress = now
+                            print_progress(dl, length, now - start)
+            if length and dl < length:
+                # keep the partial file, the next attempt resumes it
+                raise requests.exceptions.RequestException(\
+                      "Transfer incomplete, {} of {} bytes".format(dl, length))
+            error = verify_download(dl, length, hasher, file_checksum)
+            if error is not None:
+                os.remove(part_filename)
+                raise requests.exceptions.RequestException(error)
+            break
+        except requests.exceptions.RequestException as e:
+            n_resumes += 1
+            if n_resumes > max_resumes:
+                print("Error: Download failed after {} attempts: {}"\
+                      .format(n_resumes, e))
+                return finish("failed", dl, n_resumes)
+            print("\nTransfer interrupted ({}), resuming".format(e))
+
+    # atomic rename, the final file only appears once it is complete
+    os.replace(part_filename, filename)
+    if show_progress:
+        print_progress(dl, length, time.perf_counter() - start)
+        print()
+    return finish("completed", dl, n_resumes + 1)
+
+def verify_download(dl, length, hasher, checksum):
+    """ 
+    Checks a completed transfer against its expected size and checksum.
+    
+    Parameters:
+        dl: number of bytes received
+        length: expected size in bytes, 0 or None if unknown
+        hasher: hashlib object fed with the data, or None
+        checksum: expected (algorithm, hex digest), or None
+        
+    Returns:
+        Returns a description of the mismatch, or None if the data is 
+        correct.
+    """
+    if length and dl != length:
+        return "Size mismatch, {} instead of {} bytes".format(dl, length)
+    if hasher is not None and hasher.hexdigest() != checksum[1]:
+        return "Checksum mismatch, {} {} instead of {}".format(\
+               checksum[0], hasher.hexdigest(), checksum[1])
+    return None
+
+def print_progress(dl, total_length, elapsed):
+    """ 
+    Prints the progress bar of a download on a single line, with the 
+    amount downloaded and the average throughput.
+    
+    Parameters:
+        dl: bytes downloaded so far
+        total_length: size of the file in bytes, 0 or None if unknown
+        elapsed: time since the download started [s]
+    """
+    rate = dl / elapsed / (1024*1024) if elapsed > 0 else 0
+    if total_length:
+        done = min(int(50 * dl / total_length), 50)
+        print("\r[%s%s] %8.2f MB %8.2f MB/s" % ('=' * done, \
+              ' ' * (50-done), dl/(1024*1024), rate), end='', flush=True)
+    else:
+        print("\r[%8.2f] MB downloaded, %8.2f MB/s" \
+              % (dl/(1024*1024), rate), end='', flush=True)
 
 def get_filename_from_cd(cd):
     """
@@ -414,7 +1723,186 @@ def get_filenames(hda_dict):
         fileName.append(file['filename'])
     return fileName
 
-def download_data(hda_dict, file_extension=None, user_filename=None):
+def enable_download_cache(hda_dict, cache_dir=None, 
+                          max_size=50*1024**3):
+    """ 
+    Turns on a download cache shared between runs and users. Before an
+    order is placed, the cache is checked for the product and, if found,
+    the cached file is linked into the download directory instead.
+    
+    Parameters:
+        hda_dict: dictionary initied with the function init, that 
+                  stores all required information to be able to 
+                  interact with the HDA API
+        cache_dir: cache directory, defaults to a downloads directory in
+                   the cache_dir given to init
+        max_size: maximum size of the cache [bytes]. The least recently
+                  used files are removed once it is exceeded.
+        
+    Returns:
+        Returns the dictionary including the download cache settings
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(hda_dict['cache_dir'], 'downloads')
+    os.makedirs(cache_dir, exist_ok=True)
+    hda_dict['download_cache_dir'] = cache_dir
+    hda_dict['download_cache_max_size'] = max_size
+    return hda_dict
+
+def get_download_cache_file(hda_dict, result):
+    """ 
+    Returns the path under which an entry of the results list is stored
+    in the download cache. Products are identified by their filename 
+    and size, plus their checksum when the data broker provides one.
+    """
+    key = hashlib.sha256('{}\n{}\n{}'.format(result['filename'], \
+          result['size'], get_checksum(result)).encode()).hexdigest()
+    return os.path.join(hda_dict['download_cache_dir'], key)
+
+def lookup_download_cache(hda_dict, result):
+    """ 
+    Looks up an entry of the results list in the download cache.
+    
+    Returns:
+        Returns the path of the cached file, or None if the download 
+        cache is not enabled or the product is not cached.
+    """
+    if 'download_cache_dir' not in hda_dict:
+        return None
+    cache_file = get_download_cache_file(hda_dict, result)
+    if not os.path.isfile(cache_file):
+        return None
+    # mark as recently used
+    os.utime(cache_file)
+    return cache_file
+
+def add_to_download_cache(hda_dict, result, filename):
+    """ 
+    Adds a downloaded file to the download cache, if enabled, and 
+    removes the least recently used files if the cache is too large.
+    """
+    if 'download_cache_dir' not in hda_dict:
+        return
+    cache_file = get_download_cache_file(hda_dict, result)
+    tmp_file = cache_file + '.{}.tmp'.format(threading.get_ident())
+    try:
+        os.link(filename, tmp_file)
+    except OSError:
+        shutil.copyfile(filename, tmp_file)
+    os.replace(tmp_file, cache_file)
+    evict_download_cache(hda_dict)
+
+def evict_download_cache(hda_dict):
+    """ 
+    Removes the least recently used files from the download cache until
+    its size is below hda_dict['download_cache_max_size'].
+    """
+    cache_dir = hda_dict['download_cache_dir']
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.tmp'):
+            # still being written by add_to_download_cache
+            continue
+        try:
+            st = os.stat(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, name))
+    total_size = sum(entry[1] for entry in entries)
+    for mtime, size, name in sorted(entries):
+        if total_size <= hda_dict['download_cache_max_size']:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+        total_size -= size
+
+def link_file(source, target):
+    """ 
+    Makes a file available under a new path, as a hard link if possible,
+    otherwise as a copy. A symbolic link into the download cache would 
+    break once the cached file is evicted.
+    """
+    if os.path.lexists(target):
+        if os.path.exists(target) and os.path.samefile(source, target):
+            return
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+def get_download_name(file_name, file_extension=None, user_filename=None,
+                      index=None):
+    """ 
+    Returns the name under which a data file is saved. If index is given,
+    it is added to user_filename (before its extension), so that the 
+    files of several results do not overwrite each other.
+    """
+    if user_filename:
+        file_name=user_filename
+        if index is not None:
+            root, ext = os.path.splitext(user_filename)
+            file_name = '{}_{}{}'.format(root, index, ext)
+    if file_extension:
+        file_name = file_name + file_extension
+    return file_name
+
+def link_cached_results(hda_dict, file_extension=None, user_filename=None):
+    """ 
+    Links the files found in the download cache by get_order_ids into
+    the download directory.
+
+    Returns:
+        Returns the list of linked files
+    """
+    fileNames = []
+    for result in hda_dict.get('cached_results', []):
+        file_name = get_download_name(result['filename'], file_extension,\
+                                      user_filename)
+        target = os.path.join(hda_dict['download_dir_path'], file_name)
+        link_file(get_download_cache_file(hda_dict, result), target)
+        print("Found {} in the download cache".format(file_name))
+        fileNames.append(target)
+    return fileNames
+
+def extract_archive(filename, members=None, remove=False):
+    """ 
+    Extracts a downloaded zip archive into the directory it is stored 
+    in.
+    
+    Parameters:
+        filename: path of the archive
+        members: optional list of shell-style patterns, e.g. ['*.nc', 
+                 'xfdumanifest.xml']. Only archive members whose path or
+                 file name matches one of them are extracted.
+        remove: delete the archive after extraction
+        
+    Returns:
+        Returns the list of extracted files. Files that are not zip 
+        archives are returned unchanged.
+    """
+    if not zipfile.is_zipfile(filename):
+        return [filename]
+    directory = os.path.dirname(filename)
+    extracted = []
+    with zipfile.ZipFile(filename) as archive:
+        for name in archive.namelist():
+            if members is not None and not any( \
+               fnmatch.fnmatch(name, pattern) or \
+               fnmatch.fnmatch(os.path.basename(name.rstrip('/')), pattern)\
+               for pattern in members):
+                continue
+            extracted.append(archive.extract(name, directory))
+    if remove:
+        os.remove(filename)
+    print("Extracted {} files from {}".format(len(extracted), filename))
+    return extracted
+
+def download_data(hda_dict, file_extension=None, user_filename=None,
+                  n_segments=1, extract=False, extract_members=None,
+                  keep_archive=True, priority=0):
     """ 
     Downloads for each of the order IDs the associated data file.
     
@@ -426,46 +1914,449 @@ def download_data(hda_dict, file_extension=None, user_filename=None):
                   optional file extension to add to file
         user_filename:  
                   user specified download name
+        n_segments:
+                  number of parallel connections used for each file
+                  (see downloadFile)
+        extract:
+                  unpack zip archives on a worker thread as soon as each
+                  one is downloaded, while the next file is downloading
+        extract_members:
+                  patterns of the archive members to unpack, e.g. 
+                  ['*.nc', 'xfdumanifest.xml'] (see extract_archive)
+        keep_archive:
+                  keep the zip archives after unpacking. Removed archives
+                  are not listed in hda_dict['filenames'], only their 
+                  extracted files are.
+        priority:
+                  priority of the downloads if the bandwidth is limited
+                  (see enable_scheduler), lower values are served first
         
     Returns:
-        hda_dict: with names/paths of downloaded files
+        hda_dict: with names/paths of downloaded files, and of the 
+                  extracted files if extract is set, in the same order as
+                  the results list
     """
-    fileNames = []
-    fileName = get_filenames(hda_dict)
+    # files are listed by their position in the results list, also those
+    # found in the download cache
+    results = hda_dict['results']['content']
+    position = {r['url']: k for k, r in enumerate(results)}
+
+    def get_position(result):
+        # files of results not in the current results list go last
+        return position.setdefault(result['url'], \
+                                   len(results) + len(position))
+
+    fileNames = {}
+    extract_pool = ThreadPoolExecutor(max_workers=1) if extract else None
+    extractions = {}
+    for result, target in zip(hda_dict.get('cached_results', []), \
+            link_cached_results(hda_dict, file_extension, user_filename)):
+        k = get_position(result)
+        fileNames[k] = target
+        if extract:
+            extractions[k] = extract_pool.submit(extract_archive, target, \
+                             extract_members, not keep_archive)
+    if 'order_filenames' in hda_dict:
+        fileName = hda_dict['order_filenames']
+    else:
+        fileName = get_filenames(hda_dict)
     i=0
     for order_id in hda_dict['order_ids']:
-        if user_filename:
-            file_name=user_filename
-        else:
-            file_name=fileName[i]
-        
-        if file_extension:
-            file_name = file_name + file_extension
+        file_name = get_download_name(fileName[i], file_extension, \
+                                      user_filename)
 
         download_url = hda_dict['broker_endpoint'] + \
                        '/dataorder/download/' + order_id
     
         product_size = hda_dict['order_sizes'][i]
     
-        time_elapsed = downloadFile(download_url, hda_dict['headers'],\
+        time_elapsed = downloadFile(download_url, \
+                       functools.partial(get_headers, hda_dict),\
                        hda_dict['download_dir_path'], file_name,\
-                       product_size)
+                       product_size, session=hda_dict.get('session'),\
+                       n_segments=n_segments, checksum=get_checksum(\
+                       hda_dict['order_results'][i]) \
+                       if 'order_results' in hda_dict else None,\
+                       metrics=hda_dict.get('metrics'),\
+                       scheduler=hda_dict.get('scheduler'), priority=priority)
         
-        fileNames.append(os.path.join(hda_dict['download_dir_path'],file_name))
-
-        print("Download complete...")
-        print ("Time Elapsed: " + str(time_elapsed) + " seconds")
-        response=hda_dict['order_status_response']
-
-        if (response.status_code == hda_dict['CONST_HTTP_SUCCESS_CODE']):
-            order_file = "./" + file_name
-            if os.path.isfile(order_file):
-                print ("Query successfully submitted. Response is {}"\
-                       .format(response))
+        if time_elapsed is not None:
+            k = get_position(hda_dict['order_results'][i]) \
+                if 'order_results' in hda_dict else i
+            fileNames[k] = os.path.join(hda_dict['download_dir_path'], \
+                                        file_name)
+            if 'order_results' in hda_dict:
+                add_to_download_cache(hda_dict, \
+                    hda_dict['order_results'][i], fileNames[k])
+            print("Download complete...")
+            print ("Time Elapsed: " + str(time_elapsed) + " seconds")
+            if extract:
+                extractions[k] = extract_pool.submit(extract_archive, \
+                    fileNames[k], extract_members, not keep_archive)
         else:
-            print("Error: Unexpected response {}".format(response))
+            print("Error: Download of {} failed".format(file_name))
         
         i += 1
         
-    hda_dict['filenames'] = fileNames
+    hda_dict['filenames'] = [fileNames[k] for k in sorted(fileNames)]
+    if extract:
+        extracted = {k: extractions[k].result() for k in extractions}
+        hda_dict['extracted_files'] = [f for k in sorted(extracted) \
+                                       for f in extracted[k]]
+        extract_pool.shutdown()
+        if not keep_archive:
+            # only files that are not archives are returned unchanged
+            hda_dict['filenames'] = [fileNames[k] for k in sorted(fileNames)\
+                                     if extracted[k] == [fileNames[k]]]
+    return hda_dict
+
+def download_data_concurrent(hda_dict, file_extension=None, 
+                             user_filename=None, n_order_workers=4,
+                             n_download_workers=4, n_segments=1,
+                             strategy=None, extract=False, 
+                             extract_members=None, keep_archive=True,
+                             priority=0, all_pages=False):
+    """ 
+    Places the orders for all files in the results list, polls them and
+    downloads each file as soon as its order is completed. Orders and
+    downloads run in two bounded pools of worker threads, so this 
+    replaces calling get_order_ids followed by download_data. Files in
+    the download cache (see enable_download_cache) are linked instead of
+    ordered.
+    
+    Parameters:
+        hda_dict: dictionary initied with the function init, that 
+                  stores all required information to be able to 
+                  interact with the HDA API
+        file_extension: 
+                  optional file extension to add to file
+        user_filename:  
+                  user specified download name. If there are several 
+                  results, the index of the result is added to it, e.g.
+                  data_0.nc, data_1.nc for user_filename='data.nc'.
+        n_order_workers:
+                  maximum number of orders placed and polled at once
+        n_download_workers:
+                  maximum number of files downloaded at once. The 
+                  pool_size given to init should be at least 
+                  n_order_workers + n_download_workers * n_segments.
+        n_segments:
+                  number of parallel connections used for each file
+                  (see downloadFile)
+        strategy:
+                  PollingStrategy used for the order status checks
+        extract, extract_members, keep_archive:
+                  unpack zip archives right after they are downloaded,
+                  on the download worker (see download_data)
+        priority:
+                  priority of the downloads if the bandwidth is limited
+                  (see enable_scheduler), lower values are served first
+        all_pages:
+                  instead of hda_dict['results'], order the entries of all
+                  pages of the results list of the job while the pages 
+                  are requested (see iter_results), so that the first 
+                  orders do not wait for the last page. The entries are 
+                  stored as a single page in hda_dict['results'], as 
+                  get_results_list(all_pages=True) does. With 
+                  user_filename, the index of the result is always added.
+        
+    Returns:
+        hda_dict: with order IDs and names/paths of downloaded files, in 
+                  the same order as the results list
+    """
+    if all_pages:
+        entries = iter_results(hda_dict)
+    else:
+        entries = hda_dict['results']['content']
+    results = []
+    fileName = []
+    order_ids = []
+    fileNames = []
+    extractedFiles = []
+    downloads = []
+    lock = threading.Lock()
+    metrics = hda_dict.get('metrics')
+
+    def index(i):
+        # the files are written at the same time, so they need distinct names
+        return i if all_pages or len(entries) > 1 else None
+
+    def queued(queue, submitted):
+        if metrics is not None:
+            metrics.record('queue_wait', queue=queue, \
+                           seconds=time.perf_counter() - submitted)
+
+    def download(i, order_id, submitted):
+        queued('download', submitted)
+        file_name = get_download_name(fileName[i], file_extension, \
+                                      user_filename, index(i))
+
+        download_url = hda_dict['broker_endpoint'] + \
+                       '/dataorder/download/' + order_id
+
+        time_elapsed = downloadFile(download_url, \
+                       functools.partial(get_headers, hda_dict),\
+                       hda_dict['download_dir_path'], file_name,\
+                       results[i]['size'], session=hda_dict.get('session'),\
+                       show_progress=False, n_segments=n_segments,\
+                       checksum=get_checksum(results[i]), metrics=metrics,\
+                       scheduler=hda_dict.get('scheduler'), priority=priority)
+
+        if time_elapsed is not None:
+            fileNames[i] = os.path.join(hda_dict['download_dir_path'],\
+                                        file_name)
+            add_to_download_cache(hda_dict, results[i], fileNames[i])
+            print("Download of {} complete in {} seconds"\
+                  .format(file_name, time_elapsed))
+            if extract:
+                extractedFiles[i] = extract_archive(fileNames[i], \
+                                    extract_members, not keep_archive)
+
+    def order(i, submitted):
+        queued('order', submitted)
+        cached = lookup_download_cache(hda_dict, results[i])
+        if cached is not None:
+            file_name = get_download_name(fileName[i], file_extension, \
+                                          user_filename, index(i))
+            fileNames[i] = os.path.join(hda_dict['download_dir_path'],\
+                                        file_name)
+            link_file(cached, fileNames[i])
+            print("Found {} in the download cache".format(file_name))
+            if extract:
+                extractedFiles[i] = extract_archive(fileNames[i], \
+                                    extract_members, not keep_archive)
+            return
+        order_id = place_order(hda_dict, results[i])
+        if order_id is None:
+            return
+        status, response = poll_status(hda_dict, \
+                           hda_dict['broker_endpoint'] + \
+                           '/dataorder/status/' + order_id, strategy)
+        if status != "completed":
+            return
+        order_ids[i] = order_id
+        with lock:
+            downloads.append(download_pool.submit(download, i, order_id, \
+                                                  time.perf_counter()))
+
+    with ThreadPoolExecutor(max_workers=n_download_workers) as download_pool:
+        with ThreadPoolExecutor(max_workers=n_order_workers) as order_pool:
+            orders = []
+            for i, result in enumerate(entries):
+                results.append(result)
+                fileName.append(result['filename'])
+                order_ids.append(None)
+                fileNames.append(None)
+                extractedFiles.append([])
+                orders.append(order_pool.submit(order, i, \
+                                                time.perf_counter()))
+            for future in orders:
+                future.result()
+        for future in downloads:
+            future.result()
+
+    if all_pages:
+        hda_dict['results'] = get_single_page(results)
+
+    hda_dict['order_ids'] = [o for o in order_ids if o is not None]
+    hda_dict['order_sizes'] = [r['size'] for r, o in zip(results, order_ids) \
+                               if o is not None]
+    hda_dict['order_filenames'] = [r['filename'] for r, o \
+                                   in zip(results, order_ids) if o is not None]
+    hda_dict['order_results'] = [r for r, o in zip(results, order_ids) \
+                                 if o is not None]
+    hda_dict['filenames'] = [f for f, files in zip(fileNames, extractedFiles)\
+                             if f is not None and (keep_archive or \
+                             not extract or files == [f])]
+    if extract:
+        hda_dict['extracted_files'] = [f for files in extractedFiles \
+                                       for f in files]
+    return hda_dict
+
+def download_to_buffer(url, headers, total_length=0, session=None,
+                       max_memory=MAX_MEMORY_BUFFER, max_resumes=3,
+                       checksum=None, file_name=None, metrics=None,
+                       scheduler=None, priority=0):
+    """ 
+    Downloads a single data file into memory instead of the download
+    directory. Files of known size up to max_memory bytes are kept in a
+    BytesIO buffer. Larger files, or files of unknown size, are written
+    to an anonymous temporary file which is memory-mapped once the 
+    download is complete. As in downloadFile, interrupted transfers are
+    resumed and the size and checksum are verified.
+    
+    Parameters:
+        url: is the download url which included the unique order ID
+        headers: request headers including the access token, or a 
+                 function returning them (see get_download_response)
+        total_length: size of the data file in bytes, if known
+        session: optional pooled session (see get_session)
+        max_memory: largest file kept in a BytesIO buffer [bytes]
+        max_resumes, checksum, metrics, scheduler, priority:
+                 see downloadFile
+        file_name: name of the data file, for the messages and metrics
+        
+    Returns:
+        Returns a file-like object (io.BytesIO or mmap.mmap) positioned 
+        at the start of the data, or None if the download failed.
+    """
+    if session is None:
+        session = requests
+    expected = parse_checksum(checksum)
+    if total_length and total_length <= max_memory:
+        buffer = io.BytesIO()
+    else:
+        buffer = tempfile.TemporaryFile()
+    start = time.perf_counter()
+    priority = (priority, get_size_class(total_length))
+    key = scheduler.new_key() if scheduler is not None else None
+    status = "failed"
+    n_resumes = 0
+    dl = 0
+    try:
+        while True:
+            dl = buffer.seek(0, os.SEEK_END)
+            try:
+                r = get_download_response(session, url, headers, \
+                    'bytes={}-'.format(dl) if dl > 0 else None)
+                if r.status_code == 200:
+                    # no range support, restart from byte zero
+                    buffer.seek(0)
+                    buffer.truncate()
+                    dl = 0
+                elif r.status_code != 206:
+                    print("Error: Unexpected response {}".format(r))
+                    break
+                length = get_response_length(r) or total_length
+                file_checksum = expected or get_response_checksum(r)
+                hasher = None
+                if file_checksum is not None:
+                    hasher = hashlib.new(file_checksum[0])
+                    buffer.seek(0)
+                    for chunk in iter(lambda: buffer.read(1024*1024), b''):
+                        hasher.update(chunk)
+                for chunk in r.iter_content(64738):
+                    if scheduler is not None:
+                        scheduler.acquire(key, len(chunk), priority)
+                    buffer.write(chunk)
+                    dl += len(chunk)
+                    if hasher is not None:
+                        hasher.update(chunk)
+                if length and dl < length:
+                    raise requests.exceptions.RequestException(\
+                          "Transfer incomplete, {} of {} bytes"\
+                          .format(dl, length))
+                error = verify_download(dl, length, hasher, file_checksum)
+                if error is not None:
+                    buffer.seek(0)
+                    buffer.truncate()
+                    raise requests.exceptions.RequestException(error)
+                status = "completed"
+                break
+            except requests.exceptions.RequestException as e:
+                n_resumes += 1
+                if n_resumes > max_resumes:
+                    print("Error: Download failed after {} attempts: {}"\
+                          .format(n_resumes, e))
+                    break
+                print("Transfer interrupted ({}), resuming".format(e))
+    finally:
+        if scheduler is not None:
+            scheduler.release(key)
+
+    elapsed = time.perf_counter() - start
+    if metrics is not None:
+        metrics.record('download', file_name=file_name or url, \
+                       status=status, bytes=dl, seconds=elapsed, \
+                       attempts=n_resumes + 1, \
+                       bytes_per_s=dl / elapsed if elapsed else 0)
+    if status != "completed":
+        buffer.close()
+        return None
+    if isinstance(buffer, io.BytesIO):
+        buffer.seek(0)
+        return buffer
+    if dl == 0:
+        buffer.close()
+        return io.BytesIO()
+    # the mapping stays valid after the temporary file is closed
+    buffer.flush()
+    data = mmap.mmap(buffer.fileno(), 0, access=mmap.ACCESS_READ)
+    buffer.close()
+    return data
+
+def open_dataset(buffer, engine=None, **kwargs):
+    """ 
+    Opens a NetCDF file held in memory (see download_to_buffer) as an 
+    xarray Dataset. xarray is only imported when this function is used.
+    
+    Parameters:
+        buffer: file-like object with the content of the NetCDF file
+        engine: xarray backend, by default 'scipy' for NetCDF3 and 
+                'h5netcdf' for NetCDF4 files
+        kwargs: keyword arguments passed on to xarray.open_dataset
+        
+    Returns:
+        Returns the xarray Dataset, or None if the data is not a NetCDF
+        file (e.g. a zip archive).
+    """
+    import xarray as xr
+    if engine is None:
+        buffer.seek(0)
+        magic = buffer.read(4)
+        buffer.seek(0)
+        if magic.startswith(b'CDF'):
+            engine = 'scipy'
+        elif magic == b'\x89HDF':
+            engine = 'h5netcdf'
+        else:
+            print("Error: Not a NetCDF file, download it with download_data")
+            return None
+    return xr.open_dataset(buffer, engine=engine, **kwargs)
+
+def open_datasets(hda_dict, n_workers=4, max_memory=MAX_MEMORY_BUFFER,
+                  engine=None, **kwargs):
+    """ 
+    Downloads the data file of each of the order IDs into memory and 
+    opens it as an xarray Dataset, without writing to the download 
+    directory. Meant for many small NetCDF products, e.g. Sentinel-5P 
+    L2 or CAMS; use download_data for zip archives.
+    
+    Parameters:
+        hda_dict: dictionary initied with the function init, that 
+                  stores all required information to be able to 
+                  interact with the HDA API, after get_order_ids
+        n_workers: maximum number of files downloaded at once
+        max_memory: see download_to_buffer
+        engine, kwargs: see open_dataset
+        
+    Returns:
+        hda_dict: with the list of Datasets, in the order of the order 
+                  IDs. Entries of failed downloads are None.
+    """
+    if 'order_results' in hda_dict:
+        results = hda_dict['order_results']
+    else:
+        results = [{'filename': f, 'size': s} for f, s in \
+                   zip(get_filenames(hda_dict), hda_dict['order_sizes'])]
+
+    def load(order_id, result):
+        buffer = download_to_buffer(hda_dict['broker_endpoint'] + \
+                 '/dataorder/download/' + order_id, \
+                 functools.partial(get_headers, hda_dict), \
+                 result['size'], session=hda_dict.get('session'), \
+                 max_memory=max_memory, checksum=get_checksum(result), \
+                 file_name=result['filename'], \
+                 metrics=hda_dict.get('metrics'), \
+                 scheduler=hda_dict.get('scheduler'))
+        if buffer is None:
+            print("Error: Download of {} failed".format(result['filename']))
+            return None
+        print("Loaded " + result['filename'])
+        return open_dataset(buffer, engine, **kwargs)
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        datasets = list(pool.map(load, hda_dict['order_ids'], results))
+
+    hda_dict['datasets'] = datasets
     return hda_dict
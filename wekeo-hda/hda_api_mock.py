@@ -0,0 +1,421 @@
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+class MockBroker:
+    """
+    Local stand-in for the WEkEO data broker, so that the HDA client can
+    be run and benchmarked offline. It serves the endpoints used by
+    hda_api_functions and hda_api_async under
+    http://127.0.0.1:<port>/databroker; pass endpoint as broker_endpoint
+    to hda_api_functions.init.
+
+    Products are generated on the fly from their URL, so that the same
+    product always has the same content and checksum.
+
+    Parameters:
+        port: port to listen on, 0 to pick a free one
+        latency: delay added to every request [s]
+        failure_rate: probability that a request is answered with 503
+        n_results: number of products returned by each job
+        page_size: number of products per page of the results list
+        file_size: size of each product in bytes, or a tuple (min, max)
+                   for products of random size
+        job_checks: number of status checks before a job is completed
+        order_checks: number of status checks before an order is
+                      completed
+        order_failure_rate: probability that an order ends as "failed"
+        truncate_rate: probability that a download is cut off halfway
+        bandwidth: maximum rate of each download [bytes/s], None for no
+                   limit
+        ranges: serve HTTP Range requests
+        checksums: list an md5 checksum for each product and send a
+                   Digest header with each download
+        token_lifetime: lifetime of the access tokens [s]
+        seed: seed for the random failures and file sizes
+    """
+    def __init__(self, port=0, latency=0, failure_rate=0, n_results=10,
+                 page_size=5, file_size=1024*1024, job_checks=2,
+                 order_checks=1, order_failure_rate=0, truncate_rate=0,
+                 bandwidth=None, ranges=True, checksums=True,
+                 token_lifetime=3600, seed=None):
+        self.port = port
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.n_results = n_results
+        self.page_size = page_size
+        self.file_size = file_size
+        self.job_checks = job_checks
+        self.order_checks = order_checks
+        self.order_failure_rate = order_failure_rate
+        self.truncate_rate = truncate_rate
+        self.bandwidth = bandwidth
+        self.ranges = ranges
+        self.checksums = checksums
+        self.token_lifetime = token_lifetime
+        self.random = random.Random(seed)
+        self.tokens = {}
+        self.terms_accepted = False
+        self.jobs = {}
+        self.orders = {}
+        self.products = {}
+        self.requests = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def endpoint(self):
+        """
+        Address of the mock data broker, to be used as broker_endpoint.
+        """
+        return 'http://127.0.0.1:{}/databroker'.format(self.port)
+
+    def start(self):
+        """
+        Starts serving on a background thread.
+
+        Returns:
+            Returns the MockBroker itself
+        """
+        self.server = ThreadingHTTPServer(('127.0.0.1', self.port), \
+                                          MockHandler)
+        self.server.daemon_threads = True
+        self.server.broker = self
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, \
+                         daemon=True).start()
+        return self
+
+    def stop(self):
+        """
+        Stops the server.
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def chance(self, probability):
+        """
+        Returns True with the given probability.
+        """
+        with self.lock:
+            return self.random.random() < probability
+
+    def count(self, endpoint):
+        """
+        Counts a request to an endpoint, see the requests attribute.
+        """
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def get_product(self, url):
+        """
+        Returns the description of a product, creating it on first use.
+        """
+        with self.lock:
+            if url not in self.products:
+                size = self.file_size
+                if isinstance(size, (tuple, list)):
+                    size = self.random.randint(*size)
+                self.products[url] = {'size': size, 'md5': None}
+            return self.products[url]
+
+    def get_content(self, url, first, last):
+        """
+        Returns bytes first to last (inclusive) of a product. The content
+        is a block of 64 kB derived from the URL, repeated.
+        """
+        block = hashlib.sha256(url.encode()).digest() * 2048
+        offset = first % len(block)
+        n_blocks = (last - first + 1 + offset) // len(block) + 1
+        return (block * n_blocks)[offset:offset + last - first + 1]
+
+    def get_md5(self, url):
+        """
+        Returns the md5 hex digest of a product.
+        """
+        product = self.get_product(url)
+        if product['md5'] is None:
+            md5 = hashlib.md5()
+            for first in range(0, product['size'], 1024*1024):
+                md5.update(self.get_content(url, first, \
+                           min(first + 1024*1024, product['size']) - 1))
+            product['md5'] = md5.hexdigest()
+        return product['md5']
+
+    def get_results(self, job_id, page):
+        """
+        Returns a page of the results list of a job.
+        """
+        job = self.jobs[job_id]
+        first = page * self.page_size
+        n_pages = -(-self.n_results // self.page_size)
+        content = []
+        for i in range(first, min(first + self.page_size, self.n_results)):
+            name = 'product_{}_{:04d}'.format(job['key'], i)
+            url = '{}/{}.nc'.format(job['dataset_id'], name)
+            result = {'filename': name + '.nc',
+                      'size': self.get_product(url)['size'],
+                      'url': url,
+                      'productInfo': {'datasetId': job['dataset_id'],
+                                      'product': name}}
+            if self.checksums:
+                result['checksum'] = 'md5:' + self.get_md5(url)
+            content.append(result)
+        return {'content': content, 'itemsInPage': len(content),
+                'page': page, 'pages': n_pages,
+                'totItems': self.n_results,
+                'nextPage': page + 1 if page + 1 < n_pages else None,
+                'previousPage': page - 1 if page > 0 else None}
+
+class MockHandler(BaseHTTPRequestHandler):
+    """
+    Handles the requests to a MockBroker.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def broker(self):
+        return self.server.broker
+
+    def send_json(self, value, code=200):
+        body = json.dumps(value).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        return json.loads(self.body or b'{}')
+
+    def authorised(self):
+        """
+        Checks the access token of the request, answering 401 if it is
+        unknown or expired.
+        """
+        token = self.headers.get('Authorization', '')[len('Bearer '):]
+        if self.broker.tokens.get(token, 0) > time.time():
+            return True
+        self.send_json({'message': 'Invalid or expired token'}, 401)
+        return False
+
+    def handle_request(self, method):
+        # read the body before any answer, an unread body would be taken
+        # for the next request on the kept-alive connection
+        length = int(self.headers.get('Content-Length', 0))
+        self.body = self.rfile.read(length) if length else b''
+        path = urlparse(self.path).path
+        match = re.match(r'^/databroker/([a-z]+)(?:/(.*))?$', path)
+        if match is None:
+            return self.send_json({'message': 'Not found'}, 404)
+        endpoint, rest = match.group(1), match.group(2) or ''
+        if rest.startswith('status/') or rest.startswith('download/'):
+            endpoint += '/' + rest.split('/')[0]
+        self.broker.count(method + ' ' + endpoint)
+        if self.broker.latency:
+            time.sleep(self.broker.latency)
+        if self.broker.chance(self.broker.failure_rate):
+            return self.send_json({'message': 'Service unavailable'}, 503)
+
+        if endpoint == 'gettoken':
+            return self.get_token()
+        if not self.authorised():
+            return
+        handler = {'GET termsaccepted': self.get_terms,
+                   'PUT termsaccepted': self.accept_terms,
+                   'GET querymetadata': self.get_metadata,
+                   'POST datarequest': self.post_job,
+                   'GET datarequest/status': self.get_job_status,
+                   'GET datarequest': self.get_results,
+                   'POST dataorder': self.post_order,
+                   'GET dataorder/status': self.get_order_status,
+                   'GET dataorder/download': self.get_download}\
+                  .get(method + ' ' + endpoint)
+        if handler is None:
+            return self.send_json({'message': 'Not found'}, 404)
+        return handler(rest)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def get_token(self):
+        if not self.headers.get('Authorization', '').startswith('Basic '):
+            return self.send_json({'message': 'Missing api key'}, 401)
+        token = uuid.uuid4().hex
+        self.broker.tokens[token] = time.time() + self.broker.token_lifetime
+        self.send_json({'access_token': token,
+                        'expires_in': self.broker.token_lifetime})
+
+    def get_terms(self, rest):
+        self.send_json({'accepted': self.broker.terms_accepted})
+
+    def accept_terms(self, rest):
+        self.broker.terms_accepted = True
+        self.send_json({'accepted': True})
+
+    def get_metadata(self, rest):
+        self.send_json({'datasetId': rest, 'parameters': {
+                        'boundingBoxes': [], 'dateRangeSelects': [],
+                        'multiStringSelects': [], 'stringChoices': []}})
+
+    def post_job(self, rest):
+        data = self.read_json()
+        job_id = uuid.uuid4().hex
+        # identical descriptors return the same products
+        key = hashlib.sha256(json.dumps(data, sort_keys=True).encode())\
+              .hexdigest()[:8]
+        self.broker.jobs[job_id] = {'dataset_id': data.get('datasetId', \
+                                    'EO:MOCK:DAT:DATASET'), 'key': key,
+                                    'checks': 0}
+        self.send_json({'jobId': job_id, 'status': 'started'})
+
+    def get_job_status(self, rest):
+        job = self.broker.jobs.get(rest.split('/')[-1])
+        if job is None:
+            return self.send_json({'message': 'Unknown job'}, 404)
+        job['checks'] += 1
+        status = 'completed' if job['checks'] >= self.broker.job_checks \
+                 else 'running'
+        self.send_json({'status': status, 'message': None})
+
+    def get_results(self, rest):
+        match = re.match(r'^jobs/([^/]+)/result$', rest)
+        if match is None or match.group(1) not in self.broker.jobs:
+            return self.send_json({'message': 'Unknown job'}, 404)
+        page = int(parse_qs(urlparse(self.path).query)\
+                   .get('page', ['0'])[0])
+        self.send_json(self.broker.get_results(match.group(1), page))
+
+    def post_order(self, rest):
+        data = self.read_json()
+        if data.get('jobId') not in self.broker.jobs:
+            return self.send_json({'message': 'Unknown job'}, 400)
+        order_id = uuid.uuid4().hex
+        self.broker.orders[order_id] = {'uri': data['uri'], 'checks': 0,
+            'failed': self.broker.chance(self.broker.order_failure_rate)}
+        self.send_json({'orderId': order_id, 'status': 'started'})
+
+    def get_order_status(self, rest):
+        order = self.broker.orders.get(rest.split('/')[-1])
+        if order is None:
+            return self.send_json({'message': 'Unknown order'}, 404)
+        order['checks'] += 1
+        status = 'running'
+        if order['checks'] >= self.broker.order_checks:
+            status = 'failed' if order['failed'] else 'completed'
+        self.send_json({'status': status, 'message': None})
+
+    def get_download(self, rest):
+        order = self.broker.orders.get(rest.split('/')[-1])
+        if order is None or order['failed'] or \
+           order['checks'] < self.broker.order_checks:
+            return self.send_json({'message': 'Order not ready'}, 404)
+        url = order['uri']
+        size = self.broker.get_product(url)['size']
+        first, last, code = 0, size - 1, 200
+        match = re.match(r'^bytes=(\d+)-(\d*)$', \
+                         self.headers.get('Range', ''))
+        if match is not None and self.broker.ranges:
+            first = int(match.group(1))
+            last = min(int(match.group(2) or size - 1), size - 1)
+            if first >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            code = 206
+
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Disposition', \
+                         'attachment; filename="{}"'.format(\
+                         url.rsplit('/', 1)[-1]))
+        self.send_header('Content-Length', str(last - first + 1))
+        if self.broker.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if code == 206:
+            self.send_header('Content-Range', \
+                             'bytes {}-{}/{}'.format(first, last, size))
+        if self.broker.checksums:
+            self.send_header('Digest', 'md5=' + base64.b64encode(\
+                             bytes.fromhex(self.broker.get_md5(url)))\
+                             .decode())
+        self.end_headers()
+
+        if self.broker.chance(self.broker.truncate_rate):
+            # cut the transfer off halfway
+            last = first + (last - first) // 2
+            self.close_connection = True
+        start = time.perf_counter()
+        sent = 0
+        for offset in range(first, last + 1, 64*1024):
+            chunk = self.broker.get_content(url, offset, \
+                    min(offset + 64*1024 - 1, last))
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            if self.broker.bandwidth:
+                t_wait = sent / self.broker.bandwidth - \
+                         (time.perf_counter() - start)
+                if t_wait > 0:
+                    time.sleep(t_wait)
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs a local mock of '
+                                     'the WEkEO data broker.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='delay added to every request [s]')
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help='probability of a 503 answer')
+    parser.add_argument('--n-results', type=int, default=10)
+    parser.add_argument('--page-size', type=int, default=5)
+    parser.add_argument('--file-size', type=int, default=1024*1024,
+                        help='size of each product [bytes]')
+    parser.add_argument('--job-checks', type=int, default=2)
+    parser.add_argument('--order-checks', type=int, default=1)
+    parser.add_argument('--order-failure-rate', type=float, default=0)
+    parser.add_argument('--truncate-rate', type=float, default=0)
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='maximum rate of each download [bytes/s]')
+    parser.add_argument('--no-ranges', action='store_true')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    broker = MockBroker(port=args.port, latency=args.latency,
+                        failure_rate=args.failure_rate,
+                        n_results=args.n_results, page_size=args.page_size,
+                        file_size=args.file_size, job_checks=args.job_checks,
+                        order_checks=args.order_checks,
+                        order_failure_rate=args.order_failure_rate,
+                        truncate_rate=args.truncate_rate,
+                        bandwidth=args.bandwidth, ranges=not args.no_ranges,
+                        seed=args.seed).start()
+    print("Mock data broker running at " + broker.endpoint)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        broker.stop()
+
+if __name__ == '__main__':
+    main()
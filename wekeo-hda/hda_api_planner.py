@@ -0,0 +1,200 @@
+import copy
+import json
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import hda_api_functions as hapi
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+def parse_date(date_string):
+    """
+    Parses a date of a data descriptor, e.g. "2019-12-30T00:00:00.000Z"
+    """
+    return datetime.strptime(date_string, DATE_FORMAT)
+
+def format_date(date):
+    """
+    Formats a date for a data descriptor, e.g. "2019-12-30T00:00:00.000Z"
+    """
+    return date.strftime(DATE_FORMAT)[:-4] + 'Z'
+
+def next_period_start(date, freq):
+    """
+    Returns the start of the period following the one containing date.
+
+    Parameters:
+        date: datetime
+        freq: 'year', 'month' or a number of days
+    """
+    if freq == 'year':
+        return datetime(date.year + 1, 1, 1)
+    if freq == 'month':
+        if date.month == 12:
+            return datetime(date.year + 1, 1, 1)
+        return datetime(date.year, date.month + 1, 1)
+    return date + timedelta(days=freq)
+
+def split_dates(start, end, freq):
+    """
+    Splits the time range start-end into consecutive, non-overlapping
+    ranges. Each range ends one millisecond before the next one starts.
+
+    Parameters:
+        start: start of the range, as in the data descriptor
+        end: end of the range, as in the data descriptor
+        freq: 'year', 'month' or a number of days
+
+    Returns:
+        Returns a list of (start, end) tuples in the format of the data
+        descriptor
+    """
+    t_start = parse_date(start)
+    t_end = parse_date(end)
+    ranges = []
+    while t_start <= t_end:
+        t_next = next_period_start(t_start, freq)
+        ranges.append((format_date(t_start), \
+                       format_date(min(t_next - timedelta(milliseconds=1),\
+                                       t_end))))
+        t_start = t_next
+    return ranges
+
+def split_bbox(bbox, tiles):
+    """
+    Splits a bounding box into nx x ny tiles of equal size.
+
+    Parameters:
+        bbox: list of four coordinates, where the first and third and the
+              second and fourth belong to the same axis
+        tiles: tuple (nx, ny) with the number of tiles along each axis
+
+    Returns:
+        Returns a list of bounding boxes
+    """
+    nx, ny = tiles
+    dx = (bbox[2] - bbox[0]) / nx
+    dy = (bbox[3] - bbox[1]) / ny
+    return [[bbox[0] + ix*dx, bbox[1] + iy*dy, \
+             bbox[0] + (ix+1)*dx, bbox[1] + (iy+1)*dy] \
+            for ix in range(nx) for iy in range(ny)]
+
+def split_descriptor(data, freq='year', variables=None, bbox_tiles=None):
+    """
+    Splits a data descriptor into smaller sub-jobs along time and,
+    optionally, along variables and bounding box tiles. Sub-jobs that
+    would be identical are only returned once.
+
+    Parameters:
+        data: dictionary containing the dataset description
+        freq: split the dateRangeSelectValues into ranges of one 'year',
+              one 'month' or a number of days. None to not split in time.
+        variables: name of a multiStringSelectValues entry (e.g.
+                   'variable') to split into one sub-job per value
+        bbox_tiles: tuple (nx, ny) to split the boundingBoxValues into
+                    nx x ny tiles
+
+    Returns:
+        Returns the list of sub-job data descriptors
+    """
+    subjobs = [data]
+
+    if freq is not None:
+        for i, dates in enumerate(data.get('dateRangeSelectValues', [])):
+            split = []
+            for subjob in subjobs:
+                for start, end in split_dates(dates['start'], \
+                                              dates['end'], freq):
+                    new = copy.deepcopy(subjob)
+                    new['dateRangeSelectValues'][i]['start'] = start
+                    new['dateRangeSelectValues'][i]['end'] = end
+                    split.append(new)
+            subjobs = split
+
+    if variables is not None:
+        for i, values in enumerate(data.get('multiStringSelectValues', [])):
+            if values['name'] != variables:
+                continue
+            split = []
+            for subjob in subjobs:
+                for value in values['value']:
+                    new = copy.deepcopy(subjob)
+                    new['multiStringSelectValues'][i]['value'] = [value]
+                    split.append(new)
+            subjobs = split
+
+    if bbox_tiles is not None:
+        for i, bbox in enumerate(data.get('boundingBoxValues', [])):
+            split = []
+            for subjob in subjobs:
+                for tile in split_bbox(bbox['bbox'], bbox_tiles):
+                    new = copy.deepcopy(subjob)
+                    new['boundingBoxValues'][i]['bbox'] = tile
+                    split.append(new)
+            subjobs = split
+
+    unique = {}
+    for subjob in subjobs:
+        unique.setdefault(json.dumps(subjob, sort_keys=True), subjob)
+    return list(unique.values())
+
+def run_subjob(hda_dict, data):
+    """
+    Submits a single sub-job, waits for it and collects all its results.
+
+    Returns:
+        Returns the list of results, each tagged with the 'jobId' of the
+        sub-job so that it can be ordered.
+    """
+    subjob_dict = dict(hda_dict)
+    subjob_dict = hapi.get_job_id(subjob_dict, data)
+    if subjob_dict['job_status'] != "completed":
+        print("Error: Sub-job {} did not complete".format(\
+              subjob_dict['job_id']))
+        return []
+    results = []
+    for result in hapi.iter_results(subjob_dict):
+        result = dict(result, jobId=subjob_dict['job_id'])
+        results.append(result)
+    return results
+
+def get_results_list(hda_dict, data, n_workers=4, freq='year',
+                     variables=None, bbox_tiles=None):
+    """
+    Splits the data descriptor into sub-jobs (see split_descriptor),
+    submits them concurrently and merges their results into a single
+    results list. Products returned by more than one sub-job are only
+    listed once. This replaces calling hda_api_functions.get_job_id and
+    get_results_list; the results can be ordered and downloaded with
+    hda_api_functions.get_order_ids and download_data as usual.
+
+    Parameters:
+        hda_dict: dictionary initied with the function
+                  hda_api_functions.init
+        data: dictionary containing the dataset description
+        n_workers: maximum number of sub-jobs running at once
+        freq, variables, bbox_tiles: see split_descriptor
+
+    Returns:
+        Returns the dictionary including the job IDs of the sub-jobs and
+        the merged results list.
+    """
+    subjobs = split_descriptor(data, freq, variables, bbox_tiles)
+    print("Submitting {} sub-jobs".format(len(subjobs)))
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        subjob_results = list(pool.map(lambda subjob: \
+                              run_subjob(hda_dict, subjob), subjobs))
+
+    content = {}
+    for results in subjob_results:
+        for result in results:
+            content.setdefault(result['url'], result)
+    content = list(content.values())
+
+    hda_dict['job_ids'] = sorted(set(r['jobId'] for r in content))
+    hda_dict['job_id'] = hda_dict['job_ids'][0] if content else ""
+    hda_dict['results'] = hapi.get_single_page(content)
+    for item in content:
+        print(item['filename'])
+    return hda_dict
@@ -0,0 +1,315 @@
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+import hda_api_functions as hapi
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    descriptor_hash TEXT PRIMARY KEY,
+    dataset_id TEXT,
+    descriptor TEXT,
+    job_id TEXT,
+    status TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS results (
+    descriptor_hash TEXT,
+    url TEXT,
+    job_id TEXT,
+    result TEXT,
+    order_id TEXT,
+    order_status TEXT,
+    download_state TEXT DEFAULT 'pending',
+    filename TEXT,
+    updated REAL,
+    PRIMARY KEY (descriptor_hash, url)
+);
+'''
+
+def init_state(hda_dict, db_path=None):
+    """
+    Opens (and if needed creates) the SQLite state store in which the
+    progress of retrievals is recorded, see retrieve.
+
+    Parameters:
+        hda_dict: dictionary initied with the function
+                  hda_api_functions.init
+        db_path: path of the database file, defaults to state.sqlite in
+                 the download directory
+
+    Returns:
+        Returns the dictionary including the path of the state store
+    """
+    if db_path is None:
+        db_path = os.path.join(hda_dict['download_dir_path'], \
+                               'state.sqlite')
+    with closing(connect(db_path)) as con, con:
+        con.executescript(SCHEMA)
+    hda_dict['state_db'] = db_path
+    return hda_dict
+
+def connect(db_path):
+    """
+    Opens a connection to the state store. Connections are short-lived,
+    so that several threads and processes can share the store.
+    """
+    return sqlite3.connect(db_path, timeout=60)
+
+def execute(hda_dict, sql, parameters=()):
+    """
+    Runs a statement on the state store and commits it.
+
+    Returns:
+        Returns all rows of the result
+    """
+    with closing(connect(hda_dict['state_db'])) as con, con:
+        return con.execute(sql, parameters).fetchall()
+
+def get_descriptor_hash(data):
+    """
+    Returns a hash identifying a data descriptor, independent of the
+    order of its keys.
+    """
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode())\
+           .hexdigest()
+
+def get_job(hda_dict, data, strategy=None):
+    """
+    Returns the job for the data descriptor, reusing a completed job
+    from the state store if there is one and submitting a new job
+    otherwise. A new job is recorded as soon as it is submitted, so that
+    a job still running when the process stopped is polled again 
+    instead of being submitted twice. The results of a job are recorded
+    in the store once it has completed.
+
+    Parameters:
+        hda_dict: dictionary initied with the function
+                  hda_api_functions.init and init_state
+        data: dictionary containing the dataset description
+        strategy: PollingStrategy for the job status checks
+
+    Returns:
+        Returns the dictionary including the job id and status
+    """
+    key = get_descriptor_hash(data)
+    rows = execute(hda_dict, 'SELECT job_id, status FROM jobs '
+                   'WHERE descriptor_hash = ?', (key,))
+    if rows and rows[0][1] == "completed":
+        print("Reusing job " + rows[0][0])
+        hda_dict['job_id'], hda_dict['job_status'] = rows[0]
+        return hda_dict
+
+    hda_dict['job_status'] = None
+    if rows and rows[0][1] == "running" and rows[0][0]:
+        print("Polling job " + rows[0][0] + " again")
+        hda_dict['job_id'] = rows[0][0]
+        hda_dict['job_status'] = hapi.get_request_status(hda_dict, \
+                                                   strategy=strategy)
+    if hda_dict['job_status'] is None or \
+       str(hda_dict['job_status']).lower() in hapi.FAILED_STATUSES:
+        # no job yet, or the recorded one failed
+        hda_dict = hapi.submit_job(hda_dict, data)
+        if not hda_dict['job_id']:
+            hda_dict['job_status'] = "failed"
+            return hda_dict
+        execute(hda_dict, 'INSERT OR REPLACE INTO jobs VALUES '
+                '(?,?,?,?,?,?)', (key, data.get('datasetId'), \
+                json.dumps(data), hda_dict['job_id'], "running", \
+                time.time()))
+        hda_dict['job_status'] = hapi.get_request_status(hda_dict, \
+                                                   strategy=strategy)
+    if hda_dict['job_status'] != "completed":
+        # a job that timed out is still running and polled again next time
+        if hda_dict['job_status'] != "timeout":
+            execute(hda_dict, 'UPDATE jobs SET status = ?, updated = ? '
+                    'WHERE descriptor_hash = ?', \
+                    (hda_dict['job_status'], time.time(), key))
+        return hda_dict
+
+    for result in hapi.iter_results(hda_dict):
+        execute(hda_dict, 'INSERT OR IGNORE INTO results (descriptor_hash,'
+                ' url, job_id, result, updated) VALUES (?,?,?,?,?)', \
+                (key, result['url'], \
+                 result.get('jobId', hda_dict['job_id']), \
+                 json.dumps(result), time.time()))
+    execute(hda_dict, 'UPDATE jobs SET status = ?, updated = ? '
+            'WHERE descriptor_hash = ?', ("completed", time.time(), key))
+    return hda_dict
+
+def set_result_state(hda_dict, key, url, **state):
+    """
+    Updates the recorded order and download state of a single result.
+    """
+    columns = ', '.join('{} = ?'.format(c) for c in state)
+    execute(hda_dict, 'UPDATE results SET ' + columns + ', updated = ? '
+            'WHERE descriptor_hash = ? AND url = ?', \
+            tuple(state.values()) + (time.time(), key, url))
+
+def retrieve(hda_dict, data, file_extension=None, user_filename=None,
+             strategy=None, n_segments=1, priority=0, n_order_workers=4,
+             n_download_workers=4, extract=False, extract_members=None,
+             keep_archive=True):
+    """
+    Runs a full retrieval (job, results, orders and downloads) for a
+    data descriptor and records every step in the state store. When run
+    again, e.g. after a kernel restart, it reconciles against the store:
+    a completed job is reused, files already downloaded are skipped and
+    orders already completed are downloaded without ordering again.
+    As in hda_api_functions.download_data_concurrent, orders and 
+    downloads run in two bounded pools of worker threads, which record
+    their progress as they go, and files in the download cache (see 
+    hda_api_functions.enable_download_cache) are linked instead of 
+    ordered.
+
+    Parameters:
+        hda_dict: dictionary initied with the function
+                  hda_api_functions.init and init_state
+        data: dictionary containing the dataset description
+        file_extension:
+                  optional file extension to add to file
+        user_filename:
+                  user specified download name, see 
+                  hda_api_functions.download_data_concurrent
+        strategy: hda_api_functions.PollingStrategy for status checks
+        n_segments:
+                  number of parallel connections used for each file
+        priority: priority of the downloads if the bandwidth is limited
+                  (see hda_api_functions.enable_scheduler)
+        n_order_workers:
+                  maximum number of orders placed and polled at once
+        n_download_workers:
+                  maximum number of files downloaded at once
+        extract, extract_members, keep_archive:
+                  unpack the zip archives downloaded or linked by this 
+                  run (see hda_api_functions.download_data). Archives
+                  removed after unpacking are recorded as extracted and
+                  not retrieved again.
+
+    Returns:
+        hda_dict: with names/paths of the files retrieved by this and 
+                  earlier runs, in the order of the results list, and of
+                  the files extracted by this run if extract is set
+    """
+    key = get_descriptor_hash(data)
+    hda_dict = get_job(hda_dict, data, strategy)
+    if hda_dict['job_status'] != "completed":
+        hda_dict['filenames'] = []
+        return hda_dict
+
+    rows = execute(hda_dict, 'SELECT url, result, order_id, order_status, '
+                   'download_state, filename FROM results '
+                   'WHERE descriptor_hash = ? ORDER BY rowid', (key,))
+    fileNames = [None] * len(rows)
+    extractedFiles = [[] for row in rows]
+    downloads = []
+    lock = threading.Lock()
+
+    def get_filename(i, result):
+        file_name = hapi.get_download_name(result['filename'], \
+                    file_extension, user_filename, \
+                    i if len(rows) > 1 else None)
+        return os.path.join(hda_dict['download_dir_path'], file_name)
+
+    def retrieved(i, url, filename):
+        set_result_state(hda_dict, key, url, download_state="downloaded", \
+                         filename=filename)
+        if not extract:
+            fileNames[i] = filename
+            return
+        extractedFiles[i] = hapi.extract_archive(filename, extract_members,\
+                                                 not keep_archive)
+        if keep_archive or extractedFiles[i] == [filename]:
+            fileNames[i] = filename
+        else:
+            set_result_state(hda_dict, key, url, download_state="extracted")
+
+    def download(i, url, result, order_id):
+        filename = get_filename(i, result)
+        download_url = hda_dict['broker_endpoint'] + \
+                       '/dataorder/download/' + order_id
+        time_elapsed = hapi.downloadFile(download_url, \
+                       functools.partial(hapi.get_headers, hda_dict), \
+                       hda_dict['download_dir_path'], \
+                       os.path.basename(filename), result['size'], \
+                       session=hda_dict.get('session'), show_progress=False,\
+                       n_segments=n_segments, \
+                       checksum=hapi.get_checksum(result), \
+                       metrics=hda_dict.get('metrics'), \
+                       scheduler=hda_dict.get('scheduler'), priority=priority)
+        if time_elapsed is None:
+            # the order may have expired, order again on the next run
+            set_result_state(hda_dict, key, url, order_status="failed", \
+                             download_state="failed")
+            return
+        print("Download of {} complete in {} seconds"\
+              .format(os.path.basename(filename), time_elapsed))
+        hapi.add_to_download_cache(hda_dict, result, filename)
+        retrieved(i, url, filename)
+
+    def order(i, url, result, order_id, order_status):
+        cached = hapi.lookup_download_cache(hda_dict, result)
+        if cached is not None:
+            filename = get_filename(i, result)
+            hapi.link_file(cached, filename)
+            print("Found {} in the download cache"\
+                  .format(os.path.basename(filename)))
+            retrieved(i, url, filename)
+            return
+        if order_id is None or order_status not in ("running", "completed"):
+            # place the missing order and record it straight away
+            order_id = hapi.place_order(hda_dict, result)
+            if order_id is None:
+                return
+            order_status = "running"
+            set_result_state(hda_dict, key, url, order_id=order_id, \
+                             order_status=order_status)
+        if order_status != "completed":
+            order_status, response = hapi.poll_status(hda_dict, \
+                                     hda_dict['broker_endpoint'] + \
+                                     '/dataorder/status/' + order_id, \
+                                     strategy)
+            set_result_state(hda_dict, key, url, order_status=order_status)
+            if order_status != "completed":
+                return
+        with lock:
+            downloads.append(download_pool.submit(download, i, url, \
+                                                  result, order_id))
+
+    n_retrieved = 0
+    with ThreadPoolExecutor(max_workers=n_download_workers) as download_pool:
+        with ThreadPoolExecutor(max_workers=n_order_workers) as order_pool:
+            orders = []
+            for i, (url, result, order_id, order_status, download_state, \
+                    filename) in enumerate(rows):
+                if download_state == "extracted":
+                    n_retrieved += 1
+                    continue
+                if download_state == "downloaded":
+                    if os.path.isfile(filename):
+                        fileNames[i] = filename
+                        n_retrieved += 1
+                        continue
+                    # file was removed since, download it again
+                    set_result_state(hda_dict, key, url, \
+                                     download_state="pending")
+                orders.append(order_pool.submit(order, i, url, \
+                              json.loads(result), order_id, order_status))
+            print("{} of {} files already downloaded".format(n_retrieved, \
+                  len(rows)))
+            for future in orders:
+                future.result()
+        for future in downloads:
+            future.result()
+
+    hda_dict['filenames'] = [f for f in fileNames if f is not None]
+    if extract:
+        hda_dict['extracted_files'] = [f for files in extractedFiles \
+                                       for f in files]
+    return hda_dict
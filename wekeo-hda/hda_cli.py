@@ -0,0 +1,224 @@
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import hda_api_functions as hapi
+import hda_api_state
+
+# Exit codes
+EXIT_OK = 0         # all files of all descriptors were retrieved
+EXIT_PARTIAL = 1    # some files or descriptors failed
+EXIT_USAGE = 2      # bad arguments, descriptor files or missing api key
+EXIT_AUTH = 3       # no access token or Terms and Conditions not accepted
+EXIT_FAILED = 4     # nothing was retrieved
+
+EPILOG = '''
+The api key is read from --api-key, the WEKEO_API_KEY environment
+variable, or generated from WEKEO_USERNAME and WEKEO_PASSWORD.
+
+exit codes:
+  0  all files of all descriptors were retrieved
+  1  some files or descriptors failed
+  2  bad arguments, descriptor files or missing api key
+  3  no access token or Terms and Conditions not accepted
+  4  nothing was retrieved
+'''
+
+def read_descriptors(filenames):
+    """
+    Reads data descriptors from JSON files. A file contains either a
+    single descriptor or a list of descriptors.
+
+    Returns:
+        Returns a list of (name, descriptor) tuples, where name is the
+        file name, followed by the index in the list if there are more
+        than one.
+    """
+    descriptors = []
+    for filename in filenames:
+        with open(filename) as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            data = [data]
+        for i, descriptor in enumerate(data):
+            if 'datasetId' not in descriptor:
+                raise ValueError('{} has no datasetId'.format(filename))
+            name = os.path.basename(filename)
+            if len(data) > 1:
+                name += '[{}]'.format(i)
+            descriptors.append((name, descriptor))
+    return descriptors
+
+def get_api_key(args):
+    """
+    Returns the api key from the arguments or the environment, or None.
+    """
+    if args.api_key:
+        return args.api_key
+    if os.environ.get('WEKEO_API_KEY'):
+        return os.environ['WEKEO_API_KEY']
+    if os.environ.get('WEKEO_USERNAME') and os.environ.get('WEKEO_PASSWORD'):
+        return hapi.generate_api_key(os.environ['WEKEO_USERNAME'], \
+                                     os.environ['WEKEO_PASSWORD'])
+    return None
+
+def new_dict(args, api_key, dataset_id):
+    """
+    Returns a dictionary initialised with the settings of the command
+    line.
+    """
+    hda_dict = hapi.init(dataset_id, api_key, args.download_dir, \
+               pool_size=max(10, 2 * args.workers * args.segments), \
+               cache_dir=args.cache_dir, broker_endpoint=args.broker)
+    if args.metrics is not None:
+        hda_dict['metrics'] = args.metrics_object
+    if args.rate is not None:
+        hda_dict['scheduler'] = args.scheduler
+    if args.cache:
+        hda_dict = hapi.enable_download_cache(hda_dict, \
+                   max_size=args.cache_size)
+    if args.resume:
+        hda_dict = hda_api_state.init_state(hda_dict)
+    return hapi.get_access_token(hda_dict)
+
+def retrieve(args, api_key, name, data):
+    """
+    Retrieves all files of a data descriptor.
+
+    Returns:
+        Returns a tuple of the number of files retrieved and the number
+        of files found, or None if the job failed.
+    """
+    print("{}: submitting {}".format(name, data['datasetId']))
+    hda_dict = new_dict(args, api_key, data['datasetId'])
+    strategy = hapi.PollingStrategy(t_start=args.poll_interval, \
+                                    deadline=args.deadline)
+    if args.resume:
+        hda_dict = hda_api_state.retrieve(hda_dict, data, \
+                   strategy=strategy, n_segments=args.segments, \
+                   priority=args.priority, \
+                   n_order_workers=args.workers, \
+                   n_download_workers=args.workers, extract=args.extract)
+        if hda_dict['job_status'] != "completed":
+            return None
+        n_results = hda_api_state.execute(hda_dict, 'SELECT COUNT(*) '
+                    'FROM results WHERE descriptor_hash = ?', \
+                    (hda_api_state.get_descriptor_hash(data),))[0][0]
+    else:
+        hda_dict = hapi.get_job_id(hda_dict, data, strategy)
+        if hda_dict['job_status'] != "completed":
+            return None
+        hda_dict = hapi.download_data_concurrent(hda_dict, \
+                   n_order_workers=args.workers, \
+                   n_download_workers=args.workers, \
+                   n_segments=args.segments, strategy=strategy, \
+                   extract=args.extract, priority=args.priority, \
+                   all_pages=True)
+        n_results = len(hda_dict['results']['content'])
+    return len(hda_dict['filenames']), n_results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Retrieves the data of '
+             'one or more WEkEO data descriptors (JSON files) with the '
+             'HDA API.', epilog=EPILOG,
+             formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('descriptors', nargs='+', metavar='descriptor',
+                        help='JSON file with a data descriptor or a list '
+                        'of data descriptors')
+    parser.add_argument('-o', '--download-dir', default='.',
+                        help='directory to download the data to')
+    parser.add_argument('--api-key', help='Base64-encoded api key')
+    parser.add_argument('-j', '--jobs', type=int, default=2,
+                        help='number of descriptors retrieved at once')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='number of orders and downloads per '
+                        'descriptor running at once')
+    parser.add_argument('--segments', type=int, default=1,
+                        help='number of connections per file')
+    parser.add_argument('--no-resume', dest='resume', action='store_false',
+                        help='do not record progress in a state store in '
+                        'the download directory. By default, files already'
+                        ' retrieved by an earlier run are skipped.')
+    parser.add_argument('--cache', action='store_true',
+                        help='use the shared download cache')
+    parser.add_argument('--cache-dir', help='cache directory, defaults to '
+                        '~/.cache/wekeo-hda')
+    parser.add_argument('--cache-size', type=float, default=50*1024**3,
+                        help='maximum size of the download cache [bytes]')
+    parser.add_argument('--extract', action='store_true',
+                        help='unpack downloaded zip archives')
+    parser.add_argument('--rate', type=float,
+                        help='bandwidth limit [bytes/s]')
+    parser.add_argument('--lock-file', help='file to share the bandwidth '
+                        'limit with other processes')
+    parser.add_argument('--priority', type=int, default=0,
+                        help='priority of the downloads if the bandwidth is'
+                        ' limited, lower values are served first')
+    parser.add_argument('--poll-interval', type=float, default=1,
+                        help='wait before the first status check [s]')
+    parser.add_argument('--deadline', type=float,
+                        help='give up on jobs and orders not completed '
+                        'after this many seconds')
+    parser.add_argument('--metrics', help='write a JSON summary of the '
+                        'metrics to this file')
+    parser.add_argument('--broker', help='address of the data broker')
+    args = parser.parse_args(argv)
+
+    try:
+        descriptors = read_descriptors(args.descriptors)
+    except (OSError, ValueError) as e:
+        print("Error: Cannot read descriptor: {}".format(e))
+        return EXIT_USAGE
+    api_key = get_api_key(args)
+    if api_key is None:
+        print("Error: No api key, use --api-key or set WEKEO_API_KEY")
+        return EXIT_USAGE
+    if args.metrics is not None:
+        args.metrics_object = hapi.Metrics()
+    if args.rate is not None:
+        args.scheduler = hapi.BandwidthScheduler(args.rate, \
+                         lock_file=args.lock_file)
+
+    # the token and the Terms and Conditions are shared by all descriptors
+    hda_dict = new_dict(args, api_key, descriptors[0][1]['datasetId'])
+    if 'headers' not in hda_dict:
+        return EXIT_AUTH
+    hda_dict = hapi.acceptTandC(hda_dict)
+    if not hda_dict.get('isTandCAccepted'):
+        return EXIT_AUTH
+
+    def run(descriptor):
+        name, data = descriptor
+        try:
+            return retrieve(args, api_key, name, data)
+        except Exception as e:
+            print("Error: {} failed: {}".format(name, e))
+            return None
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        outcomes = list(pool.map(run, descriptors))
+
+    print("************** Summary *******************************")
+    n_complete = 0
+    n_retrieved = 0
+    for (name, data), outcome in zip(descriptors, outcomes):
+        if outcome is None:
+            print("{}: failed".format(name))
+            continue
+        print("{}: {} of {} files".format(name, *outcome))
+        n_retrieved += outcome[0]
+        if outcome[0] == outcome[1]:
+            n_complete += 1
+    if args.metrics is not None:
+        args.metrics_object.export(args.metrics)
+
+    if n_complete == len(descriptors):
+        return EXIT_OK
+    if n_retrieved == 0 and n_complete == 0:
+        return EXIT_FAILED
+    return EXIT_PARTIAL
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (directory relative to the repository, module, modules that must not be
+# loaded by importing it, import time budget [ms])
+MODULES = [
+    ('wekeo-hda', 'hda_api_functions', ['requests', 'urllib3'], 100),
+    ('land', 'utils', ['matplotlib', 'eolearn', 'shapely'], 300),
+    ('ocean/OceanCaseStudies/tools', 'SST_plotting_tools',
+     ['matplotlib', 'cartopy', 'xarray', 'xmltodict'], 300),
+]
+
+CHECK = '''
+import sys
+sys.path.insert(0, {path!r})
+import {module}
+print('LOADED', ' '.join(m for m in {heavy!r} if m in sys.modules))
+'''
+
+def time_import(path, module, heavy):
+    """
+    Imports a module in a new interpreter.
+
+    Returns:
+        Returns a tuple of the import time [ms], as reported by
+        python -X importtime, and the list of heavy modules it loaded.
+        Returns None if the module cannot be imported.
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', \
+              CHECK.format(path=path, module=module, heavy=heavy)], \
+              capture_output=True, text=True)
+    if process.returncode != 0:
+        return None
+    match = re.search(r'^import time:\s+\d+ \|\s+(\d+) \| {}$'\
+                      .format(re.escape(module)), process.stderr, re.M)
+    loaded = process.stdout.split('LOADED')[-1].split()
+    return int(match.group(1)) / 1000, loaded
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the import time'
+                                     ' of the helper modules and checks that'
+                                     ' they do not load heavy dependencies'
+                                     ' (plotting, HTTP) at import.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--scale', type=float, default=1,
+                        help='factor applied to the time budgets, e.g. '
+                        'for slow machines')
+    args = parser.parse_args()
+
+    failed = False
+    print("%-20s %10s %10s  %s" % ('module', 'median ms', 'budget ms', \
+          'heavy modules loaded'))
+    for path, module, heavy, budget in MODULES:
+        runs = [time_import(os.path.join(ROOT, path), module, heavy) \
+                for i in range(args.repeat)]
+        if None in runs:
+            print("%-20s not importable here, skipped" % module)
+            continue
+        median = statistics.median(t for t, loaded in runs)
+        loaded = sorted(set(m for t, l in runs for m in l))
+        print("%-20s %10.1f %10.1f  %s" % (module, median, \
+              budget * args.scale, ' '.join(loaded) or '-'))
+        if loaded or median > budget * args.scale:
+            failed = True
+
+    if failed:
+        print("Error: Import time budget exceeded or heavy modules loaded")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())